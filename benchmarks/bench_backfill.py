@@ -0,0 +1,116 @@
+import sys
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+from datetime import timedelta
+from statistics import median
+
+import src.data
+from src.backfill import Backfill
+from src.poller import DevicePoller
+from tests.lass_stub import LASSStub
+
+DEVICES = [f"GAP{i:05d}" for i in range(4)]
+DROPS = 20
+LOST = 3
+FLAKY = 0.2
+CONCURRENCY = 3
+CHUNK = 3600
+
+
+def reading(stub: LASSStub, device_id: str, minutes: int) -> dict:
+    # A live reading, minutes after the history.
+    payload = stub.latest(device_id)
+    entry = payload["feeds"][0]["AirBox"]
+    timestamp = (stub.start + timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    entry["timestamp"] = payload["version"] = timestamp
+    return payload
+
+
+async def live(
+    poller: DevicePoller, stub: LASSStub, stop: asyncio.Event, minutes: int = 0
+) -> list:
+    # Live readings applied on the ingest thread every 20 ms, after minutes,
+    # and the time each took to be applied.
+    latencies = []
+    while not stop.is_set():
+        minutes += 1
+        payload = reading(stub, DEVICES[0], minutes)
+        started = time.perf_counter()
+        await poller.offload(poller.process_response, DEVICES[0], payload)
+        latencies.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(0.02)
+    return latencies
+
+
+async def loaded(stub: LASSStub) -> DevicePoller:
+    poller = DevicePoller(DEVICES, base_url=stub.url)
+    await poller.fetch_histories()
+    return poller
+
+
+async def recovery(history_size: int, directory: str):
+    # How long the gaps the stub dropped from the history take to fill, with
+    # a fifth of the requests failing, and the latency of live readings
+    # meanwhile against when idle.
+    async with LASSStub(
+        latency=0.02,
+        history_size=history_size,
+        drops=DROPS,
+        lost=LOST,
+        flaky=FLAKY,
+        seed=1,
+    ) as stub:
+        poller = await loaded(stub)
+        try:
+            stop = asyncio.Event()
+            idle = asyncio.create_task(live(poller, stub, stop))
+            await asyncio.sleep(1)
+            stop.set()
+            baseline = await idle
+
+            backfill = Backfill(
+                poller,
+                concurrency=CONCURRENCY,
+                retries=8,
+                chunk=CHUNK,
+                max_backoff=0.1,
+                checkpoint=f"{directory}/backfill.json",
+            )
+            stop = asyncio.Event()
+            busy = asyncio.create_task(live(poller, stub, stop, len(baseline)))
+            started = time.perf_counter()
+            added = await backfill.run_once()
+            elapsed = time.perf_counter() - started
+            stop.set()
+            during = await busy
+            print(
+                f"{len(DEVICES)} devices, {DROPS} windows dropped, {LOST} lost:"
+                f" {added} readings recovered in {elapsed:.2f} s with"
+                f" {backfill.fetched} chunks, {stub.ranged} requests, at most"
+                f" {stub.peak} at once"
+            )
+            print(
+                f"live reading latency ms: idle median {median(baseline):.2f}"
+                f" max {max(baseline):.2f}, during backfill median"
+                f" {median(during):.2f} max {max(during):.2f}"
+            )
+        finally:
+            await poller.aclose()
+
+
+async def main():
+    logging.getLogger("uvicorn").setLevel(logging.CRITICAL)
+    src.data.STORAGE = None
+    history_size = int(sys.argv[1]) if len(sys.argv) > 1 else 10_080
+    directory = tempfile.mkdtemp(prefix="backfill-")
+    try:
+        await recovery(history_size, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+import sys
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from statistics import median, quantiles
+
+import httpx
+
+import src.data
+from src.app import PM_Analyzer
+from src.data import DeviceHistory
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+HISTORY_SIZE = 10_080
+IDLE_SECONDS = 2.0
+REQUEST_INTERVAL = 0.005
+
+
+def consistent(history: DeviceHistory) -> bool:
+    # Readings, feeds and daily metrics all count the same readings.
+    try:
+        return (
+            history.num_of_records
+            == sum(len(records) for records in history.feeds.values())
+            == sum(metrics.count for metrics in history.daily_metrics.values())
+        )
+    except RuntimeError:
+        # Changed while being read.
+        return False
+
+
+async def measure(mode: str, history: dict, bulk: dict) -> dict:
+    service = PM_Analyzer([DEVICE])
+    poller = service.poller
+    poller.process_init_response(DEVICE, history)
+    transport = httpx.ASGITransport(app=service.app)
+    latencies = []
+    torn = {"views": 0, "live": 0}
+    done = asyncio.Event()
+    finished = []
+
+    async def ingest():
+        await asyncio.sleep(0.1)
+        if mode == "inline":
+            # How the poller ingested before, on the event loop.
+            poller.process_init_response(DEVICE, bulk)
+        elif mode == "offloaded":
+            await poller.offload(poller.process_init_response, DEVICE, bulk, None)
+        else:
+            await asyncio.sleep(IDLE_SECONDS)
+        finished.append(time.perf_counter())
+        done.set()
+
+    async def check():
+        while not done.is_set():
+            torn["views"] += not consistent(poller.view(DEVICE))
+            torn["live"] += not consistent(poller.histories[DEVICE])
+            await asyncio.sleep(0.001)
+
+    async def get(client: httpx.AsyncClient, scheduled: float):
+        response = await client.get("/data/metrics/")
+        assert response.status_code == 200
+        latencies.append((time.perf_counter() - scheduled) * 1000)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+        await client.get("/data/metrics/")
+        task = asyncio.create_task(ingest())
+        checker = asyncio.create_task(check())
+        # Requests arrive on a schedule and are timed from when they were due,
+        # so a blocked loop shows up in every request that waited for it,
+        # including those due while it was blocked.
+        requests = []
+        scheduled = time.perf_counter()
+        while not done.is_set() or scheduled < finished[0]:
+            requests.append(asyncio.create_task(get(client, scheduled)))
+            scheduled += REQUEST_INTERVAL
+            await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+        await asyncio.gather(task, checker, *requests)
+    await poller.drain()
+
+    view = poller.view(DEVICE)
+    assert view.num_of_records == HISTORY_SIZE + (
+        0 if mode == "idle" else len(bulk_readings(bulk))
+    )
+    assert consistent(view)
+    started = time.perf_counter()
+    poller.publish(DEVICE)
+    publish = (time.perf_counter() - started) * 1000
+    percentiles = quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": len(latencies),
+        "p50": median(latencies),
+        "p99": percentiles[98],
+        "max": max(latencies),
+        "torn_views": torn["views"],
+        "torn_live": torn["live"],
+        "publish": publish,
+    }
+
+
+def bulk_readings(bulk: dict) -> list:
+    return [
+        entry
+        for feed in bulk["feeds"]
+        for entries in feed.values()
+        for entry in entries
+    ]
+
+
+async def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    generator = PayloadGenerator(DEVICE)
+    history = generator.history(HISTORY_SIZE)
+    bulk = PayloadGenerator(
+        DEVICE, seed=1, end=generator.end + timedelta(minutes=count)
+    ).history(count)
+    print(f"GET /data/metrics/ while {count} readings are ingested")
+    print(
+        f"{'ingest':>10} {'requests':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>9}"
+        f" {'torn views':>10} {'torn live':>10} {'publish ms':>10}"
+    )
+    for mode in ("idle", "inline", "offloaded"):
+        result = await measure(mode, history, bulk)
+        print(
+            f"{mode:>10} {result['requests']:>9} {result['p50']:>8.2f}"
+            f" {result['p99']:>8.2f} {result['max']:>9.1f} {result['torn_views']:>10}"
+            f" {result['torn_live']:>10} {result['publish']:>10.2f}"
+        )
+        assert result["torn_views"] == 0
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+import sys
+import time
+import asyncio
+import logging
+
+import httpx
+
+import src.data
+from src.app import PM_Analyzer
+from src.cache import ResponseCache
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+HISTORY_SIZE = 10_080
+# A client polls about every 5 s and a reading arrives every minute.
+POLLS_PER_READING = 12
+PATHS = ["/data/metrics/", "/data/danger", "/data", "/"]
+
+
+def service(history: dict) -> PM_Analyzer:
+    analyzer = PM_Analyzer([DEVICE])
+    analyzer.poller.process_init_response(DEVICE, history)
+    analyzer.poller.publish(DEVICE)
+    return analyzer
+
+
+async def poll(mode: str, path: str, history: dict, polls: int) -> dict:
+    analyzer = service(history)
+    if mode == "recompute":
+        # Nothing kept, every poll serializes the view again.
+        analyzer.responses = ResponseCache(max_bytes=0)
+    generator = PayloadGenerator(DEVICE, seed=1)
+    headers = {"Accept-Encoding": "gzip" if mode == "gzip" else "identity"}
+    transport = httpx.ASGITransport(app=analyzer.app)
+    sent = 0
+    statuses = {200: 0, 304: 0}
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+        tag = None
+        started = time.process_time()
+        for i in range(polls):
+            if i and i % POLLS_PER_READING == 0:
+                analyzer.poller.process_response(
+                    DEVICE, generator.latest(i // POLLS_PER_READING)
+                )
+                analyzer.poller.publish(DEVICE)
+            if mode == "304" and tag is not None:
+                headers["If-None-Match"] = tag
+            response = await client.get(path, headers=headers)
+            statuses[response.status_code] += 1
+            sent += response.num_bytes_downloaded
+            tag = response.headers["etag"]
+        elapsed = time.process_time() - started
+    return {"bytes": sent / polls, "cpu": elapsed / polls * 1000, **statuses}
+
+
+async def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    polls = int(sys.argv[1]) if len(sys.argv) > 1 else 120
+    history = PayloadGenerator(DEVICE, danger_ratio=0.2).history(HISTORY_SIZE)
+    print(f"{polls} polls per endpoint, a new reading every {POLLS_PER_READING}")
+    print(
+        f"{'endpoint':>15} {'mode':>10} {'bytes/poll':>11} {'cpu ms/poll':>12}"
+        f" {'200':>5} {'304':>5}"
+    )
+    for path in PATHS:
+        for mode in ("recompute", "cached", "gzip", "304"):
+            result = await poll(mode, path, history, polls)
+            print(
+                f"{path:>15} {mode:>10} {result['bytes']:>11.0f}"
+                f" {result['cpu']:>12.2f} {result[200]:>5} {result[304]:>5}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
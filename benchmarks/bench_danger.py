@@ -0,0 +1,60 @@
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pydantic import TypeAdapter
+from fastapi.testclient import TestClient
+
+import src.data
+from src.app import PM_Analyzer
+from src.store import from_epoch
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+INSTANCES = TypeAdapter(list[datetime])
+
+
+def main():
+    src.data.STORAGE = None
+    counts = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    print(
+        f"{'records':>10} {'exceed':>8} {'episodes':>8} {'list KiB':>9}"
+        f" {'page KiB':>9} {'list ms':>8} {'page ms':>8} {'counts ms':>9}"
+    )
+    for count in counts:
+        service = PM_Analyzer([DEVICE])
+        history = service.poller.history(DEVICE)
+        # The dust level ramps from 0 to 79 every 80 minutes, so every ramp
+        # crosses the threshold once.
+        for i in range(count):
+            add(history, START + timedelta(minutes=i), i)
+        service.poller.publish(DEVICE)
+
+        index = history.danger["local"]
+        instances = [
+            from_epoch(row[0])
+            for row in history.feeds["AirBox"].range()
+            if row[3] > index.threshold
+        ]
+
+        # What /data/danger used to return, every exceeding timestamp.
+        started = time.perf_counter()
+        listing = INSTANCES.dump_json(instances)
+        elapsed_list = (time.perf_counter() - started) * 1000
+
+        client = TestClient(service.app)
+        started = time.perf_counter()
+        page = client.get("/data/danger", params={"limit": 10000})
+        elapsed_page = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        client.get("/data/danger/counts").json()
+        elapsed_counts = (time.perf_counter() - started) * 1000
+
+        print(
+            f"{count:>10} {len(instances):>8} {len(index):>8}"
+            f" {len(listing) / 1024:>9.0f} {len(page.content) / 1024:>9.0f}"
+            f" {elapsed_list:>8.1f} {elapsed_page:>8.1f} {elapsed_counts:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
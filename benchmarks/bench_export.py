@@ -0,0 +1,86 @@
+import os
+import gc
+import sys
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import src.data
+from src.app import PM_Analyzer
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def rss() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+async def request(app, path: str, query: str) -> tuple[int, int]:
+    # Drives the ASGI app directly so the client never holds the whole body.
+    baseline = rss()
+    peak = baseline
+    size = 0
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 8000),
+    }
+
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if requested:
+            await asyncio.Event().wait()
+        requested = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal peak, size
+        if message["type"] == "http.response.body":
+            size += len(message.get("body", b""))
+            peak = max(peak, rss())
+
+    await app(scope, receive, send)
+    return size, peak - baseline
+
+
+def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    counts = [int(arg) for arg in sys.argv[1:]] or [1_000_000]
+    print(f"{'records':>10} {'format':>8} {'MiB sent':>10} {'s':>8} {'RSS +MiB':>10}")
+    for count in counts:
+        service = PM_Analyzer([DEVICE])
+        history = service.poller.history(DEVICE)
+        for i in range(count):
+            add(history, START + timedelta(minutes=5 * i), i)
+        service.poller.publish(DEVICE)
+        gc.collect()
+        for format in ("ndjson", "csv"):
+            started = time.perf_counter()
+            size, growth = asyncio.run(
+                request(service.app, "/data/export", f"format={format}")
+            )
+            elapsed = time.perf_counter() - started
+            print(
+                f"{count:>10} {format:>8} {size / 2**20:>10.1f} {elapsed:>8.1f} {growth / 2**20:>10.1f}"
+            )
+        del service, history
+        gc.collect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import sys
+import time
+import random
+import asyncio
+import logging
+
+import httpx
+
+import src.data
+from src.app import PM_Analyzer
+from src.geo import SpatialIndex, distance
+from tests.payloads import PayloadGenerator
+
+# Devices spread over Taiwan, where most AirBoxes are.
+SOUTH, NORTH, WEST, EAST = 21.9, 25.3, 120.0, 122.0
+QUERIES = 500
+NEAREST = 10
+RADIUS = 2.0
+BOX = 0.05
+APP_DEVICES = 10_000
+
+
+def positions(count: int, seed: int = 0) -> dict[str, tuple[float, float]]:
+    rng = random.Random(seed)
+    return {
+        f"GEO{i:08d}": (
+            round(rng.uniform(SOUTH, NORTH), 5),
+            round(rng.uniform(WEST, EAST), 5),
+        )
+        for i in range(count)
+    }
+
+
+def points(seed: int = 1) -> list[tuple[float, float]]:
+    rng = random.Random(seed)
+    return [
+        (rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST)) for _ in range(QUERIES)
+    ]
+
+
+def scan_nearest(devices: dict, lat: float, lon: float) -> list:
+    return sorted(
+        (distance(lat, lon, *position), device_id)
+        for device_id, position in devices.items()
+    )[:NEAREST]
+
+
+def scan_radius(devices: dict, lat: float, lon: float) -> list:
+    found = []
+    for device_id, position in devices.items():
+        km = distance(lat, lon, *position)
+        if km <= RADIUS:
+            found.append((km, device_id))
+    return sorted(found)
+
+
+def scan_box(devices: dict, lat: float, lon: float) -> list:
+    return sorted(
+        device_id
+        for device_id, (y, x) in devices.items()
+        if lat <= y <= lat + BOX and lon <= x <= lon + BOX
+    )
+
+
+def timed(query, queries: list) -> tuple[float, list]:
+    started = time.perf_counter()
+    results = [query(lat, lon) for lat, lon in queries]
+    return (time.perf_counter() - started) / len(queries) * 1e6, results
+
+
+def index_queries(counts: list[int]):
+    # Microseconds per query against the index and against a scan of the
+    # latest position of every device.
+    queries = points()
+    print(
+        f"{'devices':>8} {'build ms':>9} {'query':>8} {'index us':>9}"
+        f" {'scan us':>10} {'speedup':>8} {'found':>6}"
+    )
+    for count in counts:
+        devices = positions(count)
+        index = SpatialIndex()
+        started = time.perf_counter()
+        for device_id, (lat, lon) in devices.items():
+            index.update(device_id, lat, lon, 0)
+        build = (time.perf_counter() - started) * 1000
+        cases = {
+            "nearest": (
+                lambda lat, lon: [
+                    (km, position.device_id)
+                    for km, position in index.nearest(lat, lon, NEAREST)
+                ],
+                scan_nearest,
+            ),
+            "radius": (
+                lambda lat, lon: [
+                    (km, position.device_id)
+                    for km, position in index.within_radius(lat, lon, RADIUS)
+                ],
+                scan_radius,
+            ),
+            "box": (
+                lambda lat, lon: [
+                    position.device_id
+                    for position in index.within_box(lat, lon, lat + BOX, lon + BOX)
+                ],
+                scan_box,
+            ),
+        }
+        for name, (query, scan) in cases.items():
+            indexed, found = timed(query, queries)
+            scanned, _ = timed(lambda lat, lon: scan(devices, lat, lon), queries)
+            average = sum(len(result) for result in found) / len(found)
+            print(
+                f"{count:>8} {build:>9.1f} {name:>8} {indexed:>9.1f}"
+                f" {scanned:>10.1f} {scanned / indexed:>7.0f}x {average:>6.1f}"
+            )
+
+
+async def endpoints(count: int):
+    # The endpoints with count devices that each reported one reading.
+    service = PM_Analyzer([])
+    poller = service.poller
+    started = time.perf_counter()
+    for i, (device_id, (lat, lon)) in enumerate(positions(count).items()):
+        payload = PayloadGenerator(device_id, seed=i).latest(1)
+        reading = payload["feeds"][0]["AirBox"]
+        reading.update(device_id=device_id, gps_lat=lat, gps_lon=lon)
+        poller.process_response(device_id, payload)
+    loaded = time.perf_counter() - started
+    print(f"{count} devices loaded in {loaded:.1f} s")
+
+    transport = httpx.ASGITransport(app=service.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+        lat, lon = points()[0]
+        paths = {
+            "nearest": f"/devices/nearest?lat={lat}&lon={lon}&k={NEAREST}",
+            "radius": f"/devices/within?lat={lat}&lon={lon}&radius={RADIUS}",
+            "box": f"/devices/within?south={lat}&west={lon}"
+            f"&north={lat + BOX}&east={lon + BOX}",
+        }
+        for name, path in paths.items():
+            found = (await client.get(path)).json()
+            started = time.perf_counter()
+            for _ in range(QUERIES):
+                await client.get(path)
+            elapsed = (time.perf_counter() - started) / QUERIES * 1000
+            print(f"GET {name}: {elapsed:.2f} ms, {len(found)} devices")
+
+
+def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    counts = [int(arg) for arg in sys.argv[1:]] or [1_000, 10_000, 100_000]
+    index_queries(counts)
+    asyncio.run(endpoints(APP_DEVICES))
+
+
+if __name__ == "__main__":
+    main()
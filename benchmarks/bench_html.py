@@ -0,0 +1,54 @@
+import sys
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from fastapi.testclient import TestClient
+
+import src.data
+from src.app import PM_Analyzer
+from tests.helpers import DEVICE, add
+
+REPEATS = 20
+
+
+def measure(client: TestClient, before=None) -> float:
+    elapsed = 0.0
+    for i in range(REPEATS):
+        if before:
+            before(i)
+        started = time.perf_counter()
+        client.get("/").raise_for_status()
+        elapsed += time.perf_counter() - started
+    return elapsed / REPEATS * 1000
+
+
+def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    counts = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    print(f"{'records':>10} {'cold ms':>10} {'cached ms':>10} {'new row ms':>10}")
+    for count in counts:
+        service = PM_Analyzer([DEVICE])
+        history = service.poller.history(DEVICE)
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        start = now - timedelta(minutes=5 * count)
+        for i in range(count):
+            add(history, start + timedelta(minutes=5 * i), i)
+        service.poller.publish(DEVICE)
+        client = TestClient(service.app)
+
+        started = time.perf_counter()
+        client.get("/").raise_for_status()
+        cold = (time.perf_counter() - started) * 1000
+        cached = measure(client)
+
+        def update(i: int):
+            add(history, now + timedelta(seconds=i + 1), i)
+            service.poller.publish(DEVICE)
+
+        incremental = measure(client, update)
+        print(f"{count:>10} {cold:>10.1f} {cached:>10.2f} {incremental:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
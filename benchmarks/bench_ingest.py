@@ -0,0 +1,76 @@
+import sys
+import json
+import time
+import logging
+
+import src.data
+from src.data import DeviceHistory, DeviceRecord
+from src.ingest import ingest_history, loads
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+
+
+def empty() -> DeviceHistory:
+    return DeviceHistory(
+        **{
+            "source": None,
+            "device_id": DEVICE,
+            "version": None,
+            "num_of_records": 0,
+            "feeds": {"AirBox": {}},
+            "danger": {},
+            "daily_metrics": {},
+        }
+    )
+
+
+def reference(history: DeviceHistory, response_data: dict, since=None):
+    # The record by record path process_init_response took before.
+    for feed in response_data["feeds"]:
+        for project in feed.keys():
+            for entry in feed[project]:
+                for key in entry.keys():
+                    if since is not None and key <= since:
+                        continue
+                    record = DeviceRecord(**entry[key])
+                    history.add_record(project, key, record)
+
+
+def throughput(counts: list[int]):
+    print(
+        f"{'records':>10} {'json ms':>8} {'fast ms':>8}"
+        f" {'reference/s':>12} {'bulk/s':>10} {'speedup':>8}"
+    )
+    for count in counts:
+        body = json.dumps(PayloadGenerator(DEVICE, projects=1).history(count)).encode()
+        started = time.perf_counter()
+        json.loads(body)
+        decode = time.perf_counter() - started
+        started = time.perf_counter()
+        loads(body)
+        fast = time.perf_counter() - started
+
+        rates = []
+        for path in (reference, ingest_history):
+            history = empty()
+            response_data = loads(body)
+            started = time.perf_counter()
+            path(history, response_data)
+            rates.append(count / (time.perf_counter() - started))
+            assert history.num_of_records == count
+        print(
+            f"{count:>10} {decode * 1000:>8.1f} {fast * 1000:>8.1f}"
+            f" {rates[0]:>12.0f} {rates[1]:>10.0f} {rates[1] / rates[0]:>7.1f}x"
+        )
+
+
+def main():
+    logging.getLogger("uvicorn").setLevel(logging.CRITICAL)
+    src.data.STORAGE = None
+    counts = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    throughput(counts)
+
+
+if __name__ == "__main__":
+    main()
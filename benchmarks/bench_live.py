@@ -0,0 +1,130 @@
+import sys
+import time
+import socket
+import asyncio
+import logging
+import multiprocessing
+from statistics import median, quantiles
+from datetime import datetime, timedelta, timezone
+
+import uvicorn
+
+import src.data
+from src.app import PM_Analyzer
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+CLIENT_PROCESSES = 4
+READINGS = 200
+RATE = 20
+SLOW_QUEUE_SIZE = 64
+
+
+async def subscribe(port: int, count: int) -> dict[str, float]:
+    # Reads the chunked event stream and notes when each reading arrived.
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /live HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await writer.drain()
+    await reader.readuntil(b"\r\n\r\n")
+    arrivals = {}
+    while len(arrivals) < count:
+        size = int(await reader.readline(), 16)
+        chunk = await reader.readexactly(size + 2)
+        arrived = time.time()
+        start = chunk.find(b'"timestamp": "')
+        if start >= 0:
+            arrivals[chunk[start + 14 : start + 34].decode()] = arrived
+    writer.close()
+    return arrivals
+
+
+def client(port: int, subscribers: int, count: int, results):
+    async def run():
+        return await asyncio.gather(
+            *(subscribe(port, count) for _ in range(subscribers))
+        )
+
+    results.put(asyncio.run(run()))
+
+
+async def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    service = PM_Analyzer([DEVICE])
+    history = service.poller.history(DEVICE)
+    broadcaster = service.poller.broadcaster
+    for i in range(1000):
+        add(history, START + timedelta(minutes=i), i)
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(service.app, port=port, log_level="warning", lifespan="off")
+    )
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    # Clients run in their own processes, spawned since this one has a loop.
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=client,
+            args=(port, subscribers // CLIENT_PROCESSES, READINGS, results),
+        )
+        for _ in range(CLIENT_PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    expected = subscribers // CLIENT_PROCESSES * CLIENT_PROCESSES
+    while len(broadcaster.subscribers.get(DEVICE, ())) < expected:
+        await asyncio.sleep(0.05)
+
+    # A subscriber that never reads is dropped once its queue is full.
+    broadcaster.queue_size = SLOW_QUEUE_SIZE
+    broadcaster.subscribe(DEVICE)
+
+    published = {}
+    costs = []
+    for i in range(1000, 1000 + READINGS):
+        timestamp = START + timedelta(minutes=i)
+        started = time.perf_counter()
+        published[timestamp.strftime("%Y-%m-%dT%H:%M:%SZ")] = time.time()
+        add(history, timestamp, i)
+        costs.append((time.perf_counter() - started) * 1e6)
+        await asyncio.sleep(1 / RATE)
+
+    arrivals = []
+    for _ in processes:
+        arrivals.extend(await asyncio.to_thread(results.get))
+    for process in processes:
+        process.join()
+    server.should_exit = True
+    await serving
+
+    latencies = [
+        (received[timestamp] - sent) * 1000
+        for received in arrivals
+        for timestamp, sent in published.items()
+    ]
+    # Fan-out completes when the last subscriber has the reading.
+    fanout = [
+        max(received[timestamp] for received in arrivals) - sent
+        for timestamp, sent in published.items()
+    ]
+    percentiles = quantiles(latencies, n=100)
+    print(f"{len(arrivals)} subscribers, {READINGS} readings at {RATE}/s")
+    print(f"add_record with subscribers: {median(costs):.0f} us median")
+    print(
+        f"delivery latency ms: p50 {percentiles[49]:.1f} p95 {percentiles[94]:.1f}"
+        f" p99 {percentiles[98]:.1f} max {max(latencies):.1f}"
+    )
+    print(f"fan-out to all subscribers ms: median {median(fanout) * 1000:.1f}")
+    print(f"slow subscribers dropped: {broadcaster.dropped}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+import sys
+import math
+import time
+import random
+import statistics
+from bisect import bisect_left
+
+import src.data
+from src.data import DailyMetrics
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def readings(days: int, per_day: int) -> list[list[float]]:
+    # PM2.5 is roughly log-normal with a long tail of polluted hours.
+    generator = random.Random(42)
+    return [
+        [round(generator.lognormvariate(2.5, 0.6), 1) for _ in range(per_day)]
+        for _ in range(days)
+    ]
+
+
+def exact_quantile(ordered: list[float], q: float) -> float:
+    position = q * (len(ordered) - 1)
+    lo = math.floor(position)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (position - lo)
+
+
+def rounded_average(values: list[float]) -> float:
+    # The previous update rule, which rebuilt the sum from the rounded average.
+    avg = values[0]
+    for count, value in enumerate(values[1:], start=1):
+        avg = round((avg * count + value) / (count + 1), 1)
+    return avg
+
+
+def errors(metrics: DailyMetrics, values: list[float]) -> list[float]:
+    # Quantiles are compared by rank, the usual accuracy measure for sketches,
+    # since the sparse upper tail turns small rank errors into large value gaps.
+    ordered = sorted(values)
+    ranks = [
+        abs(bisect_left(ordered, metrics._digest.quantile(q)) / len(ordered) - q)
+        for q in QUANTILES
+    ]
+    std = statistics.pstdev(values)
+    return ranks + [abs(metrics._stats.std - std) / std]
+
+
+def main():
+    src.data.STORAGE = None
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    per_day = int(sys.argv[2]) if len(sys.argv) > 2 else 1440
+    data = readings(days, per_day)
+
+    started = time.perf_counter()
+    daily = []
+    for values in data:
+        metrics = DailyMetrics.empty()
+        for value in values:
+            metrics.add(value)
+        daily.append(metrics)
+    streaming = (time.perf_counter() - started) / (days * per_day) * 1e6
+
+    started = time.perf_counter()
+    for values in data:
+        ordered = sorted(values)
+        [exact_quantile(ordered, q) for q in QUANTILES]
+        statistics.pstdev(values)
+    exact = (time.perf_counter() - started) / days * 1000
+
+    started = time.perf_counter()
+    for metrics in daily:
+        [metrics.percentile(q) for q in QUANTILES]
+    query = (time.perf_counter() - started) / days * 1000
+
+    worst = [max(column) for column in zip(*map(errors, daily, data))]
+    month = errors(DailyMetrics.merge(daily), [v for values in data for v in values])
+    drift = max(
+        abs(rounded_average(values) - statistics.fmean(values)) for values in data
+    )
+    welford = max(
+        abs(metrics._stats.mean - statistics.fmean(values))
+        for metrics, values in zip(daily, data)
+    )
+
+    print(f"{days} days of {per_day} readings")
+    print(f"streaming add: {streaming:.2f} us/reading")
+    print(f"percentiles per day: {query:.3f} ms streaming, {exact:.3f} ms exact")
+    print("error           p50 rank p95 rank p99 rank  std rel")
+    print("worst day       " + "".join(f"{e:>9.4f}" for e in worst))
+    print("merged month    " + "".join(f"{e:>9.4f}" for e in month))
+    print(f"average error: {drift:.3f} rounded update, {welford:.2e} Welford")
+
+
+if __name__ == "__main__":
+    main()
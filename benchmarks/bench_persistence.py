@@ -0,0 +1,103 @@
+import sys
+import time
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from src.data import DeviceRecord
+from src.persistence import RedisBackend, WriteBehindQueue, load_records
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def records(count: int, offset: int = 0):
+    for i in range(offset, offset + count):
+        yield DeviceRecord(
+            app="AirBox",
+            device_id="08BEAC0AB2DE",
+            s_t0=25.0,
+            s_h0=60.0,
+            s_d0=float(i % 80),
+            gps_lat=25.04,
+            gps_lon=121.54,
+            timestamp=START + timedelta(minutes=5 * i),
+        )
+
+
+def clear():
+    db = DeviceRecord.db()
+    prefix = DeviceRecord.make_key(DeviceRecord._meta.primary_key_pattern.format(pk=""))
+    keys = list(db.scan_iter(match=f"{prefix}*", count=10000))
+    for lo in range(0, len(keys), 10000):
+        db.delete(*keys[lo : lo + 10000])
+
+
+def seed(count: int):
+    queue = WriteBehindQueue(RedisBackend(DeviceRecord))
+    for record in records(count):
+        queue.put(record)
+        if len(queue.pending) >= 10000:
+            queue.flush()
+    queue.flush()
+
+
+def restore_per_key(limit: int) -> float:
+    started = time.perf_counter()
+    for loaded, pk in enumerate(DeviceRecord.all_pks()):
+        DeviceRecord.get(pk)
+        if loaded + 1 >= limit:
+            break
+    return loaded + 1, time.perf_counter() - started
+
+
+def restore_pipelined() -> tuple[int, float]:
+    started = time.perf_counter()
+    loaded = sum(1 for _ in load_records(DeviceRecord))
+    return loaded, time.perf_counter() - started
+
+
+def ingest_per_record(count: int) -> float:
+    batch = list(records(count, offset=10**7))
+    started = time.perf_counter()
+    for record in batch:
+        record.save()
+    return count / (time.perf_counter() - started)
+
+
+async def ingest_write_behind(count: int) -> float:
+    batch = list(records(count, offset=2 * 10**7))
+    queue = WriteBehindQueue(RedisBackend(DeviceRecord))
+    writer = asyncio.create_task(queue.run())
+    started = time.perf_counter()
+    for i, record in enumerate(batch):
+        queue.put(record)
+        if i % 100 == 0:
+            await asyncio.sleep(0)
+    writer.cancel()
+    await asyncio.gather(writer, return_exceptions=True)
+    await queue.close()
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    print(
+        f"{'records':>10} {'per-key s':>10} {'pipelined s':>12} {'save/s':>10} {'batched/s':>10}"
+    )
+    for count in counts:
+        clear()
+        seed(count)
+        # The per-key restore is timed on a sample and extrapolated.
+        sample, elapsed = restore_per_key(min(count, 20_000))
+        per_key = elapsed * count / sample
+        loaded, pipelined = restore_pipelined()
+        assert loaded == count
+        per_record = ingest_per_record(min(count, 20_000))
+        batched = asyncio.run(ingest_write_behind(min(count, 100_000)))
+        print(
+            f"{count:>10} {per_key:>10.1f} {pipelined:>12.1f} {per_record:>10.0f} {batched:>10.0f}"
+        )
+    clear()
+
+
+if __name__ == "__main__":
+    main()
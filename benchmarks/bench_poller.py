@@ -0,0 +1,40 @@
+import time
+import asyncio
+import logging
+
+from src.poller import DevicePoller
+from tests.lass_stub import LASSStubProcess
+
+DEVICES = 200
+SWEEPS = 3
+
+
+async def measure(stub: LASSStubProcess, pool_size: int) -> float:
+    poller = DevicePoller(
+        [f"DEV{i:06d}" for i in range(DEVICES)],
+        base_url=stub.url,
+        max_connections=pool_size,
+        concurrency=pool_size,
+    )
+    try:
+        await poller.poll_all()
+        started = time.perf_counter()
+        for _ in range(SWEEPS):
+            await poller.poll_all()
+        elapsed = time.perf_counter() - started
+    finally:
+        await poller.aclose()
+    return DEVICES * SWEEPS / elapsed
+
+
+async def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    with LASSStubProcess(latency=0.05) as stub:
+        print(f"{'pool':>6} {'devices/s':>12}")
+        for pool_size in (1, 5, 10, 25, 50, 100):
+            rate = await measure(stub, pool_size)
+            print(f"{pool_size:>6} {rate:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+import sys
+import time
+import asyncio
+import logging
+
+import src.data
+from src.danger import DANGER_THRESHOLDS
+from src.days import Days, current_days, use_days
+from src.poller import DevicePoller
+from src.recompute import derive, derive_rows
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+
+
+def timing(count: int):
+    # A recompute of count readings against ingesting them again.
+    payload = PayloadGenerator(DEVICE, projects=2, danger_ratio=0.1).history(count)
+    poller = DevicePoller([DEVICE])
+    started = time.perf_counter()
+    poller.process_init_response(DEVICE, payload)
+    ingest = time.perf_counter() - started
+    del payload
+    history = poller.histories[DEVICE]
+
+    thresholds = {"local": 25.0, "who": 10.0}
+    days = Days("Asia/Taipei")
+    started = time.perf_counter()
+    derive(history, thresholds, days)
+    numpy_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    derive_rows(history, thresholds, days)
+    python_seconds = time.perf_counter() - started
+
+    async def swap() -> float:
+        started = time.perf_counter()
+        await poller.recompute(thresholds, days)
+        elapsed = time.perf_counter() - started
+        await poller.drain()
+        return elapsed
+
+    swapped = asyncio.run(swap())
+    print(
+        f"{history.num_of_records:>9} readings: re-ingest {ingest:.2f} s,"
+        f" numpy {numpy_seconds:.3f} s ({ingest / numpy_seconds:.0f}x),"
+        f" python {python_seconds:.2f} s, swapped in {swapped:.3f} s"
+    )
+
+
+def restore(thresholds: dict, days: Days):
+    DANGER_THRESHOLDS.clear()
+    DANGER_THRESHOLDS.update(thresholds)
+    use_days(days)
+
+
+def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    counts = [int(arg) for arg in sys.argv[1:]] or [1_000_000]
+    previous = dict(DANGER_THRESHOLDS), current_days()
+    try:
+        for count in counts:
+            timing(count)
+    finally:
+        restore(*previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import os
+import gc
+import sys
+import time
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import src.data
+import src.retention
+from src.app import PM_Analyzer
+from tests.helpers import DEVICE, add
+from benchmarks.bench_export import rss
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+# RSS growth is reported after the first month, while only per day aggregates
+# grow.
+WARMUP_DAYS = 30
+
+
+def main():
+    src.data.STORAGE = None
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 180
+    interval = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    window = sys.argv[3] if len(sys.argv) > 3 else "7d"
+    directory = tempfile.mkdtemp(prefix="segments-")
+    src.retention.RETENTION_DIR = directory
+    src.retention.RETENTION_WINDOW = window
+    src.retention.retention_window.cache_clear()
+
+    try:
+        service = PM_Analyzer([DEVICE])
+        history = service.poller.history(DEVICE)
+        per_day = 86400 // interval
+        print(f"{days} days of {per_day} readings, window {window or 'unbounded'}")
+        print(f"{'day':>5} {'records':>10} {'hot':>9} {'segments':>8} {'RSS MiB':>8}")
+        started = time.perf_counter()
+        samples = {}
+        i = 0
+        for day in range(1, days + 1):
+            for _ in range(per_day):
+                add(history, START + timedelta(seconds=i * interval), i)
+                i += 1
+            if day % 30 == 0 or day == WARMUP_DAYS:
+                gc.collect()
+                samples[day] = rss()
+                store = history.feeds["AirBox"]
+                print(
+                    f"{day:>5} {history.num_of_records:>10}"
+                    f" {len(store) - store._spilled_length:>9} {len(store.segments):>8}"
+                    f" {samples[day] / 2**20:>8.1f}"
+                )
+        elapsed = time.perf_counter() - started
+
+        disk = sum(segment[2] for segment in store.segments)
+        size = sum(os.path.getsize(segment[3]) for segment in store.segments)
+        growth = (samples[max(samples)] - samples[WARMUP_DAYS]) / 2**20
+        print(
+            f"ingest {i / elapsed:.0f}/s, {disk} readings spilled to {size / 2**20:.1f} MiB"
+            f" ({size / max(disk, 1):.1f} bytes/reading), RSS growth after day"
+            f" {WARMUP_DAYS}: {growth:.1f} MiB"
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
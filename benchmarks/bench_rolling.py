@@ -0,0 +1,82 @@
+import sys
+import time
+import random
+import logging
+from datetime import datetime, timedelta, timezone
+
+import src.data
+from src.data import DeviceHistory, DeviceRecord
+from src.rolling import ROLLING_WINDOWS, RollingEngine
+
+DEVICE = "08BEAC0AB2DE"
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def empty() -> DeviceHistory:
+    return DeviceHistory(
+        source=None,
+        device_id=DEVICE,
+        version=None,
+        num_of_records=0,
+        feeds={},
+        danger={},
+        daily_metrics={},
+    )
+
+
+def record(project: str, timestamp: datetime, value: float) -> DeviceRecord:
+    return DeviceRecord.model_construct(
+        app=project,
+        device_id=DEVICE,
+        s_t0=25.0,
+        s_h0=60.0,
+        s_d0=value,
+        gps_lat=25.04,
+        gps_lon=121.54,
+        timestamp=timestamp,
+    )
+
+
+def cost(count: int):
+    # Microseconds per reading, which must not grow with the window, against
+    # recomputing the windows from the feed on every reading.
+    print(f"{'windows':>12} {'us/reading':>11}")
+    rng = random.Random(3)
+    values = [rng.uniform(1, 120) for _ in range(count)]
+    for windows in ({"1h": 3600}, {"24h": 86400}, {"7d": 604800}, ROLLING_WINDOWS):
+        engine = RollingEngine(windows)
+        started = time.perf_counter()
+        for i, value in enumerate(values):
+            engine.add(i * 60, value)
+        elapsed = (time.perf_counter() - started) / count * 1e6
+        print(f"{','.join(windows):>12} {elapsed:>11.2f}")
+
+    history = empty()
+    for i in range(min(count, 5_000)):
+        timestamp = START + timedelta(minutes=i)
+        history.add_record(
+            "AirBox",
+            timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            record("AirBox", timestamp, values[i]),
+        )
+    records = history.feeds["AirBox"]
+    last = records.last()
+    started = time.perf_counter()
+    repeats = 50
+    for _ in range(repeats):
+        for seconds in ROLLING_WINDOWS.values():
+            values = [row[3] for row in records.range(last - seconds + 1, None)]
+            sum(values), min(values), max(values)
+    elapsed = (time.perf_counter() - started) / repeats * 1e6
+    print(f"{'rescan':>12} {elapsed:>11.2f}")
+
+
+def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000
+    cost(count * 20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import sys
+import time
+import logging
+from statistics import median
+from datetime import datetime, timedelta, timezone
+from fastapi.testclient import TestClient
+
+import src.data
+from src.app import PM_Analyzer
+from src.store import to_epoch
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+WINDOW = timedelta(weeks=4)
+REPEATS = 5
+
+
+def scan_hourly(store, start: int, end: int) -> dict[int, tuple]:
+    # What an hourly chart costs without rollups: a pass over the raw rows.
+    buckets = {}
+    for row in store.range(start, end):
+        bucket = buckets.setdefault(row[0] - row[0] % 3600, [0, 0.0, row[3], row[3]])
+        bucket[0] += 1
+        bucket[1] += row[3]
+        bucket[2] = min(bucket[2], row[3])
+        bucket[3] = max(bucket[3], row[3])
+    return buckets
+
+
+def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    counts = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    print(
+        f"{'records':>10} {'ingest/s':>10} {'scan ms':>8} {'tier ms':>8} {'GET ms':>8}"
+        f" {'raw KiB':>8} {'rollup KiB':>10} {'resolution':>10}"
+    )
+    for count in counts:
+        service = PM_Analyzer([DEVICE])
+        history = service.poller.history(DEVICE)
+        started = time.perf_counter()
+        for i in range(count):
+            add(history, START + timedelta(minutes=i), i)
+        ingest = count / (time.perf_counter() - started)
+        service.poller.publish(DEVICE)
+
+        store = history.feeds["AirBox"]
+        end = START + timedelta(hours=count // 60)
+        start = end - WINDOW
+        started = time.perf_counter()
+        scan_hourly(store, int(start.timestamp()), int(end.timestamp()))
+        scan = (time.perf_counter() - started) * 1000
+
+        client = TestClient(service.app)
+        window = {"start": start.isoformat(), "end": end.isoformat()}
+        client.get("/data/rollup", params={"resolution": "day"})
+        timings = []
+        for _ in range(REPEATS):
+            started = time.perf_counter()
+            rollup = client.get("/data/rollup", params=window)
+            timings.append((time.perf_counter() - started) * 1000)
+        elapsed = median(timings)
+        started = time.perf_counter()
+        sum(1 for _ in store.rollups["hour"].range(*map(to_epoch, (start, end))))
+        tier = (time.perf_counter() - started) * 1000
+        body = rollup.json()
+
+        raw = 0
+        cursor = None
+        while True:
+            params = {**window, "limit": 10000}
+            if cursor:
+                params["cursor"] = cursor
+            page = client.get("/data/feeds", params=params)
+            raw += len(page.content)
+            cursor = page.json()["next_cursor"]
+            if not cursor:
+                break
+        print(
+            f"{count:>10} {ingest:>10.0f} {scan:>8.1f} {tier:>8.1f} {elapsed:>8.1f}"
+            f" {raw / 1024:>8.0f} {len(rollup.content) / 1024:>10.0f} {body['resolution']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
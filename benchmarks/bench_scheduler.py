@@ -0,0 +1,67 @@
+import sys
+import asyncio
+import logging
+
+import src.data
+from src.poller import DevicePoller
+from tests.lass_stub import LASSStubProcess
+
+DEVICES = 20
+REPORTING_INTERVAL = 10.0
+
+
+def poller(stub: LASSStubProcess) -> DevicePoller:
+    device_ids = [f"DEV{i:06d}" for i in range(DEVICES)] + ["FAIL000000"]
+    poller = DevicePoller(device_ids, base_url=stub.url)
+    for device_id in device_ids:
+        poller.history(device_id)
+        poller.schedules[device_id].lead = 1.0
+    return poller
+
+
+async def fixed(poller: DevicePoller, duration: float):
+    # The previous behaviour: every device is polled every POLL_INTERVAL.
+    async def loop():
+        while True:
+            await poller.poll_all()
+            await asyncio.sleep(poller.interval)
+
+    try:
+        await asyncio.wait_for(loop(), duration)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def adaptive(poller: DevicePoller, duration: float):
+    try:
+        await asyncio.wait_for(poller.run(), duration)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def main():
+    logging.getLogger("uvicorn").setLevel(logging.CRITICAL)
+    src.data.STORAGE = None
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 60.0
+    print(
+        f"{'scheduler':>10} {'requests':>9} {'useful':>7} {'wasted':>7} {'failed':>7} {'readings':>9}"
+    )
+    with LASSStubProcess(latency=0.01, interval=REPORTING_INTERVAL) as stub:
+        for name, run in (("fixed", fixed), ("adaptive", adaptive)):
+            instance = poller(stub)
+            try:
+                await run(instance, duration)
+            finally:
+                await instance.aclose()
+            status = instance.status.values()
+            print(
+                f"{name:>10} {sum(s.polls + s.failures for s in status):>9}"
+                f" {sum(s.useful_polls for s in status):>7}"
+                f" {sum(s.wasted_polls for s in status):>7}"
+                f" {sum(s.failures for s in status):>7}"
+                f" {sum(s.num_of_records for s in status):>9}"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+# The service reads where snapshots go on import.
+DIRECTORY = tempfile.mkdtemp(prefix="snapshots-")
+os.environ["SNAPSHOT_DIR"] = DIRECTORY
+
+import src.data
+from src.app import PM_Analyzer
+from src.snapshot import load_snapshot, save_snapshot, snapshot_path
+from tests.helpers import DEVICE, add
+from tests.lass_stub import LASSStubProcess
+
+START = datetime(2024, 6, 1, tzinfo=timezone.utc)
+HISTORY_SIZE = 1440
+# Readings the snapshot is behind the history served by the stub.
+BEHIND = 60
+
+
+async def boot(url: str) -> tuple[float, float, PM_Analyzer]:
+    # Milliseconds until the first response and until /ready reports ready.
+    service = PM_Analyzer([DEVICE])
+    service.poller.base_url = url
+    started = time.perf_counter()
+    async with service.lifespan(service.app):
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://app"
+        ) as client:
+            response = await client.get("/")
+            first = (time.perf_counter() - started) * 1000
+            assert response.status_code == 200
+            while (await client.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.005)
+            ready = (time.perf_counter() - started) * 1000
+    return first, ready, service
+
+
+async def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    counts = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    directory = DIRECTORY
+    print(
+        f"{'records':>10} {'write ms':>9} {'MiB':>6} {'load ms':>8}"
+        f" {'cold first':>10} {'cold ready':>10} {'warm first':>10} {'warm ready':>10}"
+    )
+    try:
+        with LASSStubProcess(latency=0.01, history_size=HISTORY_SIZE) as stub:
+            for count in counts:
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                cold_first, cold_ready, _ = await boot(stub.url)
+
+                service = PM_Analyzer([DEVICE])
+                history = service.poller.history(DEVICE)
+                first = START - timedelta(minutes=count + BEHIND)
+                for i in range(count):
+                    add(history, first + timedelta(minutes=i), i)
+                started = time.perf_counter()
+                path = save_snapshot(history, directory)
+                write = (time.perf_counter() - started) * 1000
+                started = time.perf_counter()
+                load_snapshot(path)
+                load = (time.perf_counter() - started) * 1000
+
+                warm_first, warm_ready, warm = await boot(stub.url)
+                restored = warm.poller.histories[DEVICE]
+                assert restored.num_of_records >= count + BEHIND
+                assert len(restored.feeds["AirBox"]) == restored.num_of_records
+                assert (
+                    sum(metrics.count for metrics in restored.daily_metrics.values())
+                    == restored.num_of_records
+                )
+                # Catch-up may extend the last episode but keeps the others.
+                before = history.danger["local"]
+                after = restored.danger["local"]
+                assert list(after.starts)[: len(before) - 1] == list(before.starts)[:-1]
+                assert list(after.counts)[: len(before) - 1] == list(before.counts)[:-1]
+                print(
+                    f"{count:>10} {write:>9.0f}"
+                    f" {os.path.getsize(snapshot_path(DEVICE, directory)) / 2**20:>6.1f}"
+                    f" {load:>8.0f} {cold_first:>10.0f} {cold_ready:>10.0f}"
+                    f" {warm_first:>10.0f} {warm_ready:>10.0f}"
+                )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
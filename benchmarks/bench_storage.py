@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import tempfile
+from datetime import timedelta
+
+import src.data
+from src.data import DeviceHistory, DeviceRecord
+from src.persistence import (
+    REDIS_WRITE_BATCH_SIZE,
+    RedisBackend,
+    SQLiteBackend,
+    StorageError,
+)
+from benchmarks.bench_persistence import START, clear, records
+
+DEVICE = "08BEAC0AB2DE"
+
+
+def ingest(backend, count: int) -> float:
+    batch = list(records(count))
+    started = time.perf_counter()
+    for lo in range(0, count, REDIS_WRITE_BATCH_SIZE):
+        backend.append(batch[lo : lo + REDIS_WRITE_BATCH_SIZE])
+    return count / (time.perf_counter() - started)
+
+
+def restore(backend, count: int) -> float:
+    src.data.STORAGE = backend
+    started = time.perf_counter()
+    history = DeviceHistory(
+        **{
+            "source": None,
+            "device_id": DEVICE,
+            "version": None,
+            "num_of_records": 0,
+            "feeds": {},
+            "danger": {},
+            "daily_metrics": {},
+        }
+    )
+    elapsed = time.perf_counter() - started
+    assert history.num_of_records == count
+    return count / elapsed
+
+
+def range_read(backend, count: int) -> float:
+    # One day from the middle of the history.
+    start = START + timedelta(minutes=5 * (count // 2))
+    started = time.perf_counter()
+    day = list(backend.range(DEVICE, "AirBox", start, start + timedelta(days=1)))
+    elapsed = time.perf_counter() - started
+    assert len(day) == 288
+    assert day == sorted(day, key=lambda record: record.timestamp)
+    return elapsed * 1000
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [100_000, 1_000_000]
+    directory = tempfile.mkdtemp(prefix="storage-")
+    print(
+        f"{'backend':>8} {'records':>10} {'ingest/s':>10} {'restore/s':>10} {'day ms':>8}"
+    )
+    for name in ("redis", "sqlite"):
+        for count in counts:
+            if name == "redis":
+                backend = RedisBackend(DeviceRecord)
+                try:
+                    clear()
+                except Exception as e:
+                    print(f"{name:>8} skipped, {e}")
+                    break
+            else:
+                path = os.path.join(directory, f"{count}.db")
+                backend = SQLiteBackend(DeviceRecord, path)
+            try:
+                rate = ingest(backend, count)
+            except StorageError as e:
+                print(f"{name:>8} skipped, {e}")
+                break
+            restored = restore(backend, count)
+            day = range_read(backend, count)
+            print(f"{name:>8} {count:>10} {rate:>10.0f} {restored:>10.0f} {day:>8.1f}")
+            if name == "redis":
+                clear()
+            else:
+                backend.close()
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
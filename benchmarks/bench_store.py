@@ -0,0 +1,76 @@
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from src.data import DeviceRecord
+from src.store import FeedStore
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def records(count: int):
+    for i in range(count):
+        timestamp = START + timedelta(minutes=5 * i)
+        yield timestamp, DeviceRecord(
+            app="AirBox",
+            device_id="08BEAC0AB2DE",
+            s_t0=25.0 + i % 10,
+            s_h0=60.0 + i % 7,
+            s_d0=float(i % 80),
+            gps_lat=25.04,
+            gps_lon=121.54,
+            timestamp=timestamp,
+        )
+
+
+def build_dict(count: int):
+    return {timestamp: record for timestamp, record in records(count)}
+
+
+def build_store(count: int):
+    store = FeedStore("AirBox")
+    for timestamp, record in records(count):
+        store.add(timestamp, record)
+    store.flush()
+    return store
+
+
+def measure_memory(build, count: int) -> float:
+    tracemalloc.start()
+    feed = build(count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del feed
+    return current / 2**20
+
+
+def scan_dict(feed: dict) -> float:
+    return sum(record.s_d0 for record in feed.values() if record.s_d0 > 30)
+
+
+def scan_store(feed: FeedStore) -> float:
+    return sum(value for value in feed.column("s_d0") if value > 30)
+
+
+def measure_scan(scan, feed) -> float:
+    started = time.perf_counter()
+    scan(feed)
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    print(f"{'records':>10} {'layout':>8} {'MiB':>10} {'scan ms':>10}")
+    for count in counts:
+        for name, build, scan in (
+            ("dict", build_dict, scan_dict),
+            ("columnar", build_store, scan_store),
+        ):
+            memory = measure_memory(build, count)
+            scan_ms = measure_scan(scan, build(count))
+            print(f"{count:>10} {name:>8} {memory:>10.1f} {scan_ms:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import sys
+import time
+import logging
+from statistics import median
+
+from fastapi.testclient import TestClient
+
+import src.data
+import src.telemetry
+from src.app import PM_Analyzer
+from src.telemetry import Counter, Histogram
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+REQUESTS = 4000
+CALLS = 100_000
+
+
+def per_call(call) -> float:
+    started = time.perf_counter()
+    for _ in range(CALLS):
+        call()
+    return (time.perf_counter() - started) / CALLS * 1e9
+
+
+def alternate(call, count: int) -> dict[bool, list[float]]:
+    # Calls alternate between enabled and disabled instrumentation, so drift
+    # and garbage collection affect both sides alike.
+    samples = {True: [], False: []}
+    for i in range(count):
+        enabled = i % 2 == 0
+        src.telemetry.METRICS_ENABLED = enabled
+        started = time.perf_counter()
+        call(i)
+        samples[enabled].append(time.perf_counter() - started)
+    src.telemetry.METRICS_ENABLED = True
+    return samples
+
+
+def main():
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    updates = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    counter = Counter("bench_total", "", ["result"])
+    histogram = Histogram("bench_seconds", "", ["stage"])
+    print(f"Counter.inc: {per_call(lambda: counter.inc('added')):.0f} ns")
+    print(
+        f"Histogram.observe: {per_call(lambda: histogram.observe(0.003, 'x')):.0f} ns"
+    )
+
+    def timer():
+        with histogram.time("x"):
+            pass
+
+    print(f"Histogram.time: {per_call(timer):.0f} ns")
+
+    service = PM_Analyzer([DEVICE])
+    generator = PayloadGenerator(DEVICE, projects=2)
+    service.poller.process_init_response(DEVICE, generator.history(1440))
+    payloads = [generator.latest(i) for i in range(1, updates + 1)]
+    client = TestClient(service.app)
+
+    print(f"{'median':>24} {'enabled':>10} {'disabled':>10} {'overhead':>9}")
+    samples = alternate(
+        lambda i: service.poller.process_response(DEVICE, payloads[i]), updates
+    )
+    on, off = (median(samples[enabled]) * 1e6 for enabled in (True, False))
+    print(f"{'process_response us':>24} {on:>10.1f} {off:>10.1f} {on / off - 1:>9.1%}")
+    for path in ("/devices", "/"):
+        samples = alternate(lambda i: client.get(path).raise_for_status(), REQUESTS)
+        on, off = (median(samples[enabled]) * 1000 for enabled in (True, False))
+        print(
+            f"{'GET ' + path + ' ms':>24} {on:>10.3f} {off:>10.3f} {on / off - 1:>9.1%}"
+        )
+    print(f"/metrics: {len(client.get('/metrics').content)} bytes")
+
+
+if __name__ == "__main__":
+    main()
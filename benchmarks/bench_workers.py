@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import subprocess
+import multiprocessing
+
+import httpx
+
+from tests.lass_stub import LASSStubProcess
+
+DEVICES = ["08BEAC0AB2DE", "74DA38F7C4E2"]
+HISTORY_SIZE = 10_080
+SHARED_INTERVAL = 0.5
+DURATION = 5.0
+CLIENTS = 8
+PATH = "/devices/08BEAC0AB2DE/data/metrics/"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def client(url: str, duration: float, count):
+    # One keep-alive connection per client, so requests stay with a worker
+    # the way a browser's do.
+    done = 0
+    with httpx.Client(base_url=url) as session:
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            session.get(PATH).raise_for_status()
+            done += 1
+    with count.get_lock():
+        count.value += done
+
+
+class Service:
+    def __init__(self, stub: LASSStubProcess, workers: int, coordination: str):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.directory = tempfile.mkdtemp(prefix="shared-")
+        self.env = {
+            **os.environ,
+            "LASS_API_URL": stub.url,
+            "DEVICE_IDS": ",".join(DEVICES),
+            "PORT": str(self.port),
+            "WORKERS": str(workers),
+            "COORDINATION": coordination,
+            "SNAPSHOT_DIR": self.directory,
+            "SHARED_INTERVAL": str(SHARED_INTERVAL),
+            "POLL_INTERVAL": "1",
+            "STORAGE_BACKEND": "none",
+        }
+        self.workers = workers
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "src.app"],
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        # Ready once fresh connections, spread over the workers, all say so.
+        deadline = time.monotonic() + 120
+        ready = 0
+        while ready < 4 * self.workers:
+            assert time.monotonic() < deadline, "workers did not become ready"
+            try:
+                ready = ready + 1 if httpx.get(self.url + "/ready").is_success else 0
+            except httpx.TransportError:
+                ready = 0
+            if not ready:
+                time.sleep(0.1)
+        return self
+
+    def __exit__(self, *exc):
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def leader(self) -> int:
+        with open(os.path.join(self.directory, "poller.lease")) as lease:
+            return int(lease.read())
+
+
+def throughput(service: Service) -> float:
+    count = multiprocessing.Value("i", 0)
+    clients = [
+        multiprocessing.Process(target=client, args=(service.url, DURATION, count))
+        for _ in range(CLIENTS)
+    ]
+    started = time.perf_counter()
+    for process in clients:
+        process.start()
+    for process in clients:
+        process.join()
+    elapsed = time.perf_counter() - started
+    return count.value / elapsed
+
+
+def failover(service: Service, stub: LASSStubProcess) -> float:
+    # Seconds from killing the leader until another worker polls again.
+    leader = service.leader()
+    os.kill(leader, signal.SIGKILL)
+    started = time.perf_counter()
+    while True:
+        try:
+            if service.leader() != leader:
+                break
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.01)
+    upstream = stub.requests.value
+    while stub.requests.value == upstream:
+        time.sleep(0.01)
+    return time.perf_counter() - started
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, 2, 4]
+    print(f"{os.cpu_count()} CPUs, {CLIENTS} clients for {DURATION:.0f} s on {PATH}")
+    # Upstream counts the requests made to the LASS API while the service
+    # started and served, every polling worker fetches the histories.
+    print(f"{'workers':>8} {'coordination':>12} {'requests/s':>11} {'upstream':>9}")
+    with LASSStubProcess(latency=0.01, interval=1, history_size=HISTORY_SIZE) as stub:
+        runs = [(count, "lease") for count in counts] + [(max(counts), "none")]
+        for workers, coordination in runs:
+            upstream = stub.requests.value
+            with Service(stub, workers, coordination) as service:
+                rate = throughput(service)
+                upstream = stub.requests.value - upstream
+                print(f"{workers:>8} {coordination:>12} {rate:>11.0f} {upstream:>9}")
+        with Service(stub, max(counts), "lease") as service:
+            print(f"failover after killing the leader: {failover(service, stub):.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+from statistics import median, quantiles
+from concurrent.futures import ProcessPoolExecutor
+
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+# Calls timed per measurement: at least MIN_REPEATS and up to MAX_REPEATS or
+# until BUDGET seconds have passed.
+MIN_REPEATS = 3
+MAX_REPEATS = 200
+BUDGET = 1.0
+UPDATES = 1000
+# Paths are formatted with the device and the last day of the history.
+ENDPOINTS = [
+    "/",
+    "/data",
+    "/ready",
+    "/devices",
+    "/data/feeds",
+    "/data/feeds?start={day}&end={end}",
+    "/data/export",
+    "/data/export?format=csv",
+    "/data/rollup",
+    "/data/rollup?resolution=minute&start={day}&end={end}",
+    "/data/danger",
+    "/data/danger/counts",
+    "/data/danger/counts?resolution=hour",
+    "/data/metrics/",
+    "/data/metrics/summary",
+    "/data/metrics/summary?period=month",
+    "/devices/{device}/",
+    "/devices/{device}/data/feeds",
+]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2**20 if sys.platform == "darwin" else 2**10)
+
+
+def timed(call) -> list[float]:
+    samples = []
+    started = time.perf_counter()
+    while len(samples) < MIN_REPEATS or (
+        len(samples) < MAX_REPEATS and time.perf_counter() - started < BUDGET
+    ):
+        begin = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - begin)
+    return samples
+
+
+def latency(name: str, samples: list[float]) -> dict:
+    milliseconds = sorted(sample * 1000 for sample in samples)
+    p99 = quantiles(milliseconds, n=100)[98] if len(samples) > 1 else milliseconds[0]
+    return {f"{name}.median_ms": median(milliseconds), f"{name}.p99_ms": p99}
+
+
+def run(size: int, projects: int, danger_ratio: float, seed: int) -> dict:
+    # One size in a fresh process, so the peak memory belongs to it alone.
+    import src.data
+    from fastapi.testclient import TestClient
+    from src.app import PM_Analyzer
+    from src.data import DeviceRecord
+    from src.html import generate_html
+
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    src.data.STORAGE = None
+    results = {}
+    service = PM_Analyzer([DEVICE])
+    poller = service.poller
+    generator = PayloadGenerator(DEVICE, projects, danger_ratio, seed=seed)
+
+    body = json.dumps(generator.history(size))
+    started = time.perf_counter()
+    poller.process_init_response(DEVICE, json.loads(body))
+    elapsed = time.perf_counter() - started
+    history = poller.histories[DEVICE]
+    assert history.num_of_records >= size
+    del body
+    results["process_init_response.records_per_second"] = (
+        history.num_of_records / elapsed
+    )
+    results["process_init_response.ms"] = elapsed * 1000
+    results["ingest.peak_rss_mb"] = peak_rss_mb()
+
+    payloads = [generator.latest(i) for i in range(1, UPDATES + 1)]
+    samples = []
+    for payload in payloads:
+        started = time.perf_counter()
+        poller.process_response(DEVICE, payload)
+        samples.append(time.perf_counter() - started)
+    results.update(latency("process_response", samples))
+    results["process_response.records_per_second"] = (
+        UPDATES * len(generator.projects) / sum(samples)
+    )
+
+    readings = [
+        generator.reading(project, i)
+        for i in range(UPDATES + 1, 2 * UPDATES + 1)
+        for project in generator.projects
+    ]
+    records = [DeviceRecord(**reading) for reading in readings]
+    samples = []
+    for reading, record in zip(readings, records):
+        started = time.perf_counter()
+        history.add_record(reading["app"], reading["timestamp"], record)
+        samples.append(time.perf_counter() - started)
+    results.update(latency("add_record", samples))
+    results["add_record.records_per_second"] = len(records) / sum(samples)
+    results.update(latency("publish", timed(lambda: poller.publish(DEVICE))))
+    view = poller.view(DEVICE)
+
+    # A new dashboard renders everything, a cached one only checks its key.
+    results.update(latency("generate_html.cold", timed(lambda: generate_html(view))))
+    service.dashboard(view).render()
+    results.update(
+        latency(
+            "generate_html.cached",
+            timed(lambda: service.dashboard(view).render()),
+        )
+    )
+
+    client = TestClient(service.app)
+    values = {
+        "device": DEVICE,
+        "day": generator.timestamp(-86400 // generator.interval),
+        "end": generator.timestamp(0),
+    }
+    for endpoint in ENDPOINTS:
+        path = endpoint.format(**values)
+        sizes = []
+
+        def get():
+            response = client.get(path)
+            assert response.status_code in (200, 503), (path, response.status_code)
+            sizes.append(len(response.content))
+
+        results.update(latency(f"GET {endpoint}", timed(get)))
+        results[f"GET {endpoint}.bytes"] = sizes[-1]
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def regressions(baseline: dict, current: dict, tolerance: float) -> list[str]:
+    # Rates regress when they drop, times, memory and sizes when they grow.
+    # Tail latencies are too noisy to compare between runs.
+    found = []
+    for size, metrics in current["results"].items():
+        for name, value in metrics.items():
+            before = baseline["results"].get(size, {}).get(name)
+            if not before or name.endswith(".p99_ms"):
+                continue
+            change = value / before - 1
+            if name.endswith("_per_second"):
+                change = -change
+            if change > tolerance:
+                found.append(f"{size:>8} {name}: {before:.4g} -> {value:.4g}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int, default=SIZES)
+    parser.add_argument("--projects", type=int, default=1)
+    parser.add_argument("--danger-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Earlier results to check against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "projects": args.projects,
+            "danger_ratio": args.danger_ratio,
+            "seed": args.seed,
+        },
+        "results": {},
+    }
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results = executor.submit(
+                run, size, args.projects, args.danger_ratio, args.seed
+            ).result()
+        report["results"][str(size)] = results
+        print(
+            f"{size:>8} records:"
+            f" init {results['process_init_response.records_per_second']:.0f}/s,"
+            f" update {results['process_response.median_ms']:.3f} ms,"
+            f" add_record {results['add_record.median_ms'] * 1000:.1f} us,"
+            f" html {results['generate_html.cold.median_ms']:.1f} ms,"
+            f" peak {results['peak_rss_mb']:.0f} MiB"
+        )
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as previous:
+            baseline = json.load(previous)
+        found = regressions(baseline, report, args.tolerance)
+        for line in found:
+            print(line)
+        print(
+            f"{len(found)} regressions beyond {args.tolerance:.0%}"
+            f" against {baseline.get('commit') or args.compare}"
+        )
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
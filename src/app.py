@@ -1,143 +1,757 @@
 import os
-import httpx
+import hmac
+import math
+import time
 import asyncio
 import logging
 import datetime
-from typing import Optional
-from pydantic import ValidationError
+from typing import Callable, Optional, Union
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Header, Query, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import TypeAdapter
 
-from src.html import HTMLResponse, generate_html
-from src.data import DeviceHistory, DeviceRecord, DailyMetrics
+from src.html import HTMLResponse, Dashboard, today_start
+from src.export import EXPORT_FORMATS, export_rows
+from src.data import (
+    DeviceHistory,
+    DailyMetrics,
+    FeedPage,
+    FeedReading,
+    RollupBucket,
+    RollupSeries,
+    RollupValue,
+)
+from src.poller import DevicePoller, DeviceStatus, Readiness
+from src.geo import GEO_MAX_RESULTS, GEO_NEAREST, NearbyDevice, nearby
+from src.cluster import COORDINATION, WORKERS, Coordinator
+from src.backfill import Backfill
+from src.days import Days, current_days
+from src.recompute import RecomputeResult, vectorized
+from src.cache import (
+    GZIP_MIN_SIZE,
+    ResponseCache,
+    accepts_gzip,
+    etag,
+    not_modified,
+)
+from src.store import COLUMNS, from_epoch, to_epoch, to_value
+from src.rolling import RollingValue
+from src.rollup import ROLLUP_COLUMNS, ROLLUP_MAX_POINTS, select_resolution
+from src.telemetry import CONTENT_TYPE, MetricsMiddleware, render
+from src.danger import DANGER_RESOLUTIONS, DANGER_THRESHOLDS, DangerIndex, DangerPage
 
 DEVICE_ID = str(os.getenv("DEVICE_ID", default="08BEAC0AB2DE"))
+PORT = int(os.getenv("PORT", default=8000))
+FEED_PAGE_SIZE = int(os.getenv("FEED_PAGE_SIZE", default=1000))
+FEED_PAGE_MAX_SIZE = int(os.getenv("FEED_PAGE_MAX_SIZE", default=10000))
+DANGER_THRESHOLD = next(iter(DANGER_THRESHOLDS))
+DEVICE_IDS = [
+    device_id.strip()
+    for device_id in str(os.getenv("DEVICE_IDS", default=DEVICE_ID)).split(",")
+    if device_id.strip()
+]
+METRICS = TypeAdapter(dict[datetime.date, DailyMetrics])
+# Bearer token of the admin endpoints, which are off without one.
+ADMIN_TOKEN = str(os.getenv("ADMIN_TOKEN", default=""))
+JSON = "application/json"
+HTML = "text/html; charset=utf-8"
 
 
 class PM_Analyzer:
-    def __init__(self):
+    def __init__(self, device_ids: Optional[list[str]] = None):
         self.app = FastAPI(lifespan=self.lifespan)
-        self.data_store: DeviceHistory = {}
+        self.app.add_middleware(MetricsMiddleware)
+        self.device_ids = device_ids or DEVICE_IDS
+        self.poller = DevicePoller(self.device_ids)
+        self.coordinator = Coordinator(self.poller) if COORDINATION == "lease" else None
+        self.backfill = Backfill(self.poller)
+        self.dashboards: dict[str, Dashboard] = {}
+        self.responses = ResponseCache()
+        self.recomputing = asyncio.Lock()
         self.log = logging.getLogger("uvicorn")
 
-        @self.app.get("/")
-        async def read_root() -> HTMLResponse:
-            return generate_html(self.data_store)
+        @self.app.get("/", response_class=HTMLResponse)
+        async def read_root(request: Request):
+            return await self.render_dashboard(request, self.data_store)
 
         @self.app.get("/data", response_model=DeviceHistory)
-        async def get_data():
-            return self.data_store
+        async def get_data(request: Request):
+            history = self.data_store
+            return await self.cached(request, history, history.model_dump_json)
 
-        @self.app.get("/data/danger", response_model=list[datetime.datetime])
-        async def get_danger_thresholds():
-            return self.data_store.danger_threshold_instances
+        @self.app.get("/ready", response_model=Readiness)
+        async def get_ready():
+            readiness = self.poller.readiness()
+            return JSONResponse(
+                readiness.model_dump(), status_code=200 if readiness.ready else 503
+            )
+
+        @self.app.get("/metrics", response_class=PlainTextResponse)
+        async def get_metrics_exposition():
+            return PlainTextResponse(render(), media_type=CONTENT_TYPE)
+
+        @self.app.get("/live")
+        async def live() -> StreamingResponse:
+            return self.live(self.data_store)
+
+        @self.app.get("/data/feeds", response_model=FeedPage)
+        async def get_feeds(
+            project: str = Query("AirBox"),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+            limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_PAGE_MAX_SIZE),
+            cursor: Optional[str] = Query(None),
+        ):
+            return self.get_feeds(self.data_store, project, start, end, limit, cursor)
+
+        @self.app.get("/data/export")
+        async def export_data(
+            format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+            project: Optional[str] = Query(None),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+            columns: Optional[str] = Query(None),
+        ) -> StreamingResponse:
+            return self.export(self.data_store, format, project, start, end, columns)
+
+        @self.app.get("/data/rollup", response_model=RollupSeries)
+        async def get_rollup(
+            project: str = Query("AirBox"),
+            resolution: str = Query("auto", pattern="^(auto|minute|hour|day)$"),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+        ):
+            return self.get_rollup(self.data_store, project, resolution, start, end)
+
+        @self.app.get("/data/rolling", response_model=dict[str, RollingValue])
+        async def get_rolling(window: Optional[str] = Query(None)):
+            return self.get_rolling(self.data_store, window)
+
+        @self.app.get("/data/danger", response_model=DangerPage)
+        async def get_danger_thresholds(
+            request: Request,
+            threshold: str = Query(DANGER_THRESHOLD),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+            limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_PAGE_MAX_SIZE),
+            cursor: Optional[str] = Query(None),
+        ):
+            history = self.data_store
+            return await self.cached(
+                request,
+                history,
+                lambda: self.get_danger(
+                    history, threshold, start, end, limit, cursor
+                ).model_dump_json(),
+            )
+
+        @self.app.get(
+            "/data/danger/counts", response_model=dict[datetime.datetime, int]
+        )
+        async def get_danger_counts(
+            threshold: str = Query(DANGER_THRESHOLD),
+            resolution: str = Query("day", pattern="^(hour|day)$"),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+        ):
+            return self.get_danger_counts(
+                self.data_store, threshold, resolution, start, end
+            )
 
         @self.app.get(
             "/data/metrics/", response_model=dict[datetime.date, DailyMetrics]
         )
-        async def get_metrics(date: Optional[datetime.date] = Query(None)):
-            if date:
-                if date in self.data_store.daily_metrics.keys():
-                    return {date: self.data_store.daily_metrics[date]}
-                else:
-                    raise HTTPException(
-                        status_code=404, detail="Data not found in the specified date!"
-                    )
-            else:
-                return self.data_store.daily_metrics
+        async def get_metrics(
+            request: Request, date: Optional[datetime.date] = Query(None)
+        ):
+            history = self.data_store
+            return await self.cached(
+                request,
+                history,
+                lambda: METRICS.dump_json(self.get_metrics(history, date)),
+            )
 
-    async def fetch_data_onStartup(self):
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"https://pm25.lass-net.org/API-1.0.0/device/{DEVICE_ID}/history/?format=JSON"
+        @self.app.get(
+            "/data/metrics/summary", response_model=dict[datetime.date, DailyMetrics]
+        )
+        async def get_metrics_summary(
+            period: str = Query("week", pattern="^(week|month)$")
+        ):
+            return self.get_metrics_summary(self.data_store, period)
+
+        @self.app.get("/devices", response_model=list[DeviceStatus])
+        async def get_devices():
+            return list(self.poller.status.values())
+
+        @self.app.get("/devices/nearest", response_model=list[NearbyDevice])
+        async def get_nearest_devices(
+            lat: float = Query(..., ge=-90, le=90),
+            lon: float = Query(..., ge=-180, le=180),
+            k: int = Query(GEO_NEAREST, ge=1, le=GEO_MAX_RESULTS),
+        ):
+            return nearby(self.poller.positions.nearest(lat, lon, k), self.poller.views)
+
+        @self.app.get("/devices/within", response_model=list[NearbyDevice])
+        async def get_devices_within(
+            lat: Optional[float] = Query(None, ge=-90, le=90),
+            lon: Optional[float] = Query(None, ge=-180, le=180),
+            radius: Optional[float] = Query(None, gt=0),
+            south: Optional[float] = Query(None, ge=-90, le=90),
+            west: Optional[float] = Query(None, ge=-180, le=180),
+            north: Optional[float] = Query(None, ge=-90, le=90),
+            east: Optional[float] = Query(None, ge=-180, le=180),
+            limit: int = Query(GEO_MAX_RESULTS, ge=1, le=GEO_MAX_RESULTS),
+        ):
+            return self.get_devices_within(
+                lat, lon, radius, south, west, north, east, limit
             )
+
+        @self.app.post("/admin/recompute", response_model=RecomputeResult)
+        async def recompute(
+            threshold: Optional[str] = None,
+            timezone: Optional[str] = None,
+            authorization: Optional[str] = Header(None),
+        ):
+            self.authorize(authorization)
+            return await self.recompute(threshold, timezone)
+
+        @self.app.get("/devices/{device_id}/", response_class=HTMLResponse)
+        async def read_device_root(request: Request, device_id: str):
+            return await self.render_dashboard(request, self.get_history(device_id))
+
+        @self.app.get("/devices/{device_id}/live")
+        async def device_live(device_id: str) -> StreamingResponse:
+            return self.live(self.get_history(device_id))
+
+        @self.app.get("/devices/{device_id}/data", response_model=DeviceHistory)
+        async def get_device_data(request: Request, device_id: str):
+            history = self.get_history(device_id)
+            return await self.cached(request, history, history.model_dump_json)
+
+        @self.app.get("/devices/{device_id}/data/feeds", response_model=FeedPage)
+        async def get_device_feeds(
+            device_id: str,
+            project: str = Query("AirBox"),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+            limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_PAGE_MAX_SIZE),
+            cursor: Optional[str] = Query(None),
+        ):
+            return self.get_feeds(
+                self.get_history(device_id), project, start, end, limit, cursor
+            )
+
+        @self.app.get("/devices/{device_id}/data/export")
+        async def export_device_data(
+            device_id: str,
+            format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+            project: Optional[str] = Query(None),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+            columns: Optional[str] = Query(None),
+        ) -> StreamingResponse:
+            return self.export(
+                self.get_history(device_id), format, project, start, end, columns
+            )
+
+        @self.app.get("/devices/{device_id}/data/rollup", response_model=RollupSeries)
+        async def get_device_rollup(
+            device_id: str,
+            project: str = Query("AirBox"),
+            resolution: str = Query("auto", pattern="^(auto|minute|hour|day)$"),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+        ):
+            return self.get_rollup(
+                self.get_history(device_id), project, resolution, start, end
+            )
+
+        @self.app.get(
+            "/devices/{device_id}/data/rolling", response_model=dict[str, RollingValue]
+        )
+        async def get_device_rolling(
+            device_id: str, window: Optional[str] = Query(None)
+        ):
+            return self.get_rolling(self.get_history(device_id), window)
+
+        @self.app.get("/devices/{device_id}/data/danger", response_model=DangerPage)
+        async def get_device_danger_thresholds(
+            request: Request,
+            device_id: str,
+            threshold: str = Query(DANGER_THRESHOLD),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+            limit: int = Query(FEED_PAGE_SIZE, ge=1, le=FEED_PAGE_MAX_SIZE),
+            cursor: Optional[str] = Query(None),
+        ):
+            history = self.get_history(device_id)
+            return await self.cached(
+                request,
+                history,
+                lambda: self.get_danger(
+                    history, threshold, start, end, limit, cursor
+                ).model_dump_json(),
+            )
+
+        @self.app.get(
+            "/devices/{device_id}/data/danger/counts",
+            response_model=dict[datetime.datetime, int],
+        )
+        async def get_device_danger_counts(
+            device_id: str,
+            threshold: str = Query(DANGER_THRESHOLD),
+            resolution: str = Query("day", pattern="^(hour|day)$"),
+            start: Optional[datetime.datetime] = Query(None),
+            end: Optional[datetime.datetime] = Query(None),
+        ):
+            return self.get_danger_counts(
+                self.get_history(device_id), threshold, resolution, start, end
+            )
+
+        @self.app.get(
+            "/devices/{device_id}/data/metrics/",
+            response_model=dict[datetime.date, DailyMetrics],
+        )
+        async def get_device_metrics(
+            request: Request,
+            device_id: str,
+            date: Optional[datetime.date] = Query(None),
+        ):
+            history = self.get_history(device_id)
+            return await self.cached(
+                request,
+                history,
+                lambda: METRICS.dump_json(self.get_metrics(history, date)),
+            )
+
+        @self.app.get(
+            "/devices/{device_id}/data/metrics/summary",
+            response_model=dict[datetime.date, DailyMetrics],
+        )
+        async def get_device_metrics_summary(
+            device_id: str, period: str = Query("week", pattern="^(week|month)$")
+        ):
+            return self.get_metrics_summary(self.get_history(device_id), period)
+
+    @property
+    def data_store(self) -> DeviceHistory:
+        return self.poller.view(self.device_ids[0])
+
+    def get_history(self, device_id: str) -> DeviceHistory:
+        if device_id not in self.poller.histories:
+            raise HTTPException(status_code=404, detail="Device not found!")
+        return self.poller.view(device_id)
+
+    def dashboard(self, history: DeviceHistory) -> Dashboard:
+        # Each view replaces the last, the rendered fragments carry over.
+        dashboard = self.dashboards.get(history.device_id)
+        if dashboard is None:
+            dashboard = self.dashboards[history.device_id] = Dashboard(history)
+        dashboard.data = history
+        return dashboard
+
+    async def cached(
+        self,
+        request: Request,
+        history: DeviceHistory,
+        build: Callable[[], Union[bytes, str]],
+        media_type: str = JSON,
+        *extra,
+    ) -> Response:
+        # Bodies are built once per view and request, clients that send back
+        # the ETag of the view they have get a 304 without a body.
+        tag = etag(history, *extra)
+        headers = {"ETag": tag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if not_modified(request.headers, tag):
+            return Response(status_code=304, headers=headers)
+        key = (request.url.path, request.url.query)
+        entry = self.responses.get(key, tag)
+        if entry is None:
+            body = build()
+            entry = self.responses.put(
+                key, tag, body if isinstance(body, bytes) else body.encode()
+            )
+        body = entry.body
+        if len(body) >= GZIP_MIN_SIZE and accepts_gzip(request.headers):
+            body = await self.responses.compress(key, entry)
+            headers["Content-Encoding"] = "gzip"
+        return Response(body, media_type=media_type, headers=headers)
+
+    async def render_dashboard(
+        self, request: Request, history: DeviceHistory
+    ) -> Response:
+        # The page shows today's readings, so it changes with the day too.
+        return await self.cached(
+            request,
+            history,
+            lambda: self.dashboard(history).render().body,
+            HTML,
+            today_start(history._days),
+        )
+
+    def live(self, history: DeviceHistory) -> StreamingResponse:
+        return StreamingResponse(
+            self.poller.broadcaster.stream(history.device_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    def get_feeds(
+        self,
+        history: DeviceHistory,
+        project: str,
+        start: Optional[datetime.datetime],
+        end: Optional[datetime.datetime],
+        limit: int,
+        cursor: Optional[str],
+    ) -> FeedPage:
+        if project not in history.feeds:
+            raise HTTPException(status_code=404, detail="Project not found!")
+        start_epoch = None if start is None else to_epoch(start)
+        if cursor is not None:
+            # The cursor is the epoch of the first reading of the next page.
+            if not cursor.isdigit():
+                raise HTTPException(status_code=400, detail="Invalid cursor!")
+            start_epoch = max(int(cursor), start_epoch or 0)
+        records = history.feeds[project]
+        rows, next_epoch = records.page(
+            start_epoch, None if end is None else to_epoch(end), limit
+        )
+        return FeedPage(
+            project=project,
+            device_id=records.device_id,
+            records=[
+                FeedReading(
+                    timestamp=from_epoch(row[0]),
+                    **{name: to_value(value) for name, value in zip(COLUMNS, row[1:])},
+                )
+                for row in rows
+            ],
+            next_cursor=None if next_epoch is None else str(next_epoch),
+        )
+
+    def get_devices_within(
+        self,
+        lat: Optional[float],
+        lon: Optional[float],
+        radius: Optional[float],
+        south: Optional[float],
+        west: Optional[float],
+        north: Optional[float],
+        east: Optional[float],
+        limit: int,
+    ) -> list[NearbyDevice]:
+        # A radius in km around lat and lon, nearest first, or a box by
+        # device, which crosses the antimeridian when west is east of east.
+        positions = self.poller.positions
+        if None not in (lat, lon, radius):
+            found = positions.within_radius(lat, lon, radius)
+        elif None not in (south, west, north, east):
+            if south > north:
+                raise HTTPException(status_code=400, detail="Invalid box!")
+            found = [
+                (None, position)
+                for position in positions.within_box(south, west, north, east)
+            ]
+        else:
+            raise HTTPException(
+                status_code=400,
+                detail="Give lat, lon and radius, or south, west, north and east!",
+            )
+        return nearby(found[:limit], self.poller.views)
+
+    def authorize(self, authorization: Optional[str]):
+        if not ADMIN_TOKEN:
+            raise HTTPException(
+                status_code=403, detail="Admin operations are disabled!"
+            )
+        if not hmac.compare_digest(authorization or "", f"Bearer {ADMIN_TOKEN}"):
+            raise HTTPException(status_code=401, detail="Invalid token!")
+
+    def parse_thresholds(self, value: Optional[str]) -> dict[str, float]:
+        # A number for the default threshold, or name=number pairs.
+        thresholds = dict(DANGER_THRESHOLDS)
+        for item in (value or "").split(","):
+            if not item.strip():
+                continue
+            name, _, number = item.rpartition("=")
+            name = name.strip() or DANGER_THRESHOLD
+            if name not in thresholds:
+                raise HTTPException(status_code=404, detail="Threshold not found!")
             try:
-                data = response.json()
-                self.process_init_response(data)
-            except (ValueError, ValidationError) as e:
-                print(f"Failed to update data_store: {e}")
+                thresholds[name] = float(number)
+            except ValueError:
+                thresholds[name] = math.nan
+            if not math.isfinite(thresholds[name]):
+                raise HTTPException(status_code=400, detail="Invalid threshold!")
+        return thresholds
+
+    async def recompute(
+        self, threshold: Optional[str], timezone: Optional[str]
+    ) -> RecomputeResult:
+        thresholds = self.parse_thresholds(threshold)
+        try:
+            days = current_days() if timezone is None else Days(timezone)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Unknown timezone!")
+        # Followers serve the histories the leader recomputed.
+        if self.poller.role == "follower":
+            raise HTTPException(status_code=409, detail="Not the polling worker!")
+        if self.recomputing.locked():
+            raise HTTPException(status_code=409, detail="Recompute already running!")
+        async with self.recomputing:
+            started = time.perf_counter()
+            readings = await self.poller.recompute(thresholds, days)
+            seconds = time.perf_counter() - started
+        self.log.info(
+            f"Recomputed {readings} readings with {thresholds} in {days.name}"
+            f" in {seconds:.2f} s"
+        )
+        return RecomputeResult(
+            thresholds=thresholds,
+            timezone=days.name,
+            devices=len(self.poller.histories),
+            readings=readings,
+            seconds=round(seconds, 3),
+            vectorized=vectorized(),
+        )
+
+    def danger_index(self, history: DeviceHistory, threshold: str) -> DangerIndex:
+        if threshold not in history.danger:
+            raise HTTPException(status_code=404, detail="Threshold not found!")
+        return history.danger[threshold]
+
+    def get_danger(
+        self,
+        history: DeviceHistory,
+        threshold: str,
+        start: Optional[datetime.datetime],
+        end: Optional[datetime.datetime],
+        limit: int,
+        cursor: Optional[str],
+    ) -> DangerPage:
+        index = self.danger_index(history, threshold)
+        start_epoch = None if start is None else to_epoch(start)
+        if cursor is not None:
+            # The cursor is the start of the first episode of the next page.
+            if not cursor.isdigit():
+                raise HTTPException(status_code=400, detail="Invalid cursor!")
+            start_epoch = max(int(cursor), start_epoch or 0)
+        episodes, next_start = index.page(
+            start_epoch, None if end is None else to_epoch(end), limit
+        )
+        return DangerPage(
+            name=threshold,
+            threshold=index.threshold,
+            episodes=episodes,
+            next_cursor=None if next_start is None else str(next_start),
+        )
+
+    def get_danger_counts(
+        self,
+        history: DeviceHistory,
+        threshold: str,
+        resolution: str,
+        start: Optional[datetime.datetime],
+        end: Optional[datetime.datetime],
+    ) -> dict[datetime.datetime, int]:
+        # Buckets are counted from the one containing start, like rollups.
+        counts = self.danger_index(history, threshold).exceedances[resolution]
+        lo = None if start is None else to_epoch(start)
+        if lo is not None:
+            lo -= lo % DANGER_RESOLUTIONS[resolution]
+        hi = None if end is None else to_epoch(end)
+        return {
+            from_epoch(bucket): count
+            for bucket, count in sorted(counts.items())
+            if (lo is None or bucket >= lo) and (hi is None or bucket < hi)
+        }
+
+    def get_rolling(
+        self, history: DeviceHistory, window: Optional[str]
+    ) -> dict[str, RollingValue]:
+        windows = history.rolling()
+        if window is None:
+            return windows
+        if window not in windows:
+            raise HTTPException(status_code=404, detail="Window not found!")
+        return {window: windows[window]}
+
+    def get_rollup(
+        self,
+        history: DeviceHistory,
+        project: str,
+        resolution: str,
+        start: Optional[datetime.datetime],
+        end: Optional[datetime.datetime],
+    ) -> RollupSeries:
+        if project not in history.feeds:
+            raise HTTPException(status_code=404, detail="Project not found!")
+        tiers = history.feeds[project].rollups
+        start_epoch = None if start is None else to_epoch(start)
+        end_epoch = None if end is None else to_epoch(end)
+        if resolution == "auto":
+            resolution = select_resolution(tiers, start_epoch, end_epoch)
+        tier = tiers[resolution]
+        lo, hi = tier.bounds(start_epoch, end_epoch)
+        if hi - lo > ROLLUP_MAX_POINTS:
+            raise HTTPException(
+                status_code=400,
+                detail="Too many buckets, use a coarser resolution or a shorter range!",
+            )
+        return RollupSeries(
+            project=project,
+            resolution=resolution,
+            buckets=[
+                RollupBucket(
+                    timestamp=from_epoch(bucket),
+                    values={
+                        name: RollupValue(
+                            count=value[0], avg=value[1], min=value[2], max=value[3]
+                        )
+                        for name, value in zip(ROLLUP_COLUMNS, values)
+                        if value is not None
+                    },
+                )
+                for bucket, values in tier.range(start_epoch, end_epoch)
+            ],
+        )
+
+    def export(
+        self,
+        history: DeviceHistory,
+        format: str,
+        project: Optional[str],
+        start: Optional[datetime.datetime],
+        end: Optional[datetime.datetime],
+        columns: Optional[str],
+    ) -> StreamingResponse:
+        if project is not None and project not in history.feeds:
+            raise HTTPException(status_code=404, detail="Project not found!")
+        names = None
+        if columns:
+            names = [name.strip() for name in columns.split(",") if name.strip()]
+            if not set(names) <= set(COLUMNS):
+                raise HTTPException(status_code=400, detail="Unknown column!")
+        return StreamingResponse(
+            export_rows(
+                history,
+                format,
+                None if project is None else [project],
+                None if start is None else to_epoch(start),
+                None if end is None else to_epoch(end),
+                names,
+            ),
+            media_type=EXPORT_FORMATS[format],
+            headers={
+                "Content-Disposition": f'attachment; filename="{history.device_id}.{format}"'
+            },
+        )
+
+    def get_metrics(self, history: DeviceHistory, date: Optional[datetime.date]):
+        if date:
+            if date in history.daily_metrics.keys():
+                return {date: history.daily_metrics[date]}
+            else:
+                raise HTTPException(
+                    status_code=404, detail="Data not found in the specified date!"
+                )
+        else:
+            return history.daily_metrics
+
+    def get_metrics_summary(
+        self, history: DeviceHistory, period: str
+    ) -> dict[datetime.date, DailyMetrics]:
+        # Weeks start on Monday, both are keyed by their first day.
+        periods: dict[datetime.date, list[DailyMetrics]] = {}
+        for date, metrics in sorted(history.daily_metrics.items()):
+            if period == "week":
+                start = date - datetime.timedelta(days=date.weekday())
+            else:
+                start = date.replace(day=1)
+            periods.setdefault(start, []).append(metrics)
+        return {
+            start: DailyMetrics.merge(metrics) for start, metrics in periods.items()
+        }
+
+    async def fetch_data_onStartup(self):
+        await self.poller.fetch_histories()
 
     async def fetch_data_periodically(self):
-        async with httpx.AsyncClient() as client:
-            while True:
-                try:
-                    response = await client.get(
-                        f"https://pm25.lass-net.org/API-1.0.0/device/{DEVICE_ID}/latest/?format=JSON"
-                    )
-                    self.process_response(response.json())
-                except (ValueError, ValidationError) as e:
-                    print(f"Failed to update data_store: {e}")
-                except Exception as e:
-                    self.log.error(str(e))
-                finally:
-                    await asyncio.sleep(1)
+        await self.poller.run()
+
+    async def warm_up(self):
+        # Gaps are looked for once the history is in, next to the polls.
+        await self.fetch_data_onStartup()
+        await asyncio.gather(self.fetch_data_periodically(), self.backfill.run())
 
     @asynccontextmanager
     async def lifespan(self, app: FastAPI):
+        # Snapshots, and what storage holds of the devices without one, load
+        # on the ingest thread before the app serves. Fetching the history
+        # and polling happen in the background and are reported by /ready.
+        restored = await self.poller.restore()
+        if restored:
+            self.log.info(f"Restored {restored} devices from snapshots")
+        await self.poller.prepare_histories()
+        writer = asyncio.create_task(self.poller.writer.run())
+        keepalive = asyncio.create_task(self.poller.broadcaster.run())
+        if self.coordinator is None:
+            tasks = [
+                asyncio.create_task(self.poller.snapshot_forever()),
+                asyncio.create_task(self.warm_up()),
+            ]
+        else:
+            # The views the leader shares are its snapshots as well.
+            tasks = [asyncio.create_task(self.coordinator.run(self.warm_up))]
         try:
-            await self.fetch_data_onStartup()
-            task = asyncio.create_task(self.fetch_data_periodically())
             yield
-            task.cancel()
-            await task
-        except asyncio.exceptions.CancelledError:
-            pass
-
-    def process_init_response(self, response_data: dict) -> dict:
-        self.data_store = DeviceHistory(
-            **{
-                "source": response_data.get("source"),
-                "device_id": response_data.get("device_id"),
-                "version": response_data.get("version"),
-                "num_of_records": 0,
-                "feeds": {"AirBox": {}},
-                "danger_threshold_instances": [],
-                "daily_metrics": {},
-            }
-        )
-
-        for feed in response_data["feeds"]:
-            for project in feed.keys():
-                for entry in feed[project]:
-                    for key in entry.keys():
-                        record = DeviceRecord(**entry[key])
-                        self.data_store.add_record(project, key, record)
-
-    def process_response(self, response_data: dict) -> dict:
-        for feed in response_data["feeds"]:
-            for project in feed.keys():
-                record = DeviceRecord(
-                    **{
-                        "app": project,
-                        "device_id": feed[project]["device_id"],
-                        "s_t0": feed[project]["s_t0"],
-                        "s_h0": feed[project]["s_h0"],
-                        "s_d0": feed[project]["s_d0"],
-                        "gps_lat": feed[project]["gps_lat"],
-                        "gps_lon": feed[project]["gps_lon"],
-                        "timestamp": feed[project]["timestamp"],
-                    }
-                )
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.poller.drain()
+            if self.coordinator is None or self.coordinator.leading:
+                try:
+                    await self.poller.save_snapshots()
+                except OSError as e:
+                    self.log.error(f"Failed to write snapshots: {e}")
+            if self.coordinator is not None:
+                self.coordinator.lease.release()
+            writer.cancel()
+            keepalive.cancel()
+            await asyncio.gather(writer, keepalive, return_exceptions=True)
+            await self.poller.writer.close()
+            await self.poller.aclose()
 
-                response = self.data_store.add_record(
-                    project, feed[project]["timestamp"], record
-                )
-                if response:
-                    self.log.info(
-                        f"Added record with timestamp {feed[project]['timestamp']}"
-                    )
-                else:
-                    self.log.info(
-                        f"Record with timestamp {feed[project]['timestamp']} already exists"
-                    )
+    def process_init_response(self, response_data: dict) -> DeviceHistory:
+        return self.poller.process_init_response(self.device_ids[0], response_data)
+
+    def process_response(self, response_data: dict) -> int:
+        return self.poller.process_response(self.device_ids[0], response_data)
+
+
+def create_app() -> FastAPI:
+    # Every worker builds its own service.
+    return PM_Analyzer().app
 
 
 def main():
     import uvicorn
 
     try:
-        service = PM_Analyzer()
-        uvicorn.run(service.app, host="0.0.0.0", port=8000)
+        if WORKERS > 1:
+            uvicorn.run(
+                "src.app:create_app",
+                factory=True,
+                host="0.0.0.0",
+                port=PORT,
+                workers=WORKERS,
+            )
+        else:
+            service = PM_Analyzer()
+            uvicorn.run(service.app, host="0.0.0.0", port=PORT)
     except KeyboardInterrupt:
         pass
 
@@ -0,0 +1,242 @@
+import os
+import json
+import asyncio
+import logging
+from typing import Optional
+
+import httpx
+from pydantic import ValidationError
+
+from src.data import DeviceHistory
+from src.poller import DevicePoller
+from src.retention import AGE_UNITS
+from src.snapshot import SNAPSHOT_DIR
+from src.store import from_epoch
+
+
+def parse_age(value: str) -> int:
+    value = value.strip()
+    if value[-1] in AGE_UNITS:
+        return int(value[:-1]) * AGE_UNITS[value[-1]]
+    return int(value)
+
+
+# A step between two readings of a project longer than this many reporting
+# intervals is a gap.
+BACKFILL_GAP_FACTOR = float(os.getenv("BACKFILL_GAP_FACTOR", default=3.0))
+BACKFILL_LOOKBACK = parse_age(str(os.getenv("BACKFILL_LOOKBACK", default="7d")))
+BACKFILL_CHUNK = parse_age(str(os.getenv("BACKFILL_CHUNK", default="6h")))
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", default=4))
+BACKFILL_RETRIES = int(os.getenv("BACKFILL_RETRIES", default=4))
+BACKFILL_MAX_BACKOFF = float(os.getenv("BACKFILL_MAX_BACKOFF", default=60.0))
+BACKFILL_INTERVAL = float(os.getenv("BACKFILL_INTERVAL", default=900))
+BACKFILL_CHECKPOINT = str(
+    os.getenv(
+        "BACKFILL_CHECKPOINT",
+        default=os.path.join(SNAPSHOT_DIR, "backfill.json") if SNAPSHOT_DIR else "",
+    )
+)
+
+
+def find_gaps(
+    view: DeviceHistory, longest: float, lookback: int = BACKFILL_LOOKBACK
+) -> tuple[Optional[int], list[tuple[int, int]]]:
+    # The seconds strictly between readings of a project more than longest
+    # apart, merged across projects, within lookback of the newest reading.
+    # Readings older than the spilled ones would be dropped, so gaps are only
+    # looked for after them. Returns where the search started as well.
+    newest = max((records.last() or 0 for records in view.feeds.values()), default=0)
+    if not newest:
+        return None, []
+    since = newest - lookback
+    found = []
+    for records in view.feeds.values():
+        start = since if records.spilled is None else max(since, records.spilled + 1)
+        previous = None
+        for row in records.range(start, None):
+            if previous is not None and row[0] - previous > longest:
+                found.append((previous + 1, row[0] - 1))
+            previous = row[0]
+    gaps = []
+    for start, end in sorted(found):
+        if gaps and start <= gaps[-1][1] + 1:
+            gaps[-1] = (gaps[-1][0], max(gaps[-1][1], end))
+        else:
+            gaps.append((start, end))
+    return since, gaps
+
+
+def split(start: int, end: int, size: int = BACKFILL_CHUNK) -> list[tuple[int, int]]:
+    # Aligned to multiples of size, so the rest of a gap partly filled is
+    # split as it was.
+    return [
+        (max(lo, start), min(lo + size - 1, end))
+        for lo in range(start - start % size, end + 1, size)
+    ]
+
+
+def stamp(epoch: int) -> str:
+    return from_epoch(epoch).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Backfill:
+    # Fetches the readings missed while the poller was down or LASS was out.
+    # Every interval the views are searched for gaps against the learned
+    # reporting interval of each device, and the gaps are fetched in chunks,
+    # a few at a time next to the polls. A chunk that brings nothing new is
+    # checkpointed and not asked for again, after a restart either. One that
+    # does is not, the snapshots keep what it brought.
+    def __init__(
+        self,
+        poller: DevicePoller,
+        concurrency: int = BACKFILL_CONCURRENCY,
+        retries: int = BACKFILL_RETRIES,
+        chunk: int = BACKFILL_CHUNK,
+        factor: float = BACKFILL_GAP_FACTOR,
+        lookback: int = BACKFILL_LOOKBACK,
+        max_backoff: float = BACKFILL_MAX_BACKOFF,
+        checkpoint: str = BACKFILL_CHECKPOINT,
+    ):
+        self.poller = poller
+        self.concurrency = concurrency
+        self.retries = retries
+        self.chunk = chunk
+        self.factor = factor
+        self.lookback = lookback
+        self.max_backoff = max_backoff
+        self.checkpoint = checkpoint
+        # The chunks per device, as (start, end) epochs, LASS had nothing for.
+        self.done: dict[str, set[tuple[int, int]]] = {}
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.fetched = 0
+        self.failed = 0
+        self.recovered = 0
+        self.log = logging.getLogger("uvicorn")
+
+    def load(self):
+        if not self.checkpoint:
+            return
+        try:
+            with open(self.checkpoint) as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            self.log.error(f"Failed to read the backfill checkpoint: {e}")
+            return
+        self.done = {
+            device_id: {(start, end) for start, end in chunks}
+            for device_id, chunks in state.get("done", {}).items()
+        }
+
+    def save(self):
+        if not self.checkpoint:
+            return
+        os.makedirs(os.path.dirname(self.checkpoint) or ".", exist_ok=True)
+        state = {
+            "done": {
+                device_id: sorted(chunks) for device_id, chunks in self.done.items()
+            }
+        }
+        with open(self.checkpoint + ".tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+
+    async def pending(self, device_id: str) -> list[tuple[int, int]]:
+        # Devices still fetching their history, or whose interval is not
+        # known yet, are left for the next run.
+        status = self.poller.status.get(device_id)
+        schedule = self.poller.schedules.get(device_id)
+        if status is None or not status.ready or schedule is None:
+            return []
+        interval = schedule.reporting_interval
+        if not interval:
+            return []
+        # Views never change, so they are searched on a thread.
+        since, gaps = await asyncio.to_thread(
+            find_gaps,
+            self.poller.views[device_id],
+            interval * self.factor,
+            self.lookback,
+        )
+        done = self.done.setdefault(device_id, set())
+        if since is not None:
+            done.difference_update([chunk for chunk in done if chunk[1] < since])
+        return [
+            chunk
+            for start, end in gaps
+            for chunk in split(start, end, self.chunk)
+            if chunk not in done
+        ]
+
+    async def fetch(self, device_id: str, start: int, end: int) -> int:
+        # Held through the merge, so at most concurrency chunks wait for the
+        # ingest thread behind the polls.
+        schedule = self.poller.schedules[device_id]
+        params = {"start": stamp(start), "end": stamp(end)}
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    data = await self.poller.request(device_id, "history", params)
+                    added = await self.poller.offload(
+                        self.poller.process_backfill, device_id, data, start, end
+                    )
+                break
+            except (ValueError, ValidationError, KeyError, TypeError) as e:
+                self.log.error(f"Failed to backfill {device_id}: {e}")
+                self.failed += 1
+                return 0
+            except httpx.HTTPError as e:
+                if attempt == self.retries:
+                    self.log.error(f"Failed to fetch backfill for {device_id}: {e}")
+                    self.failed += 1
+                    return 0
+                await asyncio.sleep(schedule.backoff(attempt, self.max_backoff))
+            except Exception as e:
+                # Anything else fails this chunk alone, the others go on.
+                self.log.error(f"Failed to backfill {device_id}: {e}")
+                self.failed += 1
+                return 0
+        self.fetched += 1
+        self.recovered += added
+        if not added:
+            self.done.setdefault(device_id, set()).add((start, end))
+            self.save()
+        return added
+
+    async def backfill_device(self, device_id: str) -> int:
+        chunks = await self.pending(device_id)
+        added = sum(
+            await asyncio.gather(
+                *(self.fetch(device_id, start, end) for start, end in chunks)
+            )
+        )
+        if added:
+            # One event once the device is filled in, the readings went in
+            # behind the live ones.
+            self.poller.announce_backfill(device_id)
+        return added
+
+    async def run_once(self) -> int:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        added = await asyncio.gather(
+            *(self.backfill_device(device_id) for device_id in self.poller.device_ids)
+        )
+        return sum(added)
+
+    async def run(self, interval: float = BACKFILL_INTERVAL):
+        if interval <= 0:
+            return
+        self.load()
+        while True:
+            try:
+                added = await self.run_once()
+                if added:
+                    self.log.info(f"Backfilled {added} readings")
+            except OSError as e:
+                self.log.error(f"Failed to write the backfill checkpoint: {e}")
+            except Exception as e:
+                # The next run tries again, the task itself keeps going.
+                self.log.error(f"Backfill failed: {e}")
+            await asyncio.sleep(interval)
@@ -0,0 +1,116 @@
+import os
+import gzip
+import asyncio
+from zlib import crc32
+from collections import OrderedDict
+from typing import Optional
+
+from starlette.datastructures import Headers
+
+from src.data import DeviceHistory
+
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", default=64 * 2**20))
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", default=1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", default=6))
+
+
+def etag(history: DeviceHistory, *extra) -> str:
+    # Every reading changes the count, and views with the same version and
+    # count have the same readings, on every worker. Weak, so the gzip and
+    # identity bodies share it. A recompute changes the settings and nothing
+    # else.
+    parts = [
+        history.device_id,
+        history.version,
+        history.num_of_records,
+        format(crc32(history.settings().encode()), "08x"),
+        *extra,
+    ]
+    return 'W/"' + "-".join(str(part) for part in parts) + '"'
+
+
+def not_modified(headers: Headers, tag: str) -> bool:
+    # Only If-None-Match is honoured. The version is the newest reading, so
+    # a date from it would not move with backfilled or recomputed views.
+    match = headers.get("if-none-match")
+    if match is None:
+        return False
+    tags = [value.strip().removeprefix("W/") for value in match.split(",")]
+    return "*" in tags or tag.removeprefix("W/") in tags
+
+
+def accepts_gzip(headers: Headers) -> bool:
+    for coding in headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00")
+    return False
+
+
+class CachedBody:
+    __slots__ = ("tag", "body", "compressed")
+
+    def __init__(self, tag: str, body: bytes):
+        self.tag = tag
+        self.body = body
+        self.compressed: Optional[bytes] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + len(self.compressed or b"")
+
+
+class ResponseCache:
+    # Serialized bodies by path and query, each with the ETag it was built
+    # for and, once a client asked for it, its gzip form. The least recently
+    # used go first once they take more than max_bytes.
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, CachedBody] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, tag: str) -> Optional[CachedBody]:
+        entry = self.entries.get(key)
+        if entry is None or entry.tag != tag:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: tuple, tag: str, body: bytes) -> CachedBody:
+        entry = CachedBody(tag, body)
+        self.discard(key)
+        # Bodies too large to leave room for others are not kept.
+        if entry.size <= self.max_bytes // 4:
+            self.entries[key] = entry
+            self.bytes += entry.size
+            self.trim()
+        return entry
+
+    def discard(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def trim(self):
+        while self.bytes > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.bytes -= entry.size
+
+    async def compress(self, key: tuple, entry: CachedBody) -> bytes:
+        # Compressed once per body, on a thread so a large one does not hold
+        # up the event loop. Requests that raced for it keep the first one, so
+        # its size is counted once.
+        if entry.compressed is None:
+            compressed = await asyncio.to_thread(
+                gzip.compress, entry.body, GZIP_LEVEL, mtime=0
+            )
+            if entry.compressed is None:
+                entry.compressed = compressed
+                if self.entries.get(key) is entry:
+                    self.bytes += len(compressed)
+                    self.trim()
+        return entry.compressed
@@ -0,0 +1,360 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Awaitable, Callable, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows locks a byte range instead.
+    import msvcrt
+
+    fcntl = None
+
+from src.data import DeviceHistory
+from src.poller import DevicePoller, DeviceStatus
+from src.snapshot import SNAPSHOT_DIR, load_snapshot, save_snapshot, snapshot_path
+
+WORKERS = int(os.getenv("WORKERS", default=1))
+# With lease, one worker polls and shares its views through the snapshot
+# directory, the others serve what it shares.
+COORDINATION = str(
+    os.getenv("COORDINATION", default="lease" if WORKERS > 1 else "none")
+).lower()
+LEASE_PATH = str(
+    os.getenv("LEASE_PATH", default=os.path.join(SNAPSHOT_DIR, "poller.lease"))
+)
+SHARED_INTERVAL = float(os.getenv("SHARED_INTERVAL", default=5.0))
+# Seconds between the full snapshots the leader shares. In between, only the
+# readings added since are appended to a delta file per device.
+SHARED_SNAPSHOT_INTERVAL = float(os.getenv("SHARED_SNAPSHOT_INTERVAL", default=300))
+STATUS_FILE = "status.json"
+
+
+def delta_path(device_id: str, directory: Optional[str] = None) -> str:
+    return os.path.splitext(snapshot_path(device_id, directory))[0] + ".delta"
+
+
+class Lease:
+    # An exclusive lock on a file. The operating system releases it when the
+    # process holding it exits or dies, whichever way, so a follower can take
+    # over without a timeout. Only workers on one host share it reliably.
+    def __init__(self, path: str = LEASE_PATH):
+        self.path = path
+        self.file = None
+
+    @property
+    def held(self) -> bool:
+        return self.file is not None
+
+    def acquire(self) -> bool:
+        if self.file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        file = open(self.path, "a+")
+        try:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            file.close()
+            return False
+        file.truncate(0)
+        file.write(str(os.getpid()))
+        file.flush()
+        self.file = file
+        return True
+
+    def release(self):
+        file, self.file = self.file, None
+        if file is not None:
+            file.close()
+
+    def holder(self) -> Optional[int]:
+        try:
+            with open(self.path) as file:
+                return int(file.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+
+class Coordinator:
+    def __init__(
+        self,
+        poller: DevicePoller,
+        directory: str = SNAPSHOT_DIR,
+        interval: float = SHARED_INTERVAL,
+        lease: Optional[Lease] = None,
+        snapshot_interval: float = SHARED_SNAPSHOT_INTERVAL,
+    ):
+        self.poller = poller
+        self.directory = directory
+        self.interval = interval
+        self.snapshot_interval = snapshot_interval
+        self.lease = lease or Lease()
+        # Every worker follows until it holds the lease, from the histories
+        # it prepares at startup on.
+        self.poller.role = "follower"
+        # What was last loaded from each shared file, by inode, time and size.
+        self.loaded: dict[str, tuple] = {}
+        # Shared files that could not be read, until they are replaced.
+        self.ignored: dict[str, tuple] = {}
+        # The device statuses last shared by the leader.
+        self.statuses: dict[str, dict] = {}
+        # Leading, what was last shared of each device. Following, the
+        # version and number of records of the snapshot each view was loaded
+        # from, and the inode and length of its delta file read so far.
+        self.shared: dict[str, dict] = {}
+        self.bases: dict[str, list] = {}
+        self.deltas: dict[str, tuple] = {}
+        self.log = logging.getLogger("uvicorn")
+
+    @property
+    def leading(self) -> bool:
+        return self.lease.held
+
+    async def run(self, lead: Callable[[], Awaitable]):
+        # Follows until the lease is won, then leads for as long as the
+        # process lives.
+        if not self.directory:
+            self.log.error("Views are not shared without a SNAPSHOT_DIR")
+        while not self.lease.acquire():
+            await self.follow_once()
+            await asyncio.sleep(self.interval)
+        # Whatever the last leader shared before it stopped is taken over.
+        await self.follow_once()
+        self.poller.role = "leader"
+        self.log.info(f"Took the poller lease in process {os.getpid()}")
+        sharing = asyncio.create_task(self.share_forever())
+        try:
+            await lead()
+        finally:
+            sharing.cancel()
+            await asyncio.gather(sharing, return_exceptions=True)
+
+    async def follow_once(self):
+        # Whatever goes wrong reading what the leader shared is logged, and
+        # the follower keeps following.
+        try:
+            await self.follow()
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.log.error(f"Failed to follow the shared views: {e}")
+
+    async def share(self):
+        now = time.monotonic()
+        for device_id, view in list(self.poller.views.items()):
+            if self.poller.status[device_id].ready:
+                # Views never change, so they are written on a thread.
+                await asyncio.to_thread(self.share_view, view, now)
+        state = {
+            "leader": os.getpid(),
+            "devices": [status.model_dump() for status in self.poller.status.values()],
+        }
+        path = os.path.join(self.directory, STATUS_FILE)
+        with open(path + ".tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(path + ".tmp", path)
+
+    def share_view(self, view: DeviceHistory, now: float):
+        # Appends the readings added since the last share to the delta file,
+        # or writes a full snapshot and starts a new delta file from it, every
+        # snapshot_interval, when the settings change or when readings older
+        # than those shared were added, by a backfill for one.
+        device_id = view.device_id
+        shared = self.shared.get(device_id)
+        settings = view.settings()
+        if (
+            shared is not None
+            and shared["settings"] == settings
+            and shared["num_of_records"] == view.num_of_records
+        ):
+            return
+        rows = None
+        if (
+            shared is not None
+            and shared["settings"] == settings
+            and now - shared["since"] < self.snapshot_interval
+        ):
+            rows = self.added(view, shared["lasts"])
+        lasts = {project: records.last() for project, records in view.feeds.items()}
+        path = delta_path(device_id, self.directory)
+        if rows is None:
+            save_snapshot(view, self.directory)
+            header = {"base": [view.version, view.num_of_records]}
+            with open(path + ".tmp", "w") as file:
+                file.write(json.dumps(header) + "\n")
+            os.replace(path + ".tmp", path)
+            self.poller.snapshots[device_id] = (
+                view.version,
+                view.num_of_records,
+                settings,
+            )
+            shared = self.shared[device_id] = {"settings": settings, "since": now}
+        else:
+            batch = {
+                "version": view.version,
+                "num_of_records": view.num_of_records,
+                "feeds": rows,
+            }
+            # One write of whole lines, followers read up to the last one.
+            with open(path, "a") as file:
+                file.write(json.dumps(batch) + "\n")
+        shared["num_of_records"] = view.num_of_records
+        shared["lasts"] = lasts
+
+    def added(self, view: DeviceHistory, lasts: dict) -> Optional[dict]:
+        # The readings after the newest shared one of each project, or None
+        # when they are not all the view has added.
+        rows = {}
+        for project, records in view.feeds.items():
+            last = lasts.get(project)
+            found = list(records.range(None if last is None else last + 1, None))
+            if found:
+                rows[project] = found
+        shared = self.shared[view.device_id]["num_of_records"]
+        if sum(map(len, rows.values())) != view.num_of_records - shared:
+            return None
+        return rows
+
+    async def share_forever(self):
+        while True:
+            try:
+                await self.share()
+            except OSError as e:
+                self.log.error(f"Failed to share views: {e}")
+            await asyncio.sleep(self.interval)
+
+    def changed(self, path: str) -> Optional[tuple]:
+        # The leader replaces shared files, so a new one has a new inode.
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key in (self.loaded.get(path), self.ignored.get(path)):
+            return None
+        return key
+
+    async def follow(self):
+        path = os.path.join(self.directory, STATUS_FILE)
+        key = self.changed(path)
+        if key is not None:
+            try:
+                with open(path) as file:
+                    state = json.load(file)
+                self.statuses = {data["device_id"]: data for data in state["devices"]}
+                self.loaded[path] = key
+            except (ValueError, KeyError, TypeError) as e:
+                self.log.error(f"Ignoring the corrupt status file {path}: {e}")
+                self.ignored[path] = key
+
+        for device_id in self.poller.device_ids:
+            path = snapshot_path(device_id, self.directory)
+            key = self.changed(path)
+            if key is not None:
+                # Taken as the leader recomputed it, with its settings.
+                history = await asyncio.to_thread(load_snapshot, path, False)
+                if history is None:
+                    # A corrupt snapshot is logged once and skipped until the
+                    # leader replaces it.
+                    self.ignored[path] = key
+                else:
+                    previous = self.poller.views.get(device_id)
+                    await self.poller.offload(self.poller.follow_settings, history)
+                    self.poller.adopt(device_id, history)
+                    self.loaded[path] = key
+                    self.bases[device_id] = [history.version, history.num_of_records]
+                    self.deltas.pop(device_id, None)
+                    self.announce(previous, self.poller.view(device_id))
+            if path in self.loaded:
+                await self.follow_delta(device_id, path)
+            # Devices are reported as the leader sees them once their views
+            # have been loaded, except for where this worker would catch up
+            # from if it took over.
+            if path in self.loaded and device_id in self.statuses:
+                restored_until = self.poller.status[device_id].restored_until
+                self.poller.status[device_id] = DeviceStatus(
+                    **{**self.statuses[device_id], "restored_until": restored_until}
+                )
+
+    async def follow_delta(self, device_id: str, path: str):
+        batches, self.deltas[device_id] = await asyncio.to_thread(
+            self.read_delta, device_id
+        )
+        if not batches:
+            return
+        count = await self.poller.offload(self.poller.replay, device_id, batches)
+        if count != batches[-1]["num_of_records"]:
+            # Out of step with the leader, the snapshot is loaded again.
+            self.log.error(
+                f"Reloading {device_id}, {count} records where the leader has"
+                f" {batches[-1]['num_of_records']}"
+            )
+            self.loaded.pop(path, None)
+
+    def read_delta(self, device_id: str) -> tuple[list, tuple]:
+        # The whole lines appended since the last read, and where the next
+        # read starts. A delta file started from another snapshot than the one
+        # loaded is left until the leader or the snapshot catches up.
+        known = self.deltas.get(device_id, (None, 0))
+        try:
+            file = open(delta_path(device_id, self.directory), "rb")
+        except FileNotFoundError:
+            return [], known
+        with file:
+            inode = os.fstat(file.fileno()).st_ino
+            offset = known[1]
+            if inode != known[0]:
+                header = file.readline()
+                if (
+                    not header.endswith(b"\n")
+                    or json.loads(header).get("base") != self.bases[device_id]
+                ):
+                    return [], (None, 0)
+                offset = len(header)
+            file.seek(offset)
+            data = file.read()
+        complete = data[: data.rfind(b"\n") + 1]
+        batches = [json.loads(line) for line in complete.splitlines()]
+        return batches, (inode, offset + len(complete))
+
+    def announce(self, previous: Optional[DeviceHistory], view: DeviceHistory):
+        # Live subscribers of a follower get the readings that are new in the
+        # loaded view, in the form the leader sends them in.
+        broadcaster = self.poller.broadcaster
+        if previous is None or not broadcaster.listening(view.device_id):
+            return
+        if previous.settings() != view.settings():
+            broadcaster.publish(
+                view.device_id, "settings", {"settings": view.settings()}
+            )
+            return
+        announced = 0
+        for project, records in view.feeds.items():
+            before = previous.feeds.get(project)
+            last = before.last() if before is not None else None
+            if last is None:
+                continue
+            for row in records.range(last + 1, None):
+                announced += 1
+                crossed = set()
+                for name, index in view.danger.items():
+                    position = bisect_left(index.starts, row[0])
+                    if (
+                        position < len(index.starts)
+                        and index.starts[position] == row[0]
+                    ):
+                        crossed.add(name)
+                broadcaster.publish(
+                    view.device_id,
+                    "reading",
+                    view.delta(project, records.record(row), crossed),
+                )
+        # Readings the leader backfilled behind those are not live ones.
+        if view.num_of_records - previous.num_of_records > announced:
+            self.poller.announce_backfill(view.device_id)
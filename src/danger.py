@@ -0,0 +1,179 @@
+import os
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from typing import Iterator, Optional
+from pydantic import BaseModel
+from pydantic_core import core_schema
+
+from src.days import Days, current_days
+from src.store import from_epoch, to_epoch
+
+PM_DANGER_THRESHOLD = float(os.getenv("PM_DANGER_THRESHOLD", default=30.0))
+# Named thresholds, the first one is used when a request does not name one.
+DANGER_THRESHOLDS = {
+    name.strip(): float(value)
+    for name, value in (
+        item.split("=")
+        for item in str(
+            os.getenv(
+                "DANGER_THRESHOLDS", default=f"local={PM_DANGER_THRESHOLD},who=15"
+            )
+        ).split(",")
+        if item.strip()
+    )
+}
+DANGER_RESOLUTIONS = {"hour": 3600, "day": 86400}
+
+
+class DangerEpisode(BaseModel):
+    start: datetime
+    end: datetime
+    peak: float
+    count: int
+
+
+class DangerSummary(BaseModel):
+    threshold: float
+    episodes: list[DangerEpisode]
+
+
+class DangerPage(BaseModel):
+    name: str
+    threshold: float
+    episodes: list[DangerEpisode]
+    next_cursor: Optional[str] = None
+
+
+class DangerIndex:
+    # Runs of consecutive readings above the threshold, kept sorted by start in
+    # parallel arrays, with the number of exceedances per hour and per day of
+    # days.
+    def __init__(self, threshold: float, days: Optional[Days] = None):
+        self.threshold = threshold
+        self.days = days or current_days()
+        self.starts = array("q")
+        self.ends = array("q")
+        self.peaks = array("d")
+        self.counts = array("q")
+        self.last: Optional[int] = None
+        self.open = False
+        self.exceedances: dict[str, dict[int, int]] = {
+            name: {} for name in DANGER_RESOLUTIONS
+        }
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def _count(self, epoch: int):
+        for name, resolution in DANGER_RESOLUTIONS.items():
+            counts = self.exceedances[name]
+            bucket = self.days.start(epoch, resolution)
+            counts[bucket] = counts.get(bucket, 0) + 1
+
+    def _extend(self, index: int, epoch: int, value: float):
+        self.starts[index] = min(self.starts[index], epoch)
+        self.ends[index] = max(self.ends[index], epoch)
+        self.peaks[index] = max(self.peaks[index], value)
+        self.counts[index] += 1
+
+    def _insert(self, index: int, epoch: int, value: float):
+        self.starts.insert(index, epoch)
+        self.ends.insert(index, epoch)
+        self.peaks.insert(index, value)
+        self.counts.insert(index, 1)
+
+    def add(self, epoch: int, value: float):
+        if value != value:
+            return
+        if self.last is None or epoch > self.last:
+            self.last = epoch
+            if value <= self.threshold:
+                self.open = False
+                return
+            self._count(epoch)
+            if self.open:
+                self._extend(len(self.starts) - 1, epoch, value)
+            else:
+                self._insert(len(self.starts), epoch, value)
+                self.open = True
+            return
+
+        # A late reading joins the episode that spans it or becomes an episode
+        # of its own. A late reading below the threshold does not split one.
+        if value <= self.threshold:
+            return
+        self._count(epoch)
+        index = bisect_right(self.starts, epoch) - 1
+        if index >= 0 and epoch <= self.ends[index]:
+            self._extend(index, epoch, value)
+        else:
+            self._insert(index + 1, epoch, value)
+
+    def freeze(self) -> "DangerIndex":
+        index = DangerIndex(self.threshold, self.days)
+        index.starts = self.starts[:]
+        index.ends = self.ends[:]
+        index.peaks = self.peaks[:]
+        index.counts = self.counts[:]
+        index.last = self.last
+        index.open = self.open
+        index.exceedances = {
+            name: dict(counts) for name, counts in self.exceedances.items()
+        }
+        return index
+
+    def bounds(self, start: Optional[int], end: Optional[int]) -> tuple[int, int]:
+        # Episodes are disjoint, so their ends are sorted like their starts.
+        lo = 0 if start is None else bisect_left(self.ends, start)
+        hi = len(self.starts) if end is None else bisect_left(self.starts, end)
+        return lo, max(lo, hi)
+
+    def episodes(
+        self, lo: int = 0, hi: Optional[int] = None
+    ) -> Iterator[DangerEpisode]:
+        for index in range(lo, len(self.starts) if hi is None else hi):
+            yield DangerEpisode(
+                start=from_epoch(self.starts[index]),
+                end=from_epoch(self.ends[index]),
+                peak=self.peaks[index],
+                count=self.counts[index],
+            )
+
+    def page(
+        self, start: Optional[int] = None, end: Optional[int] = None, limit: int = 1000
+    ) -> tuple[list[DangerEpisode], Optional[int]]:
+        # Returns up to limit episodes overlapping the range and the start of
+        # the episode the next page begins with.
+        lo, hi = self.bounds(start, end)
+        next_start = self.starts[lo + limit] if hi - lo > limit else None
+        return list(self.episodes(lo, min(hi, lo + limit))), next_start
+
+    def summary(self) -> DangerSummary:
+        return DangerSummary(threshold=self.threshold, episodes=list(self.episodes()))
+
+    @classmethod
+    def validate(cls, summary: DangerSummary) -> "DangerIndex":
+        index = cls(summary.threshold)
+        for episode in sorted(summary.episodes, key=lambda episode: episode.start):
+            index.starts.append(to_epoch(episode.start))
+            index.ends.append(to_epoch(episode.end))
+            index.peaks.append(episode.peak)
+            index.counts.append(episode.count)
+        return index
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler):
+        summary_schema = core_schema.no_info_after_validator_function(
+            cls.validate, handler.generate_schema(DangerSummary)
+        )
+        return core_schema.json_or_python_schema(
+            json_schema=summary_schema,
+            python_schema=core_schema.union_schema(
+                [core_schema.is_instance_schema(cls), summary_schema]
+            ),
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda index, info: index.summary().model_dump(mode=info.mode),
+                info_arg=True,
+            ),
+        )
@@ -1,11 +1,26 @@
-import os
-from typing import Optional
+import heapq
+import logging
+from typing import Iterable, Optional
+from pydantic import BaseModel, PrivateAttr, computed_field
 from redis_om import HashModel, Field
-from redis.exceptions import ConnectionError
 from datetime import datetime, timezone, date
 
-REDIS = True
-PM_DANGER_THRESHOLD = float(os.getenv("PM_DANGER_THRESHOLD", default=30.0))
+from src.store import COLUMNS, NAN, FeedStore, to_epoch
+from src.retention import segment_projects
+from src.danger import DANGER_THRESHOLDS, DangerIndex
+from src.days import Days, current_days
+from src.persistence import (
+    STORAGE_BACKEND,
+    StorageError,
+    WriteBehindQueue,
+    open_backend,
+)
+from src.stats import RunningStats, TDigest
+from src.live import Broadcaster
+from src.rolling import RollingEngine, RollingValue
+from src.telemetry import RECORDS, STORAGE_RECORDS, STORAGE_WRITE_SECONDS
+
+log = logging.getLogger("uvicorn")
 
 
 class DeviceRecord(HashModel):
@@ -19,11 +34,139 @@ class DeviceRecord(HashModel):
     timestamp: Optional[datetime] = Field(None)
 
 
+# The backend records are restored from and written to, None when readings are
+# only kept in memory.
+STORAGE = open_backend(STORAGE_BACKEND, DeviceRecord)
+
+
+def storage():
+    return STORAGE
+
+
+def dust_level(record: DeviceRecord) -> float:
+    # NaN for a reading without s_d0, as the feeds store it. Raises for one
+    # that is not a number.
+    return NAN if record.s_d0 is None else float(record.s_d0)
+
+
 class DailyMetrics(HashModel):
     max: Optional[float]
     min: Optional[float]
     avg: Optional[float]
     count: Optional[int]
+    std: Optional[float] = Field(None)
+    _stats: RunningStats = PrivateAttr(default_factory=RunningStats)
+    _digest: TDigest = PrivateAttr(default_factory=TDigest)
+    _frozen = PrivateAttr(default=False)
+
+    @computed_field
+    @property
+    def p50(self) -> Optional[float]:
+        return self.percentile(0.5)
+
+    @computed_field
+    @property
+    def p95(self) -> Optional[float]:
+        return self.percentile(0.95)
+
+    @computed_field
+    @property
+    def p99(self) -> Optional[float]:
+        return self.percentile(0.99)
+
+    def percentile(self, q: float) -> Optional[float]:
+        digest = self._digest
+        if self._frozen and digest.buffer:
+            # Views fold a copy and swap it in, the digest other threads may
+            # be reading is left as it is.
+            digest = digest.copy()
+            digest.compress()
+            self._digest = digest
+        value = digest.quantile(q)
+        return None if value is None else round(value, 1)
+
+    def add(self, value: float):
+        self._stats.add(value)
+        self._digest.add(value)
+        self.refresh()
+
+    def extend(self, values: Iterable[float]):
+        for value in values:
+            self._stats.add(value)
+            self._digest.add(value)
+        self.refresh()
+
+    def refresh(self):
+        stats = self._stats
+        if not stats.count:
+            return
+        # Runs for every reading, so it skips the checks of BaseModel.__setattr__.
+        self.__dict__.update(
+            max=stats.max,
+            min=stats.min,
+            avg=round(stats.mean, 1),
+            count=stats.count,
+            std=round(stats.std, 1),
+        )
+
+    def freeze(self) -> "DailyMetrics":
+        metrics = self.model_copy()
+        metrics._stats = self._stats.copy()
+        metrics._digest = self._digest.copy()
+        metrics._frozen = True
+        return metrics
+
+    @classmethod
+    def empty(cls) -> "DailyMetrics":
+        return cls(max=None, min=None, avg=None, count=0)
+
+    @classmethod
+    def merge(cls, metrics: Iterable["DailyMetrics"]) -> "DailyMetrics":
+        merged = cls.empty()
+        for daily in metrics:
+            merged._stats.merge(daily._stats)
+            merged._digest.merge(daily._digest)
+        merged.refresh()
+        return merged
+
+
+S_D0 = COLUMNS.index("s_d0") + 1
+# The daily metrics sent with every live reading.
+DELTA_METRICS = {"max", "min", "avg", "std", "count", "p50", "p95", "p99"}
+
+
+class FeedReading(BaseModel):
+    timestamp: datetime
+    s_t0: Optional[float] = None
+    s_h0: Optional[float] = None
+    s_d0: Optional[float] = None
+    gps_lat: Optional[float] = None
+    gps_lon: Optional[float] = None
+
+
+class FeedPage(BaseModel):
+    project: str
+    device_id: Optional[str] = None
+    records: list[FeedReading]
+    next_cursor: Optional[str] = None
+
+
+class RollupValue(BaseModel):
+    count: int
+    avg: float
+    min: float
+    max: float
+
+
+class RollupBucket(BaseModel):
+    timestamp: datetime
+    values: dict[str, RollupValue]
+
+
+class RollupSeries(BaseModel):
+    project: str
+    resolution: str
+    buckets: list[RollupBucket]
 
 
 class DeviceHistory(HashModel):
@@ -31,84 +174,352 @@ class DeviceHistory(HashModel):
     device_id: Optional[str] = Field(None)
     version: Optional[str] = Field(None)
     num_of_records: Optional[int] = Field(None)
-    feeds: Optional[dict[str, dict[datetime, DeviceRecord]]]
-    danger_threshold_instances: Optional[list]
+    feeds: Optional[dict[str, FeedStore]]
+    danger: Optional[dict[str, DangerIndex]]
     daily_metrics: Optional[dict[date, DailyMetrics]]
+    _writer: Optional[WriteBehindQueue] = PrivateAttr(default=None)
+    _broadcaster: Optional[Broadcaster] = PrivateAttr(default=None)
+    # Days whose metrics changed since the last view, and the view's number.
+    _changed_days = PrivateAttr(default_factory=set)
+    _revision: int = PrivateAttr(default=0)
+    _rolling: RollingEngine = PrivateAttr(default_factory=RollingEngine)
+    # The days the daily metrics and danger counts are kept in.
+    _days: Days = PrivateAttr(default_factory=current_days)
 
-    def __init__(self, **data):
+    def __init__(self, retain: bool = True, **data):
+        # Followers load what storage holds without spilling it, the
+        # segments on disk are the leader's to write.
         super().__init__(**data)
-        try:
-            for record in DeviceRecord.all_pks():
-                record_data = DeviceRecord.get(record)
-                if record_data.app in self.feeds.keys():
-                    self.feeds[record_data.app][record_data.timestamp] = record_data
-                else:
-                    self.feeds[record_data.app] = {record_data.timestamp: record_data}
-
-                self.__check_danger_threshold(record_data)
-                self.__check_daily_average(record_data)
-                self.num_of_records += 1
-        except ConnectionError:
-            global REDIS
-            REDIS = False
-            pass
-
-    def add_record(self, project: str, timestamp: str, record: DeviceRecord):
-        global REDIS
+        for name, threshold in DANGER_THRESHOLDS.items():
+            if name not in self.danger:
+                self.danger[name] = DangerIndex(threshold, self._days)
+        loaded = self.__open_segments()
+        if STORAGE is not None:
+            try:
+                loaded += self.__load_records()
+            except StorageError as e:
+                log.error(f"Failed to restore {self.device_id}: {e}")
+        if loaded:
+            self.__index_danger()
+        if retain:
+            for records in self.feeds.values():
+                records.retain()
+        self.index_rolling()
+
+    def __open_segments(self) -> int:
+        # Readings spilled to disk by an earlier run count again, and go into
+        # the daily metrics since Redis records older than them are skipped.
+        opened = 0
+        for project in segment_projects(self.device_id) if self.device_id else []:
+            if project not in self.feeds:
+                self.feeds[project] = FeedStore(project)
+            records = self.feeds[project]
+            records.project = records.project or project
+            records.device_id = records.device_id or self.device_id
+            length = records.open_segments()
+            if not length:
+                continue
+            for row in records.range(None, records.spilled + 1):
+                if row[3] == row[3]:
+                    self.__add_daily_metric(self._days.date(row[0]), row[3])
+            self.num_of_records += length
+            opened += length
+        return opened
+
+    def __load_records(self) -> int:
+        loaded = 0
+        for record_data in STORAGE.load(self.device_id):
+            if record_data.app not in self.feeds.keys():
+                self.feeds[record_data.app] = FeedStore(record_data.app)
+            if not self.feeds[record_data.app].add(record_data.timestamp, record_data):
+                continue
+
+            self.__check_daily_average(record_data, dust_level(record_data))
+            self.num_of_records += 1
+            loaded += 1
+        return loaded
+
+    def add_record(
+        self,
+        project: str,
+        timestamp: str,
+        record: DeviceRecord,
+        replayed: bool = False,
+    ):
+        # A reading replayed from what the leader shared is stored and
+        # spilled by the leader, not by this worker.
         datetime_object_from_string = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
         datetime_object_from_string = datetime_object_from_string.replace(
             tzinfo=timezone.utc
         )
 
+        # Checked before anything is stored. A reading without s_d0 is kept
+        # in the feed but left out of the figures derived from s_d0.
+        value = dust_level(record)
+
         if project not in self.feeds:
-            self.feeds[project] = {}
+            self.feeds[project] = FeedStore(project)
 
-        if datetime_object_from_string not in self.feeds[project]:
-            self.__check_danger_threshold(record)
-            self.__check_daily_average(record)
-            self.feeds[project][datetime_object_from_string] = record
+        if self.feeds[project].add(datetime_object_from_string, record):
+            crossed = self.__check_danger_threshold(record, value)
+            self.__check_daily_average(record, value)
+            self._rolling.add(to_epoch(datetime_object_from_string), value)
 
-            if REDIS:
-                record.save()
+            if STORAGE is not None and not replayed:
+                if self._writer is not None:
+                    self._writer.put(record)
+                else:
+                    try:
+                        with STORAGE_WRITE_SECONDS.time(STORAGE.name):
+                            STORAGE.append([record])
+                        STORAGE_RECORDS.inc(STORAGE.name, "written")
+                    except StorageError as e:
+                        STORAGE_RECORDS.inc(STORAGE.name, "failed")
+                        log.error(f"Failed to save {self.device_id}: {e}")
 
             self.version = timestamp
             self.num_of_records += 1
+            if not replayed:
+                self.feeds[project].retain()
+            if self._broadcaster is not None and self._broadcaster.listening(
+                self.device_id
+            ):
+                self._broadcaster.publish(
+                    self.device_id, "reading", self.delta(project, record, crossed)
+                )
+            RECORDS.inc(project, "added")
             return True
+        RECORDS.inc(project, "duplicate")
         return False
 
-    def __check_danger_threshold(self, record: DeviceRecord):
-        if float(record.s_d0) > PM_DANGER_THRESHOLD:
-            self.danger_threshold_instances.append(record.timestamp)
-
-    def __check_daily_average(self, record: DeviceRecord):
-        date = record.timestamp.date()
-        if date in self.daily_metrics.keys():
-            # Recalculate average
-            total_sum_old_values = (
-                self.daily_metrics[date].avg * self.daily_metrics[date].count
+    def extend(
+        self,
+        project: str,
+        timestamps: list[str],
+        epochs: list[int],
+        readings: list[dict],
+    ) -> bool:
+        # Adds validated readings in one go, leaving the same state as
+        # add_record would. Returns False, adding nothing, unless the epochs
+        # are sorted and newer than the feed's, and nobody listens live.
+        if not readings:
+            return True
+        if self._broadcaster is not None and self._broadcaster.listening(
+            self.device_id
+        ):
+            return False
+        if any(reading.get("timestamp") is None for reading in readings):
+            return False
+        rows = [
+            (
+                epoch,
+                *(
+                    NAN if reading.get(name) is None else float(reading[name])
+                    for name in COLUMNS
+                ),
             )
-            total_sum_new_values = total_sum_old_values + record.s_d0
-            self.daily_metrics[date].count += 1
+            for epoch, reading in zip(epochs, readings)
+        ]
+        if project not in self.feeds:
+            self.feeds[project] = FeedStore(project)
+        device_ids = (reading.get("device_id") for reading in reversed(readings))
+        device_id = next((found for found in device_ids if found is not None), None)
+        if not self.feeds[project].extend(rows, readings[0].get("app"), device_id):
+            return False
 
-            self.daily_metrics[date].avg = round(
-                total_sum_new_values / self.daily_metrics[date].count, 1
-            )
+        day = None
+        values = []
+        for row in rows:
+            epoch, value = row[0], row[S_D0]
+            if value != value:
+                continue
+            for index in self.danger.values():
+                index.add(epoch, value)
+            date = self._days.date(epoch)
+            if date != day:
+                if values:
+                    self.__add_daily_metrics(day, values)
+                day = date
+                values = []
+            values.append(value)
+        if values:
+            self.__add_daily_metrics(day, values)
+        self._rolling.extend(rows)
 
-            # Recalculate max value
-            if self.daily_metrics[date].max < record.s_d0:
-                self.daily_metrics[date].max = record.s_d0
+        if STORAGE is not None:
+            create_pk = DeviceRecord._meta.primary_key_creator_cls().create_pk
+            records = [
+                DeviceRecord.model_construct(pk=create_pk(), **reading)
+                for reading in readings
+            ]
+            if self._writer is not None:
+                for record in records:
+                    self._writer.put(record)
+            else:
+                try:
+                    with STORAGE_WRITE_SECONDS.time(STORAGE.name):
+                        STORAGE.append(records)
+                    STORAGE_RECORDS.inc(STORAGE.name, "written", amount=len(records))
+                except StorageError as e:
+                    STORAGE_RECORDS.inc(STORAGE.name, "failed", amount=len(records))
+                    log.error(f"Failed to save {self.device_id}: {e}")
 
-            # Recalculate min value
-            if self.daily_metrics[date].min > record.s_d0:
-                self.daily_metrics[date].min = record.s_d0
-        else:
-            metrics = DailyMetrics(
-                **{
-                    "max": record.s_d0,
-                    "min": record.s_d0,
-                    "avg": record.s_d0,
-                    "count": 1,
+        self.version = timestamps[-1]
+        self.num_of_records += len(readings)
+        self.feeds[project].retain()
+        RECORDS.inc(project, "added", amount=len(readings))
+        return True
+
+    def freeze(self, previous: Optional["DeviceHistory"] = None) -> "DeviceHistory":
+        # A consistent copy for readers that the writer never touches again.
+        # Feed chunks and sealed rollup blocks are shared, and so are the daily
+        # metrics unchanged since previous, the last view of this history.
+        changed, self._changed_days = self._changed_days, set()
+        daily_metrics = {}
+        for day, metrics in self.daily_metrics.items():
+            if previous is None or day in changed or day not in previous.daily_metrics:
+                metrics = metrics.freeze()
+            else:
+                metrics = previous.daily_metrics[day]
+            daily_metrics[day] = metrics
+        view = DeviceHistory.model_construct(
+            source=self.source,
+            device_id=self.device_id,
+            version=self.version,
+            num_of_records=self.num_of_records,
+            feeds={
+                project: records.freeze() for project, records in self.feeds.items()
+            },
+            danger={name: index.freeze() for name, index in self.danger.items()},
+            daily_metrics=daily_metrics,
+        )
+        view._revision = 1 if previous is None else previous._revision + 1
+        view._rolling = self._rolling.freeze()
+        view._days = self._days
+        return view
+
+    def index_rolling(self):
+        # The rolling windows from the newest readings of the feeds, after
+        # they were restored.
+        self._rolling = RollingEngine()
+        newest = [records.last() for records in self.feeds.values()]
+        newest = max((epoch for epoch in newest if epoch is not None), default=None)
+        if newest is None:
+            return
+        start = newest - self._rolling.longest + 1
+        rows = heapq.merge(
+            *(records.range(start, None) for records in self.feeds.values()),
+            key=lambda row: row[0],
+        )
+        self._rolling.extend(list(rows))
+
+    def rolling(self) -> dict[str, RollingValue]:
+        return self._rolling.summary()
+
+    def settings(self) -> str:
+        # The thresholds and timezone the danger episodes and daily metrics
+        # were built with.
+        thresholds = ",".join(
+            f"{name}={index.threshold:g}" for name, index in self.danger.items()
+        )
+        return f"{thresholds};{self._days.name}"
+
+    def replace_derived(
+        self,
+        danger: dict[str, DangerIndex],
+        daily_metrics: dict[date, DailyMetrics],
+        days: Days,
+    ):
+        # Swaps in danger episodes and daily metrics recomputed from the
+        # feeds. Every day is frozen again for the next view.
+        self.danger = danger
+        self.daily_metrics = daily_metrics
+        self._days = days
+        self._changed_days = set(daily_metrics)
+
+    def __index_danger(self):
+        # Records may come back from storage in no particular order, so the
+        # episodes are rebuilt from the sorted feeds.
+        self.danger = {
+            name: DangerIndex(index.threshold, index.days)
+            for name, index in self.danger.items()
+        }
+        rows = heapq.merge(
+            *(records.range() for records in self.feeds.values()),
+            key=lambda row: row[0],
+        )
+        for row in rows:
+            for index in self.danger.values():
+                index.add(row[0], row[3])
+
+    def delta(self, project: str, record: DeviceRecord, crossed: set[str]) -> dict:
+        # What a live subscriber needs to apply a new reading to a rendered page.
+        epoch = to_epoch(record.timestamp)
+        date = self._days.date(epoch)
+        day = self._days.start(epoch)
+        value = dust_level(record)
+        # None until the day has a reading with s_d0.
+        summary = None
+        if date in self.daily_metrics:
+            summary = {
+                "date": date.isoformat(),
+                **self.daily_metrics[date].model_dump(include=DELTA_METRICS),
+            }
+        return {
+            "project": project,
+            "version": self.version,
+            "num_of_records": self.num_of_records,
+            "reading": {
+                "timestamp": record.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "device_id": record.device_id,
+                **{name: getattr(record, name) for name in COLUMNS},
+            },
+            "metrics": summary,
+            "rolling": {
+                name: value.model_dump(include={"count", "avg", "min", "max"})
+                for name, value in self.rolling().items()
+            },
+            "danger": {
+                name: {
+                    "threshold": index.threshold,
+                    "above": value > index.threshold,
+                    "crossed": name in crossed,
+                    "count": index.exceedances["day"].get(day, 0),
                 }
-            )
+                for name, index in self.danger.items()
+                if name in crossed or value > index.threshold
+            },
+        }
+
+    def __check_danger_threshold(self, record: DeviceRecord, value: float) -> set[str]:
+        # Returns the thresholds whose episode the reading opened or closed.
+        epoch = to_epoch(record.timestamp)
+        crossed = set()
+        for name, index in self.danger.items():
+            was_open = index.open
+            index.add(epoch, value)
+            if index.open != was_open:
+                crossed.add(name)
+        return crossed
 
-            self.daily_metrics[date] = metrics
+    def __check_daily_average(self, record: DeviceRecord, value: float):
+        if value != value:
+            return
+        self.__add_daily_metric(self._days.date(to_epoch(record.timestamp)), value)
+
+    def __add_daily_metric(self, date: date, value: float):
+        self.__add_daily_metrics(date, [value])
+
+    def __add_daily_metrics(self, date: date, values: list[float]):
+        if date not in self.daily_metrics.keys():
+            if self.daily_metrics:
+                # Earlier days rarely change again, so their buffers are folded.
+                last = next(reversed(self.daily_metrics))
+                self.daily_metrics[last]._digest.compress()
+                self._changed_days.add(last)
+            self.daily_metrics[date] = DailyMetrics.empty()
+        self._changed_days.add(date)
+        if len(values) == 1:
+            self.daily_metrics[date].add(values[0])
+        else:
+            self.daily_metrics[date].extend(values)
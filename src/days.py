@@ -0,0 +1,65 @@
+import os
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from zoneinfo import ZoneInfo
+
+# The timezone whose days the daily metrics and danger counts are kept in.
+DAY_TIMEZONE = str(os.getenv("DAY_TIMEZONE", default="UTC"))
+EPOCH_DAY = date(1970, 1, 1).toordinal()
+
+
+def parse_timezone(name: str) -> tzinfo:
+    # UTC, an offset such as +08:00, or a name such as Asia/Taipei. Raises
+    # ValueError for anything else.
+    name = name.strip()
+    if name.upper() in ("", "UTC", "Z"):
+        return timezone.utc
+    if name[0] in "+-":
+        hours, _, minutes = name[1:].partition(":")
+        offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+        return timezone(-offset if name[0] == "-" else offset)
+    try:
+        return ZoneInfo(name)
+    except (KeyError, OSError) as e:
+        raise ValueError(f"Unknown timezone {name}") from e
+
+
+class Days:
+    # The days of a timezone, as epochs. Offsets are looked up per reading,
+    # unless the zone has a fixed one, so daylight saving time is followed.
+    __slots__ = ("name", "zone", "fixed")
+
+    def __init__(self, name: str = DAY_TIMEZONE):
+        self.zone = parse_timezone(name)
+        self.name = "UTC" if self.zone is timezone.utc else name.strip()
+        self.fixed = None
+        if isinstance(self.zone, timezone):
+            self.fixed = int(self.zone.utcoffset(None).total_seconds())
+
+    def offset(self, epoch: int) -> int:
+        if self.fixed is not None:
+            return self.fixed
+        return int(datetime.fromtimestamp(epoch, self.zone).utcoffset().total_seconds())
+
+    def date(self, epoch: int) -> date:
+        return date.fromordinal(EPOCH_DAY + (epoch + self.offset(epoch)) // 86400)
+
+    def start(self, epoch: int, resolution: int = 86400) -> int:
+        # The epoch the local hour or day holding epoch starts at.
+        return epoch - (epoch + self.offset(epoch)) % resolution
+
+    def today(self) -> int:
+        return self.start(int(datetime.now(timezone.utc).timestamp()))
+
+
+DAYS = Days(DAY_TIMEZONE)
+
+
+def current_days() -> Days:
+    return DAYS
+
+
+def use_days(days: Days):
+    # New histories and the dashboard follow, existing histories keep theirs
+    # until they are recomputed.
+    global DAYS
+    DAYS = days
@@ -0,0 +1,70 @@
+import os
+import csv
+import io
+import json
+import time
+import asyncio
+from typing import AsyncIterator, Optional
+
+from src.data import DeviceHistory
+from src.store import COLUMNS, to_value
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", default=1000))
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def format_ndjson(project: str, rows: list[tuple], indexes: list[int]) -> str:
+    names = [COLUMNS[i] for i in indexes]
+    return "".join(
+        json.dumps(
+            {
+                "project": project,
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(row[0])),
+                **{name: to_value(row[i + 1]) for name, i in zip(names, indexes)},
+            }
+        )
+        + "\n"
+        for row in rows
+    )
+
+
+def format_csv(project: str, rows: list[tuple], indexes: list[int]) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerows(
+        (
+            project,
+            time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(row[0])),
+            *("" if to_value(row[i + 1]) is None else row[i + 1] for i in indexes),
+        )
+        for row in rows
+    )
+    return buffer.getvalue()
+
+
+async def export_rows(
+    history: DeviceHistory,
+    format: str = "ndjson",
+    projects: Optional[list[str]] = None,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    columns: Optional[list[str]] = None,
+    batch_size: int = EXPORT_BATCH_SIZE,
+) -> AsyncIterator[str]:
+    indexes = [COLUMNS.index(name) for name in columns or COLUMNS]
+    formatter = format_csv if format == "csv" else format_ndjson
+    if format == "csv":
+        yield ",".join(["project", "timestamp", *(COLUMNS[i] for i in indexes)]) + "\n"
+
+    for project in projects or list(history.feeds.keys()):
+        rows = []
+        # Chunks are immutable, so readings added while the export runs do not
+        # disturb the rows already being read.
+        for row in history.feeds[project].range(start, end):
+            rows.append(row)
+            if len(rows) >= batch_size:
+                yield formatter(project, rows, indexes)
+                rows = []
+                await asyncio.sleep(0)
+        if rows:
+            yield formatter(project, rows, indexes)
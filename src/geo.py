@@ -0,0 +1,284 @@
+import os
+import math
+import heapq
+import threading
+from datetime import date, datetime
+from typing import Iterable, Iterator, Optional
+from pydantic import BaseModel
+
+from src.data import DailyMetrics, DeviceHistory
+from src.store import COLUMNS, from_epoch, to_value
+
+GEO_CELL_SIZE = float(os.getenv("GEO_CELL_SIZE", default=0.05))
+GEO_NEAREST = int(os.getenv("GEO_NEAREST", default=10))
+GEO_MAX_RESULTS = int(os.getenv("GEO_MAX_RESULTS", default=1000))
+EARTH_RADIUS = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+S_D0 = COLUMNS.index("s_d0") + 1
+GPS_LAT = COLUMNS.index("gps_lat") + 1
+GPS_LON = COLUMNS.index("gps_lon") + 1
+
+
+class NearbyDevice(BaseModel):
+    device_id: str
+    gps_lat: float
+    gps_lon: float
+    distance_km: Optional[float] = None
+    timestamp: Optional[datetime] = None
+    s_d0: Optional[float] = None
+    day: Optional[date] = None
+    metrics: Optional[DailyMetrics] = None
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    # Great circle distance in km.
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (
+        math.sin((phi2 - phi1) / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Position:
+    __slots__ = ("device_id", "lat", "lon", "epoch", "s_d0")
+
+    def __init__(self, device_id: str, lat: float, lon: float, epoch: int, s_d0: float):
+        self.device_id = device_id
+        self.lat = lat
+        self.lon = lon
+        self.epoch = epoch
+        self.s_d0 = s_d0
+
+
+class SpatialIndex:
+    # The latest position of every device, in a grid of cells cell_size
+    # degrees wide, so a query looks at the cells around a point instead of
+    # at every device. Updated by the ingest thread and read on the event
+    # loop, hence the lock.
+    def __init__(self, cell_size: float = GEO_CELL_SIZE):
+        self.cell_size = cell_size
+        self.rows = max(1, math.ceil(180 / cell_size))
+        self.columns = max(1, round(360 / cell_size))
+        self.positions: dict[str, Position] = {}
+        self.cells: dict[tuple[int, int], set[str]] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def cell(self, lat: float, lon: float) -> tuple[int, int]:
+        row = min(max(int((lat + 90) // self.cell_size), 0), self.rows - 1)
+        return row, int((lon + 180) // self.cell_size) % self.columns
+
+    def update(
+        self, device_id: str, lat: float, lon: float, epoch: int, s_d0: float = math.nan
+    ):
+        cell = self.cell(lat, lon)
+        with self.lock:
+            previous = self.positions.get(device_id)
+            if previous is not None:
+                self._unlink(self.cell(previous.lat, previous.lon), device_id)
+            self.positions[device_id] = Position(device_id, lat, lon, epoch, s_d0)
+            self.cells.setdefault(cell, set()).add(device_id)
+
+    def remove(self, device_id: str):
+        with self.lock:
+            previous = self.positions.pop(device_id, None)
+            if previous is not None:
+                self._unlink(self.cell(previous.lat, previous.lon), device_id)
+
+    def _unlink(self, cell: tuple[int, int], device_id: str):
+        devices = self.cells.get(cell)
+        if devices is not None:
+            devices.discard(device_id)
+            if not devices:
+                del self.cells[cell]
+
+    def observe(self, view: DeviceHistory):
+        # The newest reading of any project gives the current s_d0, and the
+        # position unless it has none, then the last known one stays.
+        newest = None
+        for records in view.feeds.values():
+            rows = records.tail(1)
+            if rows and (newest is None or rows[0][0] > newest[0]):
+                newest = rows[0]
+        if newest is None:
+            return
+        lat, lon = newest[GPS_LAT], newest[GPS_LON]
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            previous = self.positions.get(view.device_id)
+            if previous is None:
+                return
+            lat, lon = previous.lat, previous.lon
+        self.update(view.device_id, lat, lon, newest[0], newest[S_D0])
+
+    def _box_cells(
+        self, south: float, west: float, north: float, east: float
+    ) -> Optional[Iterator[tuple[int, int]]]:
+        # The cells overlapping a box, or None when there are more of them
+        # than occupied cells and those are better scanned. A box with west
+        # east of east crosses the antimeridian.
+        first_row, first_column = self.cell(south, west)
+        last_row = self.cell(north, east)[0]
+        spread = east - west if west <= east else east - west + 360
+        columns = min(
+            int((west + 180 + spread) // self.cell_size)
+            - int((west + 180) // self.cell_size)
+            + 1,
+            self.columns,
+        )
+        if (last_row - first_row + 1) * columns > len(self.cells):
+            return None
+        return (
+            (row, (first_column + column) % self.columns)
+            for row in range(first_row, last_row + 1)
+            for column in range(columns)
+        )
+
+    def _candidates(
+        self, south: float, west: float, north: float, east: float
+    ) -> Iterator[Position]:
+        cells = self._box_cells(south, west, north, east)
+        if cells is None:
+            for devices in self.cells.values():
+                for device_id in devices:
+                    yield self.positions[device_id]
+            return
+        for cell in cells:
+            for device_id in self.cells.get(cell, ()):
+                yield self.positions[device_id]
+
+    def within_box(
+        self, south: float, west: float, north: float, east: float
+    ) -> list[Position]:
+        with self.lock:
+            return sorted(
+                (
+                    position
+                    for position in self._candidates(south, west, north, east)
+                    if south <= position.lat <= north
+                    and (
+                        west <= position.lon <= east
+                        if west <= east
+                        else position.lon >= west or position.lon <= east
+                    )
+                ),
+                key=lambda position: position.device_id,
+            )
+
+    def within_radius(
+        self, lat: float, lon: float, radius: float
+    ) -> list[tuple[float, Position]]:
+        # The box around the circle, then the exact distance.
+        angle = radius / EARTH_RADIUS
+        delta = math.degrees(angle)
+        south, north = lat - delta, lat + delta
+        west, east = -180.0, 180.0
+        if south > -90 and north < 90 and angle < math.pi / 2:
+            reach = math.sin(angle) / math.cos(math.radians(lat))
+            if reach < 1:
+                spread = math.degrees(math.asin(reach))
+                west = (lon - spread + 180) % 360 - 180
+                east = (lon + spread + 180) % 360 - 180
+        south, north = max(south, -90.0), min(north, 90.0)
+        with self.lock:
+            found = []
+            for position in self._candidates(south, west, north, east):
+                km = distance(lat, lon, position.lat, position.lon)
+                if km <= radius:
+                    found.append((km, position))
+        found.sort(key=lambda item: (item[0], item[1].device_id))
+        return found
+
+    def nearest(self, lat: float, lon: float, k: int) -> list[tuple[float, Position]]:
+        # Rings of cells around the point's cell, until the k nearest found
+        # are closer than any cell left. Once the rings hold more cells than
+        # are occupied, the occupied ones are scanned instead.
+        row, column = self.cell(lat, lon)
+        with self.lock:
+            found = []
+            seen = set()
+            occupied = 0
+            scanned = 0
+            ring = 0
+            while occupied < len(self.cells):
+                if scanned > len(self.cells):
+                    found = [
+                        (distance(lat, lon, p.lat, p.lon), p)
+                        for p in self.positions.values()
+                    ]
+                    break
+                for cell in self._ring(row, column, ring):
+                    if cell in seen:
+                        continue
+                    seen.add(cell)
+                    scanned += 1
+                    devices = self.cells.get(cell)
+                    if devices is None:
+                        continue
+                    occupied += 1
+                    for device_id in devices:
+                        position = self.positions[device_id]
+                        found.append(
+                            (distance(lat, lon, position.lat, position.lon), position)
+                        )
+                if len(found) >= k:
+                    kth = heapq.nsmallest(k, found, key=lambda item: item[0])[-1][0]
+                    if kth <= self._gap(lat, ring):
+                        break
+                ring += 1
+        return heapq.nsmallest(k, found, key=lambda item: (item[0], item[1].device_id))
+
+    def _ring(self, row: int, column: int, ring: int) -> Iterable[tuple[int, int]]:
+        if ring == 0:
+            return [(row, column)]
+        cells = []
+        for offset in range(-ring, ring + 1):
+            for r in (row - ring, row + ring):
+                if 0 <= r < self.rows:
+                    cells.append((r, (column + offset) % self.columns))
+            if abs(offset) < ring:
+                r = row + offset
+                if 0 <= r < self.rows:
+                    cells.append((r, (column - ring) % self.columns))
+                    cells.append((r, (column + ring) % self.columns))
+        return cells
+
+    def _gap(self, lat: float, ring: int) -> float:
+        # The shortest distance from the point to a cell outside the rings
+        # searched: ring cells away north or south, or as many degrees of
+        # longitude east or west.
+        degrees = ring * self.cell_size
+        north_south = degrees * KM_PER_DEGREE
+        if degrees >= 90:
+            # Those cells are nearest at a pole.
+            return min(north_south, (90 - abs(lat)) * KM_PER_DEGREE)
+        east_west = EARTH_RADIUS * math.asin(
+            math.cos(math.radians(lat)) * math.sin(math.radians(degrees))
+        )
+        return min(north_south, east_west)
+
+
+def nearby(
+    found: Iterable[tuple[Optional[float], Position]],
+    views: dict[str, DeviceHistory],
+) -> list[NearbyDevice]:
+    # The current reading of each device found, and its latest daily metrics.
+    devices = []
+    for km, position in found:
+        view = views.get(position.device_id)
+        day = max(view.daily_metrics) if view and view.daily_metrics else None
+        devices.append(
+            NearbyDevice(
+                device_id=position.device_id,
+                gps_lat=position.lat,
+                gps_lon=position.lon,
+                distance_km=None if km is None else round(km, 3),
+                timestamp=from_epoch(position.epoch),
+                s_d0=to_value(position.s_d0),
+                day=day,
+                metrics=None if day is None else view.daily_metrics[day],
+            )
+        )
+    return devices
@@ -1,43 +1,75 @@
-from datetime import datetime
+import os
+import json
+import time
+from collections import deque
+from datetime import date
+from typing import Optional
 from fastapi.responses import HTMLResponse
 from src.data import DeviceHistory
+from src.danger import DANGER_THRESHOLDS
+from src.days import Days, current_days
+from src.store import FeedStore, to_value
+from src.rollup import lttb
+from src.telemetry import RENDER_SECONDS
 
+DASHBOARD_FEED_ROWS = int(os.getenv("DASHBOARD_FEED_ROWS", default=500))
+DASHBOARD_CHART_POINTS = int(os.getenv("DASHBOARD_CHART_POINTS", default=500))
 
-def get_todays_data(data: DeviceHistory):
-    today_date = datetime.today().strftime("%Y-%m-%d")
 
+def today_start(days: Optional[Days] = None) -> int:
+    return (days or current_days()).today()
+
+
+def series_data(rows) -> dict[str, list]:
     timestamps = []
     temperatures = []
     humidities = []
     dust_levels = []
 
-    for feed_type, records in data.feeds.items():
-        for record in records.values():
-            record_time = record.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-            if today_date in record_time:
-                timestamps.append(record_time)
-                temperatures.append(record.s_t0)
-                humidities.append(record.s_h0)
-                dust_levels.append(record.s_d0)
-
-    recent_data = {
+    for row in rows:
+        timestamps.append(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(row[0])))
+        temperatures.append(to_value(row[1]))
+        humidities.append(to_value(row[2]))
+        dust_levels.append(to_value(row[3]))
+
+    return {
         "timestamps": timestamps,
         "temperatures": temperatures,
         "humidities": humidities,
         "dust_levels": dust_levels,
     }
 
+
+def get_todays_data(data: DeviceHistory):
+    start = today_start(data._days)
+    recent_data = series_data([])
+    for feed_type, records in data.feeds.items():
+        for name, values in series_data(records.range(start)).items():
+            recent_data[name].extend(values)
     return recent_data
 
 
-def generate_html(data: DeviceHistory) -> HTMLResponse:
-    recent_data = get_todays_data(data)
+def render_feed_row(records: FeedStore, row: tuple) -> str:
+    return f"""
+            <tr>
+                <td>{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(row[0]))}</td>
+                <td>{records.device_id}</td>
+                <td>{to_value(row[1])}</td>
+                <td>{to_value(row[2])}</td>
+                <td>{to_value(row[3])}</td>
+                <td>{to_value(row[4])}</td>
+                <td>{to_value(row[5])}</td>
+            </tr>
+            """
 
-    feeds_html = ""
-    for feed_type, records in data.feeds.items():
-        feeds_html += f"<h3>{feed_type}</h3>"
-        feeds_html += f"""
-        <table class="data-table">
+
+def render_feed_table(feed_type: str, records: FeedStore, rows: list[str]) -> str:
+    return (
+        f"<h3>{feed_type}</h3>"
+        f'<p>Showing the latest <span class="feed-shown">{len(rows)}</span> of'
+        f' <span class="feed-total">{len(records)}</span> readings</p>'
+        f'<table class="data-table" data-project="{feed_type}">'
+        + """
             <thead>
                 <tr>
                     <th>Timestamp</th>
@@ -51,48 +83,39 @@ def generate_html(data: DeviceHistory) -> HTMLResponse:
             </thead>
             <tbody>
         """
-        for record in records.values():
-            feeds_html += f"""
-            <tr>
-                <td>{record.timestamp.strftime('%Y-%m-%d %H:%M:%S')}</td>
-                <td>{record.device_id}</td>
-                <td>{record.s_t0}</td>
-                <td>{record.s_h0}</td>
-                <td>{record.s_d0}</td>
-                <td>{record.gps_lat}</td>
-                <td>{record.gps_lon}</td>
-            </tr>
-            """
-        feeds_html += """
+        + "".join(rows)
+        + """
             </tbody>
         </table>
         """
+    )
 
-    danger_counts = {}
-    for instance in data.danger_threshold_instances:
-        date = instance.strftime("%Y-%m-%d")
-        if date in danger_counts:
-            danger_counts[date] += 1
-        else:
-            danger_counts[date] = 1
 
-    danger_thresholds = {
-        "dates": list(danger_counts.keys()),
-        "counts": list(danger_counts.values()),
-    }
-
-    metrics_html = ""
-    for metric_date, metrics in data.daily_metrics.items():
-        metrics_html += f"""
-        <tr>
+def render_metrics_row(metric_date: date, metrics) -> str:
+    return f"""
+        <tr data-date="{metric_date}">
             <td>{metric_date}</td>
             <td>{metrics.max}</td>
             <td>{metrics.min}</td>
             <td>{metrics.avg}</td>
+            <td>{metrics.std}</td>
+            <td>{metrics.p50}</td>
+            <td>{metrics.p95}</td>
+            <td>{metrics.p99}</td>
             <td>{metrics.count}</td>
         </tr>
         """
 
+
+def render_page(
+    data: DeviceHistory,
+    recent_data: dict,
+    danger_thresholds: dict,
+    feeds_html: str,
+    metrics_html: str,
+    feed_rows: int = DASHBOARD_FEED_ROWS,
+    chart_points: int = DASHBOARD_CHART_POINTS,
+) -> str:
     html_content = f"""
     <!DOCTYPE html>
     <html lang="en">
@@ -201,22 +224,22 @@ def generate_html(data: DeviceHistory) -> HTMLResponse:
                 var dataChart = new Chart(ctx, {{
                     type: 'line',
                     data: {{
-                        labels: {recent_data['timestamps']}, 
+                        labels: {json.dumps(recent_data['timestamps'])}, 
                         datasets: [{{
                             label: 'Temperature',
-                            data: {recent_data['temperatures']}, 
+                            data: {json.dumps(recent_data['temperatures'])}, 
                             borderColor: 'rgba(255, 99, 132, 1)',
                             borderWidth: 1
                         }},
                         {{
                             label: 'Humidity',
-                            data: {recent_data['humidities']}, 
+                            data: {json.dumps(recent_data['humidities'])}, 
                             borderColor: 'rgba(54, 162, 235, 1)',
                             borderWidth: 1
                         }},
                         {{
                             label: 'Dust',
-                            data: {recent_data['dust_levels']}, 
+                            data: {json.dumps(recent_data['dust_levels'])}, 
                             borderColor: 'rgba(75, 192, 192, 1)',
                             borderWidth: 1
                         }}]
@@ -247,10 +270,10 @@ def generate_html(data: DeviceHistory) -> HTMLResponse:
                 var dangerChart = new Chart(ctxDanger, {{
                     type: 'bar',
                     data: {{
-                        labels: {danger_thresholds['dates']},
+                        labels: {json.dumps(danger_thresholds['dates'])},
                         datasets: [{{
                             label: 'Danger Threshold Instances',
-                            data: {danger_thresholds['counts']},
+                            data: {json.dumps(danger_thresholds['counts'])},
                             backgroundColor: 'rgba(255, 99, 132, 0.5)',
                             borderColor: 'rgba(255, 99, 132, 1)',
                             borderWidth: 1
@@ -277,6 +300,92 @@ def generate_html(data: DeviceHistory) -> HTMLResponse:
                         }}
                     }}
                 }});
+
+                // New readings arrive as deltas and are applied in place.
+                var feedRows = {feed_rows};
+                var chartPoints = {chart_points};
+                var dangerName = {json.dumps(next(iter(DANGER_THRESHOLDS)))};
+                var metricNames = ['max', 'min', 'avg', 'std', 'p50', 'p95', 'p99', 'count'];
+                function cell(value) {{
+                    return '<td>' + (value === null ? 'None' : value) + '</td>';
+                }}
+                var connected = false;
+                var source = new EventSource('live');
+                source.addEventListener('open', function () {{
+                    // Deltas missed while disconnected are picked up by a reload.
+                    if (connected) {{
+                        window.location.reload();
+                    }}
+                    connected = true;
+                }});
+                // Recomputed danger episodes and metrics are rendered anew.
+                source.addEventListener('settings', function () {{
+                    window.location.reload();
+                }});
+                // So are readings filled in behind the live ones.
+                source.addEventListener('backfill', function () {{
+                    window.location.reload();
+                }});
+                source.addEventListener('reading', function (event) {{
+                    var delta = JSON.parse(event.data);
+                    var reading = delta.reading;
+                    var time = reading.timestamp.replace('T', ' ').replace('Z', '');
+                    document.getElementById('version').textContent = delta.version;
+                    document.getElementById('numOfRecords').textContent = delta.num_of_records;
+
+                    var values = [reading.s_t0, reading.s_h0, reading.s_d0];
+                    dataChart.data.labels.push(time);
+                    dataChart.data.datasets.forEach(function (dataset, i) {{
+                        dataset.data.push(values[i]);
+                    }});
+                    if (dataChart.data.labels.length > chartPoints) {{
+                        dataChart.data.labels.shift();
+                        dataChart.data.datasets.forEach(function (dataset) {{
+                            dataset.data.shift();
+                        }});
+                    }}
+                    dataChart.update('none');
+
+                    var table = document.querySelector('table[data-project="' + CSS.escape(delta.project) + '"]');
+                    if (table) {{
+                        var rows = table.tBodies[0];
+                        rows.insertAdjacentHTML('beforeend', '<tr>' + cell(time) + cell(reading.device_id)
+                            + ['s_t0', 's_h0', 's_d0', 'gps_lat', 'gps_lon'].map(function (name) {{
+                                return cell(reading[name]);
+                            }}).join('') + '</tr>');
+                        if (rows.rows.length > feedRows) {{
+                            rows.deleteRow(0);
+                        }}
+                        var total = table.previousElementSibling.querySelector('.feed-total');
+                        table.previousElementSibling.querySelector('.feed-shown').textContent = rows.rows.length;
+                        total.textContent = Number(total.textContent) + 1;
+                    }}
+
+                    var metrics = delta.metrics;
+                    if (!metrics) {{
+                        return;
+                    }}
+                    var row = document.querySelector('tr[data-date="' + metrics.date + '"]');
+                    if (!row) {{
+                        row = document.querySelector('.metrics-table tbody').insertRow(-1);
+                        row.dataset.date = metrics.date;
+                    }}
+                    row.innerHTML = cell(metrics.date) + metricNames.map(function (name) {{
+                        return cell(metrics[name]);
+                    }}).join('');
+
+                    var danger = delta.danger[dangerName];
+                    if (danger && danger.above) {{
+                        var index = dangerChart.data.labels.indexOf(metrics.date);
+                        if (index < 0) {{
+                            dangerChart.data.labels.push(metrics.date);
+                            dangerChart.data.datasets[0].data.push(danger.count);
+                        }} else {{
+                            dangerChart.data.datasets[0].data[index] = danger.count;
+                        }}
+                        dangerChart.update('none');
+                    }}
+                }});
             }});
         </script>
     </head>
@@ -300,10 +409,10 @@ def generate_html(data: DeviceHistory) -> HTMLResponse:
                         <p><strong>Device ID:</strong> {data.device_id}</p>
                     </div>
                     <div class="card">
-                        <p><strong>Last Updated:</strong> {data.version}</p>
+                        <p><strong>Last Updated:</strong> <span id="version">{data.version}</span></p>
                     </div>
                     <div class="card">
-                        <p><strong>Number of Records:</strong> {data.num_of_records}</p>
+                        <p><strong>Number of Records:</strong> <span id="numOfRecords">{data.num_of_records}</span></p>
                     </div>
                 </div>
             </div>
@@ -333,6 +442,10 @@ def generate_html(data: DeviceHistory) -> HTMLResponse:
                             <th>Max</th>
                             <th>Min</th>
                             <th>Avg</th>
+                            <th>Std</th>
+                            <th>P50</th>
+                            <th>P95</th>
+                            <th>P99</th>
                             <th>Count</th>
                         </tr>
                     </thead>
@@ -345,4 +458,126 @@ def generate_html(data: DeviceHistory) -> HTMLResponse:
     </body>
     </html>
     """
-    return HTMLResponse(content=html_content, status_code=200)
+
+    return html_content
+
+
+class FeedFragment:
+    # Rendered state of one feed: the newest table rows and today's chart series.
+    def __init__(self, size: int):
+        self.length = 0
+        self.last: Optional[int] = None
+        self.rows: deque[str] = deque(maxlen=size)
+        self.day: Optional[int] = None
+        self.series = series_data([])
+
+    def update(self, records: FeedStore, day: int):
+        added = len(records) - self.length
+        if added == 0:
+            if day != self.day:
+                self.series = series_data(records.range(day))
+                self.day = day
+            return
+
+        rows = []
+        if self.last is not None and 0 < added <= self.rows.maxlen:
+            rows = list(records.range(self.last + 1))
+        if len(rows) == added and day == self.day:
+            self.rows.extend(render_feed_row(records, row) for row in rows)
+            for name, values in series_data(
+                row for row in rows if row[0] >= day
+            ).items():
+                self.series[name].extend(values)
+        else:
+            # First render, a large batch, a new day or readings older than the
+            # last one.
+            self.rows.clear()
+            self.rows.extend(
+                render_feed_row(records, row) for row in records.tail(self.rows.maxlen)
+            )
+            self.series = series_data(records.range(day))
+            self.day = day
+        self.length = len(records)
+        self.last = records.last()
+
+
+class Dashboard:
+    def __init__(
+        self,
+        data: DeviceHistory,
+        feed_rows: int = DASHBOARD_FEED_ROWS,
+        chart_points: int = DASHBOARD_CHART_POINTS,
+    ):
+        self.data = data
+        self.feed_rows = feed_rows
+        self.chart_points = chart_points
+        self.key = None
+        self.body = b""
+        self.feeds: dict[str, FeedFragment] = {}
+        self.metric_rows: dict[date, tuple[int, str]] = {}
+
+    def metrics_html(self) -> str:
+        rows = {}
+        for metric_date, metrics in self.data.daily_metrics.items():
+            # Every new reading of a day changes its count.
+            cached = self.metric_rows.get(metric_date)
+            if cached is None or cached[0] != metrics.count:
+                cached = (metrics.count, render_metrics_row(metric_date, metrics))
+            rows[metric_date] = cached
+        self.metric_rows = rows
+        return "".join(row for _, row in rows.values())
+
+    def build(self, day: int) -> str:
+        recent_data = series_data([])
+        feeds_html = ""
+        for feed_type, records in self.data.feeds.items():
+            if feed_type not in self.feeds:
+                self.feeds[feed_type] = FeedFragment(self.feed_rows)
+            fragment = self.feeds[feed_type]
+            fragment.update(records, day)
+            feeds_html += render_feed_table(feed_type, records, fragment.rows)
+            for name, values in fragment.series.items():
+                recent_data[name].extend(values)
+
+        # The chart keeps the points that preserve the shape of the dust series.
+        indexes = lttb(recent_data["dust_levels"], self.chart_points)
+        if len(indexes) < len(recent_data["dust_levels"]):
+            recent_data = {
+                name: [values[index] for index in indexes]
+                for name, values in recent_data.items()
+            }
+
+        counts = sorted(
+            self.data.danger[next(iter(DANGER_THRESHOLDS))].exceedances["day"].items()
+        )
+        danger_thresholds = {
+            "dates": [self.data._days.date(day).isoformat() for day, _ in counts],
+            "counts": [count for _, count in counts],
+        }
+
+        return render_page(
+            self.data,
+            recent_data,
+            danger_thresholds,
+            feeds_html,
+            self.metrics_html(),
+            self.feed_rows,
+            self.chart_points,
+        )
+
+    def render(self) -> HTMLResponse:
+        day = today_start(self.data._days)
+        settings = self.data.settings()
+        key = (self.data.version, self.data.num_of_records, day, settings)
+        if key != self.key:
+            if self.key is not None and self.key[3] != settings:
+                # Recomputed days may have the counts they had before.
+                self.metric_rows = {}
+            with RENDER_SECONDS.time("dashboard"):
+                self.body = self.build(day).encode()
+            self.key = key
+        return HTMLResponse(content=self.body, status_code=200)
+
+
+def generate_html(data: DeviceHistory) -> HTMLResponse:
+    return Dashboard(data).render()
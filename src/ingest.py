@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import calendar
+from functools import lru_cache
+from datetime import datetime, timezone
+from typing import Optional
+from typing_extensions import TypedDict
+from pydantic import TypeAdapter, ValidationError
+
+from src.data import DeviceHistory, DeviceRecord
+from src.store import to_epoch
+from src.telemetry import PARSE_SECONDS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Readings validated per call. A call holds the GIL throughout, so requests
+# get a turn between slices while a large history is ingested.
+INGEST_SLICE_SIZE = int(os.getenv("INGEST_SLICE_SIZE", default=5000))
+
+
+class Reading(TypedDict, total=False):
+    # The fields of DeviceRecord, validated a whole project at a time.
+    app: Optional[str]
+    device_id: Optional[str]
+    s_t0: Optional[float]
+    s_h0: Optional[float]
+    s_d0: Optional[float]
+    gps_lat: Optional[float]
+    gps_lon: Optional[float]
+    timestamp: Optional[datetime]
+
+
+READINGS = TypeAdapter(list[Reading])
+
+
+def loads(data: bytes):
+    # orjson rejects the NaN literals json accepts, those payloads fall back.
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def decode(content: bytes):
+    with PARSE_SECONDS.time("json"):
+        return loads(content)
+
+
+@lru_cache(maxsize=4096)
+def day_epoch(day: str) -> int:
+    return calendar.timegm(datetime.strptime(day, "%Y-%m-%d").timetuple())
+
+
+def parse_epoch(timestamp: str) -> int:
+    # The LASS keys look like 2024-06-01T12:34:56Z. Their date is looked up
+    # and the time of day added, anything else goes through strptime.
+    if (
+        len(timestamp) == 20
+        and timestamp[4] == "-"
+        and timestamp[7] == "-"
+        and timestamp[10] == "T"
+        and timestamp[13] == ":"
+        and timestamp[16] == ":"
+        and timestamp[19] == "Z"
+        and timestamp[11:13].isdigit()
+        and timestamp[14:16].isdigit()
+        and timestamp[17:19].isdigit()
+    ):
+        hours, minutes, seconds = (
+            int(timestamp[11:13]),
+            int(timestamp[14:16]),
+            int(timestamp[17:19]),
+        )
+        if hours < 24 and minutes < 60 and seconds < 60:
+            return day_epoch(timestamp[:10]) + hours * 3600 + minutes * 60 + seconds
+    parsed = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+    return to_epoch(parsed.replace(tzinfo=timezone.utc))
+
+
+def ingest_project(
+    history: DeviceHistory, project: str, entries: list[tuple[str, dict]]
+) -> int:
+    # Validates and adds one project's readings at once. Payloads that would
+    # fail part way or are out of order go through add_record one by one, so
+    # they end the same way as before, without validating them twice.
+    started = time.perf_counter()
+    try:
+        readings = []
+        for lo in range(0, len(entries), INGEST_SLICE_SIZE):
+            readings.extend(
+                READINGS.validate_python(
+                    [reading for _, reading in entries[lo : lo + INGEST_SLICE_SIZE]]
+                )
+            )
+        epochs = [parse_epoch(key) for key, _ in entries]
+    except (ValidationError, ValueError, TypeError):
+        readings = None
+    PARSE_SECONDS.observe(time.perf_counter() - started, "records")
+    keys = [key for key, _ in entries]
+    if readings is not None and history.extend(project, keys, epochs, readings):
+        return len(entries)
+
+    added = 0
+    built = 0.0
+    create_pk = DeviceRecord._meta.primary_key_creator_cls().create_pk
+    try:
+        for i, (key, reading) in enumerate(entries):
+            started = time.perf_counter()
+            if readings is None:
+                record = DeviceRecord(**reading)
+            else:
+                record = DeviceRecord.model_construct(pk=create_pk(), **readings[i])
+            built += time.perf_counter() - started
+            added += history.add_record(project, key, record)
+    finally:
+        PARSE_SECONDS.observe(built, "records")
+    return added
+
+
+def ingest_history(
+    history: DeviceHistory, response_data: dict, since: Optional[str] = None
+) -> int:
+    # Entries up to since are skipped before they are parsed.
+    added = 0
+    for feed in response_data["feeds"]:
+        for project in feed.keys():
+            entries = [
+                (key, entry[key])
+                for entry in feed[project]
+                for key in entry.keys()
+                if since is None or key > since
+            ]
+            added += ingest_project(history, project, entries)
+    return added
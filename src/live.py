@@ -0,0 +1,84 @@
+import os
+import json
+import asyncio
+from typing import AsyncIterator, Optional
+
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", default=256))
+LIVE_KEEPALIVE = float(os.getenv("LIVE_KEEPALIVE", default=15.0))
+
+
+class Broadcaster:
+    # Fans server-sent events out to the subscribers of each device. Every
+    # subscriber has a bounded queue and is dropped when it fills up, so a slow
+    # client neither holds back the others nor buffers without bound.
+    def __init__(self, queue_size: int = LIVE_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.subscribers: dict[str, set[asyncio.Queue]] = {}
+        self.published = 0
+        self.dropped = 0
+        # The loop the subscribers wait on, events published from other
+        # threads are handed to it.
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def listening(self, device_id: Optional[str]) -> bool:
+        return bool(self.subscribers.get(device_id))
+
+    def subscribe(self, device_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        self.subscribers.setdefault(device_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, device_id: str, queue: asyncio.Queue):
+        subscribers = self.subscribers.get(device_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self.subscribers[device_id]
+
+    def send(self, device_id: str, message: str):
+        for queue in list(self.subscribers.get(device_id, ())):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.unsubscribe(device_id, queue)
+                self.dropped += 1
+                # The backlog is discarded and the stream ends, the client
+                # reconnects and starts over from a full page.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def publish(self, device_id: str, event: str, data: dict):
+        # Formatted once and shared by every subscriber.
+        message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self.loop is not None and running is not self.loop:
+            self.loop.call_soon_threadsafe(self.send, device_id, message)
+        else:
+            self.send(device_id, message)
+        self.published += 1
+
+    async def stream(self, device_id: str) -> AsyncIterator[str]:
+        self.loop = asyncio.get_running_loop()
+        queue = self.subscribe(device_id)
+        try:
+            yield ": connected\n\n"
+            while True:
+                message = await queue.get()
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(device_id, queue)
+
+    async def run(self, keepalive: float = LIVE_KEEPALIVE):
+        # Comments keep idle connections from being closed by proxies.
+        self.loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(keepalive)
+            for device_id in list(self.subscribers):
+                self.send(device_id, ": keepalive\n\n")
@@ -0,0 +1,372 @@
+import os
+import asyncio
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+from redis_om import HashModel
+from redis.exceptions import RedisError
+
+from src.store import COLUMNS, from_epoch, to_epoch
+from src.telemetry import STORAGE_RECORDS, STORAGE_WRITE_SECONDS
+
+STORAGE_BACKEND = str(os.getenv("STORAGE_BACKEND", default="redis"))
+SQLITE_PATH = str(os.getenv("SQLITE_PATH", default="records.db"))
+REDIS_LOAD_CHUNK_SIZE = int(os.getenv("REDIS_LOAD_CHUNK_SIZE", default=1000))
+REDIS_WRITE_BATCH_SIZE = int(os.getenv("REDIS_WRITE_BATCH_SIZE", default=500))
+REDIS_WRITE_INTERVAL = float(os.getenv("REDIS_WRITE_INTERVAL", default=1.0))
+REDIS_WRITE_MAX_PENDING = int(os.getenv("REDIS_WRITE_MAX_PENDING", default=100000))
+
+
+def load_records(
+    model: type[HashModel], chunk_size: int = REDIS_LOAD_CHUNK_SIZE
+) -> Iterator[HashModel]:
+    db = model.db()
+    prefix = model.make_key(model._meta.primary_key_pattern.format(pk=""))
+    yield from load_keys(
+        model,
+        db,
+        db.scan_iter(match=f"{prefix}*", count=chunk_size, _type="HASH"),
+        chunk_size,
+    )
+
+
+def load_keys(
+    model: type[HashModel], db, keys: Iterable, chunk_size: int = REDIS_LOAD_CHUNK_SIZE
+) -> Iterator[HashModel]:
+    chunk = []
+    for key in keys:
+        chunk.append(key)
+        if len(chunk) >= chunk_size:
+            yield from _load_chunk(model, db, chunk)
+            chunk = []
+    if chunk:
+        yield from _load_chunk(model, db, chunk)
+
+
+def _load_chunk(model: type[HashModel], db, keys: list) -> Iterator[HashModel]:
+    pipeline = db.pipeline(transaction=False)
+    for key in keys:
+        pipeline.hgetall(key)
+    for document in pipeline.execute():
+        if document:
+            yield model.parse_obj(document)
+
+
+def device_key(model: type[HashModel], device_id: str) -> str:
+    # The set of the keys of the records of a device.
+    return model.make_key(f"device:{device_id}")
+
+
+class StorageError(Exception):
+    pass
+
+
+class RedisBackend:
+    # Records are hashes keyed by their pk, and the keys of each device are
+    # kept in a set, so a device loads without scanning the others. Range
+    # reads load the device and filter.
+    name = "redis"
+
+    def __init__(self, model: type[HashModel], chunk_size: int = REDIS_LOAD_CHUNK_SIZE):
+        self.model = model
+        self.chunk_size = chunk_size
+        self.indexed = False
+
+    def index(self):
+        # Records written before they were indexed by device are indexed by
+        # the first load, once for the database.
+        if self.indexed:
+            return
+        db = self.model.db()
+        marker = self.model.make_key("indexed")
+        if not db.exists(marker):
+            prefix = self.model.make_key(
+                self.model._meta.primary_key_pattern.format(pk="")
+            )
+            keys = []
+            for key in db.scan_iter(
+                match=f"{prefix}*", count=self.chunk_size, _type="HASH"
+            ):
+                keys.append(key)
+                if len(keys) >= self.chunk_size:
+                    self._index_chunk(db, keys)
+                    keys = []
+            self._index_chunk(db, keys)
+            db.set(marker, 1)
+        self.indexed = True
+
+    def _index_chunk(self, db, keys: list):
+        if not keys:
+            return
+        pipeline = db.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hget(key, "device_id")
+        device_ids = pipeline.execute()
+        for key, device_id in zip(keys, device_ids):
+            if device_id is not None:
+                pipeline.sadd(device_key(self.model, device_id), key)
+        pipeline.execute()
+
+    def load(self, device_id: Optional[str] = None) -> Iterator[HashModel]:
+        try:
+            if device_id is None:
+                yield from load_records(self.model, self.chunk_size)
+                return
+            self.index()
+            db = self.model.db()
+            yield from load_keys(
+                self.model,
+                db,
+                db.sscan_iter(device_key(self.model, device_id), count=self.chunk_size),
+                self.chunk_size,
+            )
+        except RedisError as e:
+            raise StorageError(f"redis: {e}") from e
+
+    def range(
+        self,
+        device_id: str,
+        project: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> Iterator[HashModel]:
+        records = [
+            record
+            for record in self.load(device_id)
+            if record.app == project
+            and (start is None or record.timestamp >= start)
+            and (end is None or record.timestamp < end)
+        ]
+        return iter(sorted(records, key=lambda record: record.timestamp))
+
+    def append(self, records: list[HashModel]):
+        try:
+            pipeline = self.model.db().pipeline(transaction=False)
+            for record in records:
+                # Records are validated when they are built, so this skips the
+                # per record re-validation that HashModel.save() does.
+                pipeline.hset(
+                    record.key(),
+                    mapping=record.model_dump(mode="json", exclude_none=True),
+                )
+                if record.device_id is not None:
+                    pipeline.sadd(
+                        device_key(self.model, record.device_id), record.key()
+                    )
+            pipeline.execute()
+        except RedisError as e:
+            raise StorageError(f"redis: {e}") from e
+
+
+class SQLiteBackend:
+    # One row per reading, clustered by device, project and timestamp, in WAL
+    # mode so reads are not blocked by the batched writes.
+    name = "sqlite"
+
+    def __init__(
+        self,
+        model: type[HashModel],
+        path: str = SQLITE_PATH,
+        chunk_size: int = REDIS_LOAD_CHUNK_SIZE,
+    ):
+        self.model = model
+        self.path = path
+        self.chunk_size = chunk_size
+        self.db: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            try:
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS records ("
+                    "device_id TEXT, app TEXT, timestamp INTEGER, "
+                    + ", ".join(f"{name} REAL" for name in COLUMNS)
+                    + ", PRIMARY KEY (device_id, app, timestamp)) WITHOUT ROWID"
+                )
+            except sqlite3.Error as e:
+                raise StorageError(f"sqlite: {e}") from e
+            self.db = db
+        return self.db
+
+    def select(self, where: str, parameters: tuple) -> Iterator[HashModel]:
+        # Rows are fetched chunk by chunk so a batch can commit in between.
+        try:
+            with self.lock:
+                cursor = self.connect().execute(
+                    f"SELECT app, device_id, timestamp, {', '.join(COLUMNS)} "
+                    f"FROM records {where} ORDER BY device_id, app, timestamp",
+                    parameters,
+                )
+            while True:
+                with self.lock:
+                    rows = cursor.fetchmany(self.chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self.model.model_construct(
+                        app=row[0] or None,
+                        device_id=row[1] or None,
+                        timestamp=from_epoch(row[2]),
+                        **dict(zip(COLUMNS, row[3:])),
+                    )
+        except sqlite3.Error as e:
+            raise StorageError(f"sqlite: {e}") from e
+
+    def load(self, device_id: Optional[str] = None) -> Iterator[HashModel]:
+        if device_id is None:
+            return self.select("", ())
+        return self.select("WHERE device_id = ?", (device_id,))
+
+    def range(
+        self,
+        device_id: str,
+        project: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> Iterator[HashModel]:
+        return self.select(
+            "WHERE device_id = ? AND app = ? AND timestamp >= ? AND timestamp < ?",
+            (
+                device_id,
+                project,
+                -(2**63) if start is None else to_epoch(start),
+                2**63 - 1 if end is None else to_epoch(end),
+            ),
+        )
+
+    def append(self, records: list[HashModel]):
+        # The whole batch is one transaction.
+        rows = [
+            (
+                record.device_id or "",
+                record.app or "",
+                to_epoch(record.timestamp),
+                *(getattr(record, name) for name in COLUMNS),
+            )
+            for record in records
+        ]
+        with self.lock:
+            try:
+                with self.connect() as db:
+                    db.executemany(
+                        f"INSERT OR REPLACE INTO records VALUES "
+                        f"(?, ?, ?{', ?' * len(COLUMNS)})",
+                        rows,
+                    )
+            except sqlite3.Error as e:
+                raise StorageError(f"sqlite: {e}") from e
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+STORAGE_BACKENDS = {"redis": RedisBackend, "sqlite": SQLiteBackend}
+
+
+def open_backend(name: str, model: type[HashModel]):
+    if not name or name == "none":
+        return None
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(
+            f"Unknown storage backend {name}, expected one of {', '.join(STORAGE_BACKENDS)}"
+        )
+    return STORAGE_BACKENDS[name](model)
+
+
+class WriteBehindQueue:
+    def __init__(
+        self,
+        backend=None,
+        batch_size: int = REDIS_WRITE_BATCH_SIZE,
+        interval: float = REDIS_WRITE_INTERVAL,
+        max_pending: int = REDIS_WRITE_MAX_PENDING,
+    ):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending: list[HashModel] = []
+        self.written = 0
+        self.dropped = 0
+        self.wakeup: Optional[asyncio.Event] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        # A flush cancelled on shutdown keeps running in its thread while close()
+        # flushes the rest, so flushes are serialized.
+        self.lock = threading.Lock()
+        # Records are put by the ingest thread while a flush takes the batch.
+        self.guard = threading.Lock()
+        self.log = logging.getLogger("uvicorn")
+
+    def put(self, record: HashModel):
+        if self.backend is None:
+            return
+        with self.guard:
+            self.pending.append(record)
+            full = len(self.pending) >= self.batch_size
+            # While writes fail the oldest records are dropped, so the queue
+            # stays within max_pending.
+            dropped = max(len(self.pending) - self.max_pending, 0)
+            if dropped:
+                del self.pending[:dropped]
+        if dropped:
+            STORAGE_RECORDS.inc(self.backend.name, "dropped", amount=dropped)
+            self.dropped += dropped
+        if full and self.wakeup is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def flush(self) -> int:
+        with self.lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self.guard:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return 0
+        try:
+            with STORAGE_WRITE_SECONDS.time(self.backend.name):
+                self.backend.append(batch)
+        except Exception as e:
+            # The batch is put back whatever failed, to be written next time.
+            self.log.error(f"Failed to write {len(batch)} records: {e}")
+            STORAGE_RECORDS.inc(self.backend.name, "failed", amount=len(batch))
+            with self.guard:
+                self.pending = batch + self.pending
+                dropped = max(len(self.pending) - self.max_pending, 0)
+                if dropped:
+                    self.pending = self.pending[-self.max_pending :]
+            if dropped:
+                STORAGE_RECORDS.inc(self.backend.name, "dropped", amount=dropped)
+                self.dropped += dropped
+            return 0
+        STORAGE_RECORDS.inc(self.backend.name, "written", amount=len(batch))
+        self.written += len(batch)
+        return len(batch)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                self.log.error(f"Failed to flush the write queue: {e}")
+
+    async def close(self):
+        while self.pending:
+            if not await asyncio.to_thread(self.flush):
+                break
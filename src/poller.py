@@ -0,0 +1,598 @@
+import os
+import time
+import httpx
+import asyncio
+import logging
+from functools import partial
+from typing import Callable, Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from pydantic import BaseModel, ValidationError
+
+from src.data import DeviceHistory, DeviceRecord, storage
+from src.danger import DANGER_THRESHOLDS
+from src.days import Days, current_days, use_days
+from src.persistence import WriteBehindQueue
+from src.ingest import decode, ingest_history, ingest_project, parse_epoch
+from src.live import Broadcaster
+from src.geo import SpatialIndex
+from src.recompute import derive
+from src.snapshot import (
+    SNAPSHOT_DIR,
+    SNAPSHOT_INTERVAL,
+    load_snapshot,
+    save_snapshot,
+    snapshot_path,
+)
+from src.scheduler import POLL_INTERVAL, POLL_INTERVAL_SAMPLES, PollSchedule
+from src.store import FeedStore, from_epoch, to_epoch
+from src.telemetry import FETCH_RESPONSES, FETCH_SECONDS, PARSE_SECONDS
+
+LASS_API_URL = str(
+    os.getenv("LASS_API_URL", default="https://pm25.lass-net.org/API-1.0.0")
+)
+POLL_MAX_CONNECTIONS = int(os.getenv("POLL_MAX_CONNECTIONS", default=20))
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", default=POLL_MAX_CONNECTIONS))
+POLL_TIMEOUT = float(os.getenv("POLL_TIMEOUT", default=10.0))
+# httpcore scans every pooled connection when assigning a request, so one large
+# pool gets slower as it grows; the bounded pool is split into small shards.
+POLL_POOL_SHARD_SIZE = int(os.getenv("POLL_POOL_SHARD_SIZE", default=4))
+# Times a device is recomputed from its view before the ingest thread does it.
+RECOMPUTE_ATTEMPTS = int(os.getenv("RECOMPUTE_ATTEMPTS", default=3))
+
+
+class DeviceStatus(BaseModel):
+    device_id: str
+    num_of_records: int = 0
+    version: Optional[str] = None
+    polls: int = 0
+    failures: int = 0
+    useful_polls: int = 0
+    wasted_polls: int = 0
+    reporting_interval: Optional[float] = None
+    last_error: Optional[str] = None
+    restored_until: Optional[str] = None
+    ready: bool = False
+
+
+class Readiness(BaseModel):
+    ready: bool
+    devices: int
+    devices_ready: int
+    restored: int
+    role: str = "standalone"
+
+
+class DevicePoller:
+    def __init__(
+        self,
+        device_ids: Iterable[str],
+        base_url: str = LASS_API_URL,
+        interval: float = POLL_INTERVAL,
+        max_connections: int = POLL_MAX_CONNECTIONS,
+        concurrency: int = POLL_CONCURRENCY,
+        timeout: float = POLL_TIMEOUT,
+    ):
+        self.device_ids = list(dict.fromkeys(device_ids))
+        self.base_url = base_url.rstrip("/")
+        self.interval = interval
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.concurrency = concurrency
+        # Histories are written by the ingest thread only, requests read the
+        # views it publishes after every batch.
+        self.histories: dict[str, DeviceHistory] = {}
+        self.views: dict[str, DeviceHistory] = {}
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.status: dict[str, DeviceStatus] = {}
+        self.schedules: dict[str, PollSchedule] = {}
+        self.writer = WriteBehindQueue(storage())
+        self.broadcaster = Broadcaster()
+        # The latest position and reading of every device, by location.
+        self.positions = SpatialIndex()
+        self.snapshots: dict[str, tuple] = {}
+        self.clients: list[httpx.AsyncClient] = []
+        self.shard: dict[str, int] = {}
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        # standalone, or leader or follower when workers share one poller.
+        self.role = "standalone"
+        self.log = logging.getLogger("uvicorn")
+
+    def open(self):
+        if not self.clients:
+            shards = -(-self.max_connections // POLL_POOL_SHARD_SIZE)
+            size = -(-self.max_connections // shards)
+            self.clients = [
+                httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=size, max_keepalive_connections=size
+                    ),
+                    timeout=self.timeout,
+                )
+                for _ in range(shards)
+            ]
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    def client(self, device_id: str) -> httpx.AsyncClient:
+        self.open()
+        return self.clients[
+            self.shard.setdefault(device_id, len(self.shard)) % len(self.clients)
+        ]
+
+    async def aclose(self):
+        clients, self.clients = self.clients, []
+        for client in clients:
+            await client.aclose()
+
+    async def offload(self, call: Callable, *args):
+        # Parsing and aggregation run on one thread, a batch at a time in the
+        # order they were queued, so the event loop only reads views. Every
+        # device awaits its batch before fetching again, which bounds the queue.
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="ingest"
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(call, *args))
+
+    async def drain(self):
+        # Waits for the batch in flight, those still queued are dropped.
+        executor, self.executor = self.executor, None
+        if executor is not None:
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+    def build(self, device_id: str) -> tuple[DeviceHistory, DeviceHistory]:
+        # Reads what storage holds of the device, so it runs on the ingest
+        # thread, and freezes the first view there as well.
+        history = DeviceHistory(
+            **{
+                "source": None,
+                "device_id": device_id,
+                "version": None,
+                "num_of_records": 0,
+                "feeds": {"AirBox": {}},
+                "danger": {},
+                "daily_metrics": {},
+            },
+            retain=self.role != "follower",
+        )
+        return history, history.freeze()
+
+    def history(self, device_id: str) -> DeviceHistory:
+        # On the ingest thread, or without an event loop. The event loop
+        # prepares the history first.
+        if device_id not in self.histories:
+            self.attach(device_id, *self.build(device_id))
+        return self.histories[device_id]
+
+    async def prepare(self, device_id: str):
+        # The event loop only attaches the history built on the ingest
+        # thread. One built meanwhile by another caller is kept.
+        if device_id in self.histories:
+            return
+        history, view = await self.offload(self.build, device_id)
+        if device_id not in self.histories:
+            self.attach(device_id, history, view)
+
+    async def prepare_histories(self):
+        await asyncio.gather(
+            *(self.prepare(device_id) for device_id in self.device_ids)
+        )
+
+    def view(self, device_id: str) -> DeviceHistory:
+        self.history(device_id)
+        return self.views[device_id]
+
+    def publish(self, device_id: str):
+        # A single assignment, so readers get either view and never a mix.
+        view = self.views[device_id] = self.histories[device_id].freeze(
+            self.views.get(device_id)
+        )
+        self.positions.observe(view)
+
+    def attach(
+        self,
+        device_id: str,
+        history: DeviceHistory,
+        view: Optional[DeviceHistory] = None,
+    ):
+        history._writer = self.writer
+        history._broadcaster = self.broadcaster
+        self.histories[device_id] = history
+        self.views[device_id] = view or history.freeze()
+        self.positions.observe(self.views[device_id])
+        self.status[device_id] = DeviceStatus(
+            device_id=device_id,
+            num_of_records=history.num_of_records,
+            version=history.version,
+        )
+        self.schedules[device_id] = PollSchedule(interval=self.interval)
+
+    def load(self, device_id: str, directory: str) -> Optional[tuple]:
+        # On the ingest thread, the snapshot and its first view.
+        history = load_snapshot(snapshot_path(device_id, directory))
+        return None if history is None else (history, history.freeze())
+
+    async def restore(self, directory: str = SNAPSHOT_DIR) -> int:
+        # Loads the snapshot of every device that has one, the catch-up fetch
+        # then only adds what is newer.
+        restored = 0
+        for device_id in self.device_ids:
+            if not directory or device_id in self.histories:
+                continue
+            loaded = await self.offload(self.load, device_id, directory)
+            if loaded is None or device_id in self.histories:
+                continue
+            self.adopt(device_id, *loaded)
+            restored += 1
+        return restored
+
+    def adopt(
+        self,
+        device_id: str,
+        history: DeviceHistory,
+        view: Optional[DeviceHistory] = None,
+    ):
+        # A history loaded from a snapshot, at startup or from the leader.
+        self.attach(device_id, history, view)
+        self.observe_history(device_id)
+        # None when every feed is empty, the history is then fetched in full.
+        newest = max(
+            filter(None, (records.last() for records in history.feeds.values())),
+            default=None,
+        )
+        self.status[device_id].restored_until = (
+            None
+            if newest is None
+            else from_epoch(newest).strftime("%Y-%m-%dT%H:%M:%SZ")
+        )
+        self.snapshots[device_id] = (
+            history.version,
+            history.num_of_records,
+            history.settings(),
+        )
+
+    def replay(self, device_id: str, batches: list) -> int:
+        # On the ingest thread, the readings the leader shared since the
+        # snapshot this worker loaded. They go through the live path, which
+        # sends them to the subscribers of this worker. Returns the number
+        # of records, to compare with the leader's.
+        history = self.histories[device_id]
+        for batch in batches:
+            for project, rows in batch["feeds"].items():
+                records = history.feeds.get(project) or FeedStore(project, device_id)
+                for row in rows:
+                    timestamp = from_epoch(row[0]).strftime("%Y-%m-%dT%H:%M:%SZ")
+                    history.add_record(
+                        project, timestamp, records.record(row), replayed=True
+                    )
+            history.version = batch["version"]
+        self.publish(device_id)
+        return history.num_of_records
+
+    async def save_snapshots(self, directory: str = SNAPSHOT_DIR):
+        # Views never change, so they are captured and written on a thread.
+        # Devices still warming up or unchanged since their last snapshot are
+        # skipped.
+        if not directory:
+            return
+        for device_id, view in list(self.views.items()):
+            state = (view.version, view.num_of_records, view.settings())
+            if (
+                not self.status[device_id].ready
+                or self.snapshots.get(device_id) == state
+            ):
+                continue
+            await asyncio.to_thread(save_snapshot, view, directory)
+            self.snapshots[device_id] = state
+
+    async def snapshot_forever(
+        self, interval: float = SNAPSHOT_INTERVAL, directory: str = SNAPSHOT_DIR
+    ):
+        if not directory or interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.save_snapshots(directory)
+            except OSError as e:
+                self.log.error(f"Failed to write snapshots: {e}")
+
+    def use_settings(self, thresholds: dict[str, float], days: Days):
+        # On the ingest thread, which builds new histories and loads snapshots
+        # with them. Updated in place, so the loop never finds no thresholds.
+        DANGER_THRESHOLDS.update(thresholds)
+        for name in set(DANGER_THRESHOLDS) - set(thresholds):
+            del DANGER_THRESHOLDS[name]
+        use_days(days)
+
+    def follow_settings(self, history: DeviceHistory):
+        # On the ingest thread. Histories loaded from the leader bring the
+        # settings it recomputed them with, new histories of this worker
+        # follow them too.
+        DANGER_THRESHOLDS.update(
+            {name: index.threshold for name, index in history.danger.items()}
+        )
+        if history._days.name != current_days().name:
+            use_days(history._days)
+
+    def swap_derived(self, device_id: str, held: int, derived: tuple) -> bool:
+        # On the ingest thread. Derived from a view that has missed readings
+        # since, it is thrown away.
+        history = self.histories[device_id]
+        if history.num_of_records != held:
+            return False
+        history.replace_derived(*derived)
+        self.publish(device_id)
+        if self.broadcaster.listening(device_id):
+            self.broadcaster.publish(
+                device_id, "settings", {"settings": history.settings()}
+            )
+        return True
+
+    def rederive(self, device_id: str, thresholds: dict[str, float], days: Days) -> int:
+        history = self.histories[device_id]
+        danger, daily_metrics, count = derive(history, thresholds, days)
+        self.swap_derived(
+            device_id, history.num_of_records, (danger, daily_metrics, days)
+        )
+        return count
+
+    async def recompute(self, thresholds: dict[str, float], days: Days) -> int:
+        # Rebuilds the danger episodes and daily metrics of every device with
+        # new thresholds or days from its feeds. The readings of a view are
+        # derived on a thread and swapped in on the ingest thread, so polls
+        # carry on meanwhile, and readings added since make it start over.
+        # Returns the number of readings the results were derived from.
+        thresholds = dict(thresholds)
+        await self.offload(self.use_settings, thresholds, days)
+        readings = 0
+        for device_id in list(self.histories):
+            for _ in range(RECOMPUTE_ATTEMPTS):
+                view = self.views[device_id]
+                danger, daily_metrics, count = await asyncio.to_thread(
+                    derive, view, thresholds, days
+                )
+                if await self.offload(
+                    self.swap_derived,
+                    device_id,
+                    view.num_of_records,
+                    (danger, daily_metrics, days),
+                ):
+                    break
+            else:
+                count = await self.offload(self.rederive, device_id, thresholds, days)
+            readings += count
+        return readings
+
+    def readiness(self) -> Readiness:
+        statuses = [self.status.get(device_id) for device_id in self.device_ids]
+        ready = sum(1 for status in statuses if status is not None and status.ready)
+        return Readiness(
+            ready=ready == len(self.device_ids),
+            devices=len(self.device_ids),
+            devices_ready=ready,
+            restored=sum(
+                1 for status in statuses if status is not None and status.restored_until
+            ),
+            role=self.role,
+        )
+
+    async def request(
+        self, device_id: str, endpoint: str, params: Optional[dict] = None
+    ) -> dict:
+        client = self.client(device_id)
+        await self.prepare(device_id)
+        status = self.status[device_id]
+        async with self.semaphore:
+            started = time.perf_counter()
+            try:
+                response = await client.get(
+                    f"{self.base_url}/device/{device_id}/{endpoint}/",
+                    params={"format": "JSON", **(params or {})},
+                )
+                FETCH_SECONDS.observe(time.perf_counter() - started, endpoint)
+                FETCH_RESPONSES.inc(endpoint, response.status_code)
+                response.raise_for_status()
+            except Exception as e:
+                if isinstance(e, httpx.TransportError):
+                    FETCH_SECONDS.observe(time.perf_counter() - started, endpoint)
+                    FETCH_RESPONSES.inc(endpoint, "error")
+                status.failures += 1
+                status.last_error = f"{type(e).__name__}: {e}"
+                raise
+        try:
+            data = await self.offload(decode, response.content)
+        except ValueError as e:
+            status.failures += 1
+            status.last_error = f"{type(e).__name__}: {e}"
+            raise
+        status.polls += 1
+        return data
+
+    async def fetch_history(self, device_id: str) -> bool:
+        # A device is ready once its history has loaded. Returns whether it
+        # did, the polls fetch it again otherwise.
+        await self.prepare(device_id)
+        history = self.histories[device_id]
+        try:
+            data = await self.request(device_id, "history")
+            await self.offload(
+                self.process_init_response,
+                device_id,
+                data,
+                self.status[device_id].restored_until,
+            )
+        except (ValueError, ValidationError) as e:
+            self.log.error(f"Failed to load history for {device_id}: {e}")
+            return False
+        except httpx.HTTPError as e:
+            self.log.error(f"Failed to fetch history for {device_id}: {e}")
+            return False
+        finally:
+            self.status[device_id].num_of_records = history.num_of_records
+        self.status[device_id].ready = True
+        return True
+
+    async def fetch_histories(self):
+        await asyncio.gather(
+            *(self.fetch_history(device_id) for device_id in self.device_ids)
+        )
+
+    async def poll_device(self, device_id: str) -> Optional[int]:
+        try:
+            data = await self.request(device_id, "latest")
+            added = 0
+            schedule = self.schedules[device_id]
+            version = data.get("version")
+            if schedule.changed(version):
+                added = await self.offload(self.process_response, device_id, data)
+                schedule.applied(version)
+        except (ValueError, ValidationError) as e:
+            self.log.error(f"Failed to update {device_id}: {e}")
+            return None
+        except Exception as e:
+            self.log.error(f"Failed to poll {device_id}: {e}")
+            return None
+        if added:
+            self.status[device_id].useful_polls += 1
+        else:
+            self.status[device_id].wasted_polls += 1
+        return added
+
+    async def poll_all(self) -> int:
+        added = await asyncio.gather(
+            *(self.poll_device(device_id) for device_id in self.device_ids)
+        )
+        return sum(count or 0 for count in added)
+
+    async def poll_forever(self, device_id: str):
+        await self.prepare(device_id)
+        schedule = self.schedules[device_id]
+        attempts = 0
+        retry_at = 0.0
+        while True:
+            if not self.status[device_id].ready and time.monotonic() >= retry_at:
+                # A history that failed to load is fetched again, less often
+                # each time, while the polls go on.
+                if not await self.fetch_history(device_id):
+                    retry_at = time.monotonic() + schedule.backoff(
+                        attempts, schedule.max_backoff
+                    )
+                    attempts += 1
+            added = await self.poll_device(device_id)
+            self.status[device_id].reporting_interval = schedule.reporting_interval
+            await asyncio.sleep(schedule.next_delay(added))
+
+    async def run(self):
+        await asyncio.gather(
+            *(self.poll_forever(device_id) for device_id in self.device_ids)
+        )
+
+    def process_init_response(
+        self, device_id: str, response_data: dict, since: Optional[str] = None
+    ):
+        # Entries up to since, the newest reading of a restored snapshot, are
+        # skipped before they are parsed.
+        history = self.history(device_id)
+        history.source = response_data.get("source")
+        history.version = response_data.get("version")
+
+        try:
+            ingest_history(history, response_data, since)
+        finally:
+            self.publish(device_id)
+
+        self.observe_history(device_id)
+        self.status[device_id].num_of_records = history.num_of_records
+        self.status[device_id].version = history.version
+        return history
+
+    def process_backfill(
+        self, device_id: str, response_data: dict, start: int, end: int
+    ) -> int:
+        # Only the readings from start to end are taken, should LASS send
+        # more. They are older than the newest held, so they take the reading
+        # by reading path, which skips those already held, and the version
+        # stays that of the newest reading. They are not live readings, so
+        # they are not sent to subscribers one by one.
+        history = self.history(device_id)
+        version = history.version
+        held = history.num_of_records
+        history._broadcaster = None
+        try:
+            for feed in response_data["feeds"]:
+                for project in feed.keys():
+                    entries = [
+                        (key, entry[key])
+                        for entry in feed[project]
+                        for key in entry.keys()
+                        if start <= parse_epoch(key) <= end
+                    ]
+                    ingest_project(history, project, entries)
+        finally:
+            history.version = version
+            history._broadcaster = self.broadcaster
+            if history.num_of_records != held:
+                self.publish(device_id)
+        self.status[device_id].num_of_records = history.num_of_records
+        return history.num_of_records - held
+
+    def announce_backfill(self, device_id: str):
+        view = self.views[device_id]
+        if self.broadcaster.listening(device_id):
+            self.broadcaster.publish(
+                device_id,
+                "backfill",
+                {"version": view.version, "num_of_records": view.num_of_records},
+            )
+
+    def observe_history(self, device_id: str):
+        history = self.histories[device_id]
+        if history.feeds:
+            # Learn the reporting interval from the newest readings.
+            schedule = self.schedules[device_id]
+            records = max(history.feeds.values(), key=len)
+            schedule.observe(row[0] for row in records.tail(POLL_INTERVAL_SAMPLES + 1))
+            self.status[device_id].reporting_interval = schedule.reporting_interval
+
+    def process_response(self, device_id: str, response_data: dict) -> int:
+        history = self.history(device_id)
+        added = 0
+        built = 0.0
+        for feed in response_data["feeds"]:
+            for project in feed.keys():
+                started = time.perf_counter()
+                record = DeviceRecord(
+                    **{
+                        "app": project,
+                        "device_id": feed[project]["device_id"],
+                        "s_t0": feed[project]["s_t0"],
+                        "s_h0": feed[project]["s_h0"],
+                        "s_d0": feed[project]["s_d0"],
+                        "gps_lat": feed[project]["gps_lat"],
+                        "gps_lon": feed[project]["gps_lon"],
+                        "timestamp": feed[project]["timestamp"],
+                    }
+                )
+                built += time.perf_counter() - started
+
+                response = history.add_record(
+                    project, feed[project]["timestamp"], record
+                )
+                if response:
+                    added += 1
+                    self.schedules[device_id].observe([to_epoch(record.timestamp)])
+                    self.log.debug(
+                        f"{device_id}: Added record with timestamp {feed[project]['timestamp']}"
+                    )
+                else:
+                    self.log.debug(
+                        f"{device_id}: Record with timestamp {feed[project]['timestamp']} already exists"
+                    )
+
+        PARSE_SECONDS.observe(built, "records")
+        if added:
+            self.publish(device_id)
+        self.status[device_id].num_of_records = history.num_of_records
+        self.status[device_id].version = history.version
+        return added
@@ -0,0 +1,196 @@
+import heapq
+from array import array
+from datetime import date
+from pydantic import BaseModel
+
+from src.data import DailyMetrics, DeviceHistory
+from src.danger import DANGER_RESOLUTIONS, DangerIndex
+from src.days import EPOCH_DAY, Days
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class RecomputeResult(BaseModel):
+    thresholds: dict[str, float]
+    timezone: str
+    devices: int
+    readings: int
+    seconds: float
+    vectorized: bool
+
+
+def to_array(typecode: str, values) -> array:
+    # q and d are the int64 and float64 of numpy, so the bytes are copied as
+    # they are.
+    dtype = np.int64 if typecode == "q" else np.float64
+    return array(typecode, np.ascontiguousarray(values, dtype).tobytes())
+
+
+def readings(history: DeviceHistory) -> tuple:
+    # The epochs and s_d0 of every project in time order, the projects at the
+    # same second in the order the merge of the feeds gives them, without the
+    # readings that have no s_d0.
+    epochs = []
+    values = []
+    for records in history.feeds.values():
+        for timestamps, column in records.chunk_columns("s_d0"):
+            epochs.append(np.frombuffer(timestamps, dtype=np.int64))
+            values.append(np.frombuffer(column, dtype=np.float64))
+    if not epochs:
+        return np.empty(0, np.int64), np.empty(0, np.float64)
+    epochs = np.concatenate(epochs)
+    values = np.concatenate(values)
+    if len(history.feeds) > 1:
+        order = np.argsort(epochs, kind="stable")
+        epochs = epochs[order]
+        values = values[order]
+    kept = ~np.isnan(values)
+    return epochs[kept], values[kept]
+
+
+def offsets(days: Days, epochs):
+    if days.fixed is not None:
+        return days.fixed
+    # Zones change their offset on a quarter hour, so each quarter is looked
+    # up once.
+    quarters, inverse = np.unique(epochs // 900, return_inverse=True)
+    found = np.array(
+        [days.offset(quarter * 900) for quarter in quarters.tolist()], dtype=np.int64
+    )
+    return found[inverse]
+
+
+def derive_danger(threshold: float, days: Days, epochs, values, offset) -> DangerIndex:
+    # The index adding the readings in time order builds. A reading above the
+    # threshold starts an episode unless the one before it was above too, but
+    # only the first reading at a second moves the index on: the others join
+    # the last episode if one of them was above, and start one if not.
+    index = DangerIndex(threshold, days)
+    if not len(epochs):
+        return index
+    above = values > threshold
+    first = np.empty(len(epochs), dtype=bool)
+    first[0] = True
+    np.not_equal(epochs[1:], epochs[:-1], out=first[1:])
+    seconds = np.flatnonzero(first)
+    second = np.cumsum(first) - 1
+    opened = above[seconds]
+    was_open = np.concatenate(([False], opened[:-1]))[second]
+    seen = np.cumsum(above) - above
+    earlier = seen > seen[seconds][second]
+    starts = above & np.where(first, ~was_open, ~earlier)
+
+    index.last = int(epochs[-1])
+    index.open = bool(opened[-1])
+    hits = np.flatnonzero(above)
+    if not len(hits):
+        return index
+    hit_epochs = epochs[hits]
+    begins = np.flatnonzero(starts[hits])
+    index.starts = to_array("q", hit_epochs[begins])
+    index.ends = to_array("q", np.maximum.reduceat(hit_epochs, begins))
+    index.peaks = to_array("d", np.maximum.reduceat(values[hits], begins))
+    index.counts = to_array("q", np.diff(np.append(begins, len(hits))))
+    local = hit_epochs + (offset if np.ndim(offset) == 0 else offset[hits])
+    for name, resolution in DANGER_RESOLUTIONS.items():
+        buckets, counts = np.unique(hit_epochs - local % resolution, return_counts=True)
+        index.exceedances[name] = dict(zip(buckets.tolist(), counts.tolist()))
+    return index
+
+
+def derive_metrics(epochs, values, offset) -> dict[date, DailyMetrics]:
+    # Sorted by day and value, so the minimum, maximum and the centroids of a
+    # single compress of each day's digest are read off the slices.
+    if not len(epochs):
+        return {}
+    numbers = (epochs + offset) // 86400
+    order = np.lexsort((values, numbers))
+    numbers = numbers[order]
+    ordered = values[order]
+    begins = np.flatnonzero(np.concatenate(([True], numbers[1:] != numbers[:-1])))
+    counts = np.diff(np.append(begins, len(ordered)))
+    means = np.add.reduceat(ordered, begins) / counts
+    m2s = np.add.reduceat((ordered - np.repeat(means, counts)) ** 2, begins)
+
+    daily_metrics = {}
+    for number, begin, count, mean, m2 in zip(
+        numbers[begins].tolist(),
+        begins.tolist(),
+        counts.tolist(),
+        means.tolist(),
+        m2s.tolist(),
+    ):
+        day = ordered[begin : begin + count]
+        metrics = DailyMetrics.empty()
+        stats = metrics._stats
+        stats.count, stats.mean, stats.m2 = count, mean, m2
+        stats.min, stats.max = float(day[0]), float(day[-1])
+        digest = metrics._digest
+        bounds = digest.boundaries(count)
+        weights = np.diff(np.append(bounds, count))
+        digest.means = (np.add.reduceat(day, bounds) / weights).tolist()
+        digest.weights = weights.astype(np.float64).tolist()
+        digest.min, digest.max = stats.min, stats.max
+        metrics.refresh()
+        daily_metrics[date.fromordinal(EPOCH_DAY + number)] = metrics
+    return daily_metrics
+
+
+def derive_rows(
+    history: DeviceHistory, thresholds: dict[str, float], days: Days
+) -> tuple[dict[str, DangerIndex], dict[date, DailyMetrics], int]:
+    # Without numpy, the same a reading at a time.
+    danger = {
+        name: DangerIndex(threshold, days) for name, threshold in thresholds.items()
+    }
+    values_by_day: dict[date, list[float]] = {}
+    rows = heapq.merge(
+        *(records.range() for records in history.feeds.values()),
+        key=lambda row: row[0],
+    )
+    count = 0
+    for row in rows:
+        value = row[3]
+        if value != value:
+            continue
+        for index in danger.values():
+            index.add(row[0], value)
+        values_by_day.setdefault(days.date(row[0]), []).append(value)
+        count += 1
+
+    daily_metrics = {}
+    for day in sorted(values_by_day):
+        values = values_by_day[day]
+        metrics = DailyMetrics.empty()
+        for value in values:
+            metrics._stats.add(value)
+        digest = metrics._digest
+        digest.compress((value, 1.0) for value in values)
+        digest.min, digest.max = metrics._stats.min, metrics._stats.max
+        metrics.refresh()
+        daily_metrics[day] = metrics
+    return danger, daily_metrics, count
+
+
+def derive(
+    history: DeviceHistory, thresholds: dict[str, float], days: Days
+) -> tuple[dict[str, DangerIndex], dict[date, DailyMetrics], int]:
+    # The danger episodes and daily metrics of thresholds and days from the
+    # feeds alone, and the number of readings they were built from. Reads
+    # nothing else of history, so a view can be derived on any thread.
+    if np is None:
+        return derive_rows(history, thresholds, days)
+    epochs, values = readings(history)
+    offset = offsets(days, epochs)
+    danger = {
+        name: derive_danger(threshold, days, epochs, values, offset)
+        for name, threshold in thresholds.items()
+    }
+    return danger, derive_metrics(epochs, values, offset), len(epochs)
+
+
+def vectorized() -> bool:
+    return np is not None
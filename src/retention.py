@@ -0,0 +1,93 @@
+import os
+import re
+import zlib
+from array import array
+from functools import lru_cache
+from typing import Optional
+
+# A window is a number of readings ("100000") or an age ("30d", "12h").
+RETENTION_WINDOW = str(os.getenv("RETENTION_WINDOW", default=""))
+RETENTION_WINDOWS = {
+    name.strip(): value.strip()
+    for name, value in (
+        item.split("=")
+        for item in str(os.getenv("RETENTION_WINDOWS", default="")).split(",")
+        if item.strip()
+    )
+}
+RETENTION_DIR = str(os.getenv("RETENTION_DIR", default="segments"))
+SEGMENT_CACHE_SIZE = int(os.getenv("SEGMENT_CACHE_SIZE", default=16))
+SEGMENT_COMPRESSION = int(os.getenv("SEGMENT_COMPRESSION", default=6))
+AGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+SEGMENT_NAME = re.compile(r"^(\d+)-(\d+)-(\d+)\.seg$")
+
+
+def parse_window(value: str) -> tuple[Optional[int], Optional[int]]:
+    # Returns the number of readings and the age in seconds to keep in memory.
+    value = value.strip()
+    if not value:
+        return None, None
+    if value[-1] in AGE_UNITS:
+        return None, int(value[:-1]) * AGE_UNITS[value[-1]]
+    return int(value), None
+
+
+@lru_cache(maxsize=None)
+def retention_window(project: Optional[str]) -> tuple[Optional[int], Optional[int]]:
+    return parse_window(RETENTION_WINDOWS.get(project, RETENTION_WINDOW))
+
+
+def segment_dir(device_id: Optional[str], project: Optional[str]) -> str:
+    return os.path.join(
+        RETENTION_DIR,
+        *(str(name).replace(os.sep, "_") for name in (device_id, project)),
+    )
+
+
+def write_segment(directory: str, timestamps: array, columns: tuple[array, ...]) -> str:
+    # One file per chunk, named after its first and last epoch and its length.
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(
+        directory, f"{timestamps[0]}-{timestamps[-1]}-{len(timestamps)}.seg"
+    )
+    data = timestamps.tobytes() + b"".join(column.tobytes() for column in columns)
+    with open(path + ".tmp", "wb") as segment:
+        segment.write(zlib.compress(data, SEGMENT_COMPRESSION))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+@lru_cache(maxsize=SEGMENT_CACHE_SIZE)
+def read_segment(path: str, width: int) -> tuple[array, tuple[array, ...]]:
+    with open(path, "rb") as segment:
+        data = zlib.decompress(segment.read())
+    size = len(data) // (width + 1)
+    timestamps = array("q", data[:size])
+    columns = tuple(
+        array("d", data[size * (i + 1) : size * (i + 2)]) for i in range(width)
+    )
+    return timestamps, columns
+
+
+def list_segments(directory: str) -> list[tuple[int, int, int, str]]:
+    # (first, last, length, path) of every segment, oldest first.
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        match = SEGMENT_NAME.match(name)
+        if match:
+            first, last, length = map(int, match.groups())
+            segments.append((first, last, length, os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def segment_projects(device_id: str) -> list[str]:
+    directory = segment_dir(device_id, "")
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name))
+    )
@@ -0,0 +1,196 @@
+import os
+import math
+from array import array
+from bisect import bisect_right
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from typing import Optional, Sequence
+from pydantic import BaseModel
+
+from src.retention import AGE_UNITS
+from src.store import COLUMNS, from_epoch
+
+# Windows of s_d0 ending at the newest reading, named by their age.
+ROLLING_WINDOWS = {
+    name: int(name[:-1]) * AGE_UNITS[name[-1]]
+    for name in (
+        item.strip()
+        for item in str(os.getenv("ROLLING_WINDOWS", default="1h,8h,24h")).split(",")
+    )
+    if name
+}
+# Readings dropped from the front before the arrays are compacted.
+ROLLING_COMPACT_SIZE = int(os.getenv("ROLLING_COMPACT_SIZE", default=1024))
+S_D0 = COLUMNS.index("s_d0") + 1
+
+
+class RollingValue(BaseModel):
+    window: str
+    seconds: int
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    count: int = 0
+    avg: Optional[float] = None
+    min: Optional[float] = None
+    max: Optional[float] = None
+
+
+def push(queue: deque, epoch: int, value: float):
+    # queue holds the suffix minimums of a window, oldest first, so its front
+    # is the window's minimum.
+    while queue and queue[-1][1] >= value:
+        queue.pop()
+    queue.append((epoch, value))
+
+
+def insert(queue: deque, epoch: int, value: float):
+    # A late reading is a suffix minimum unless a newer one is as low, and
+    # replaces the older ones that are not lower. It lands near the back.
+    later = len(queue)
+    while later and queue[later - 1][0] > epoch:
+        later -= 1
+    if later < len(queue) and queue[later][1] <= value:
+        return
+    earlier = later
+    while earlier and queue[earlier - 1][1] >= value:
+        earlier -= 1
+    for _ in range(later - earlier):
+        del queue[earlier]
+    queue.insert(earlier, (epoch, value))
+
+
+class RollingWindow:
+    # The readings of the last seconds up to the newest: where they start in
+    # the engine's arrays, their sum and count, and monotonic deques for the
+    # minimum and, negated, the maximum.
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        self.first = 0
+        self.sum = 0.0
+        self.count = 0
+        self.lows: deque[tuple[int, float]] = deque()
+        self.highs: deque[tuple[int, float]] = deque()
+
+    def push(self, epoch: int, value: float):
+        self.sum += value
+        self.count += 1
+        push(self.lows, epoch, value)
+        push(self.highs, epoch, -value)
+
+    def insert(self, epoch: int, value: float):
+        self.sum += value
+        self.count += 1
+        insert(self.lows, epoch, value)
+        insert(self.highs, epoch, -value)
+
+    def evict(self, cutoff: int, epochs: array, values: array):
+        while self.first < len(epochs) and epochs[self.first] <= cutoff:
+            self.sum -= values[self.first]
+            self.count -= 1
+            self.first += 1
+        while self.lows and self.lows[0][0] <= cutoff:
+            self.lows.popleft()
+        while self.highs and self.highs[0][0] <= cutoff:
+            self.highs.popleft()
+        if not self.count:
+            self.sum = 0.0
+
+    def freeze(self) -> "RollingWindow":
+        # Only the figures, views never add to it.
+        window = RollingWindow(self.seconds)
+        window.sum = self.sum
+        window.count = self.count
+        window.lows = deque(islice(self.lows, 1))
+        window.highs = deque(islice(self.highs, 1))
+        return window
+
+    def value(self, name: str, last: Optional[int]) -> RollingValue:
+        if last is None or not self.count:
+            return RollingValue(window=name, seconds=self.seconds)
+        # The window is the seconds up to and including the newest reading.
+        return RollingValue(
+            window=name,
+            seconds=self.seconds,
+            start=from_epoch(last - self.seconds),
+            end=from_epoch(last),
+            count=self.count,
+            avg=round(self.sum / self.count, 1),
+            min=self.lows[0][1],
+            max=-self.highs[0][1],
+        )
+
+
+class RollingEngine:
+    # Rolling figures of s_d0 across the projects of a device. Readings are
+    # kept in time order for the longest window only. A reading newer than
+    # the others costs O(1) amortized per window, a late one is inserted.
+    def __init__(self, windows: dict[str, int] = ROLLING_WINDOWS):
+        self.windows = {
+            name: RollingWindow(seconds) for name, seconds in windows.items()
+        }
+        self.longest = max(windows.values(), default=0)
+        self.epochs = array("q")
+        self.values = array("d")
+        self.head = 0
+        self.last: Optional[int] = None
+
+    def add(self, epoch: int, value: float):
+        if value != value or not self.windows:
+            return
+        if self.last is None or epoch >= self.last:
+            self.last = epoch
+            self.epochs.append(epoch)
+            self.values.append(value)
+            for window in self.windows.values():
+                window.push(epoch, value)
+                window.evict(epoch - window.seconds, self.epochs, self.values)
+            self.compact()
+            return
+        if epoch <= self.last - self.longest:
+            return
+        # Within the longest window, so after every reading dropped.
+        position = bisect_right(self.epochs, epoch, self.head)
+        self.epochs.insert(position, epoch)
+        self.values.insert(position, value)
+        for window in self.windows.values():
+            if epoch > self.last - window.seconds:
+                window.insert(epoch, value)
+            else:
+                window.first += 1
+
+    def compact(self):
+        self.head = min(window.first for window in self.windows.values())
+        if self.head < ROLLING_COMPACT_SIZE or self.head * 2 < len(self.epochs):
+            return
+        del self.epochs[: self.head]
+        del self.values[: self.head]
+        for window in self.windows.values():
+            window.first -= self.head
+            # Resummed, so the running sums do not drift.
+            window.sum = math.fsum(self.values[window.first :])
+        self.head = 0
+
+    def extend(self, rows: Sequence[tuple]):
+        # Feed rows in time order. Those that would have left every window
+        # by the time the last one is added are skipped.
+        if not rows:
+            return
+        newest = rows[-1][0] if self.last is None else max(rows[-1][0], self.last)
+        start = bisect_right(rows, newest - self.longest, key=lambda row: row[0])
+        for row in islice(rows, start, None):
+            self.add(row[0], row[S_D0])
+
+    def freeze(self) -> "RollingEngine":
+        engine = RollingEngine({})
+        engine.windows = {
+            name: window.freeze() for name, window in self.windows.items()
+        }
+        engine.longest = self.longest
+        engine.last = self.last
+        return engine
+
+    def summary(self) -> dict[str, RollingValue]:
+        return {
+            name: window.value(name, self.last) for name, window in self.windows.items()
+        }
@@ -0,0 +1,226 @@
+import os
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Iterator, Optional, Sequence
+
+ROLLUP_COLUMNS = ("s_t0", "s_h0", "s_d0")
+RESOLUTIONS = {"minute": 60, "hour": 3600, "day": 86400}
+ROLLUP_MAX_POINTS = int(os.getenv("ROLLUP_MAX_POINTS", default=2000))
+ROLLUP_BLOCK_SIZE = int(os.getenv("ROLLUP_BLOCK_SIZE", default=1024))
+INF = float("inf")
+
+
+class RollupBlock:
+    # A run of consecutive buckets with the count, sum, min and max of every
+    # rollup column.
+    __slots__ = ("buckets", "counts", "sums", "mins", "maxs")
+
+    def __init__(
+        self,
+        buckets: Optional[array] = None,
+        counts: Optional[list[array]] = None,
+        sums: Optional[list[array]] = None,
+        mins: Optional[list[array]] = None,
+        maxs: Optional[list[array]] = None,
+    ):
+        self.buckets = array("q") if buckets is None else buckets
+        self.counts = [array("q") for _ in ROLLUP_COLUMNS] if counts is None else counts
+        self.sums = [array("d") for _ in ROLLUP_COLUMNS] if sums is None else sums
+        self.mins = [array("d") for _ in ROLLUP_COLUMNS] if mins is None else mins
+        self.maxs = [array("d") for _ in ROLLUP_COLUMNS] if maxs is None else maxs
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def copy(self, lo: int = 0) -> "RollupBlock":
+        return RollupBlock(
+            self.buckets[lo:],
+            *(
+                [values[lo:] for values in arrays]
+                for arrays in (self.counts, self.sums, self.mins, self.maxs)
+            ),
+        )
+
+    def insert(self, index: int, bucket: int):
+        self.buckets.insert(index, bucket)
+        for column in range(len(ROLLUP_COLUMNS)):
+            self.counts[column].insert(index, 0)
+            self.sums[column].insert(index, 0.0)
+            self.mins[column].insert(index, INF)
+            self.maxs[column].insert(index, -INF)
+
+    def row(self, index: int) -> tuple[int, list[Optional[tuple]]]:
+        values = []
+        for column in range(len(ROLLUP_COLUMNS)):
+            count = self.counts[column][index]
+            values.append(
+                (
+                    count,
+                    self.sums[column][index] / count,
+                    self.mins[column][index],
+                    self.maxs[column][index],
+                )
+                if count
+                else None
+            )
+        return self.buckets[index], values
+
+
+class RollupTier:
+    # Count, sum, min and max of every rollup column per fixed size bucket, in
+    # blocks of ROLLUP_BLOCK_SIZE buckets. Only the newest block is changed in
+    # place, older ones may be shared with views and are replaced instead.
+    def __init__(self, resolution: int, blocks: Optional[list[RollupBlock]] = None):
+        self.resolution = resolution
+        self.blocks = [RollupBlock()] if blocks is None else blocks
+        self._firsts: list[int] = []
+        self._offsets = [0]
+        # Buckets before the horizon were evicted.
+        self.horizon = 0
+
+    def __len__(self) -> int:
+        return self._offsets[-1] + len(self.blocks[-1])
+
+    def _index(self):
+        self.blocks = [block for block in self.blocks if len(block)] or [RollupBlock()]
+        self._firsts = [block.buckets[0] for block in self.blocks if len(block)]
+        self._offsets = []
+        total = 0
+        for block in self.blocks:
+            self._offsets.append(total)
+            total += len(block)
+
+    def _block(self, bucket: int) -> int:
+        return max(bisect_right(self._firsts, bucket) - 1, 0)
+
+    def _position(self, bucket: int) -> int:
+        # Where bucket is or would go among all buckets.
+        index = self._block(bucket)
+        return self._offsets[index] + bisect_left(self.blocks[index].buckets, bucket)
+
+    def add(self, epoch: int, values: Sequence[float]):
+        bucket = epoch - epoch % self.resolution
+        block = self.blocks[-1]
+        buckets = block.buckets
+        if buckets and buckets[-1] == bucket:
+            index = len(buckets) - 1
+        elif not buckets or buckets[-1] < bucket:
+            if len(buckets) >= ROLLUP_BLOCK_SIZE:
+                self._offsets.append(len(self))
+                block = RollupBlock()
+                self.blocks.append(block)
+            if not block.buckets:
+                self._firsts.append(bucket)
+            index = len(block)
+            block.insert(index, bucket)
+        else:
+            # Out of order readings are rare, so an insert into the arrays is
+            # cheaper overall than a structure that supports it well.
+            position = self._block(bucket)
+            if position < len(self.blocks) - 1:
+                self.blocks[position] = self.blocks[position].copy()
+            block = self.blocks[position]
+            index = bisect_left(block.buckets, bucket)
+            if index == len(block) or block.buckets[index] != bucket:
+                block.insert(index, bucket)
+                self._index()
+        for counts, sums, mins, maxs, value in zip(
+            block.counts, block.sums, block.mins, block.maxs, values
+        ):
+            if value != value:
+                continue
+            counts[index] += 1
+            sums[index] += value
+            if value < mins[index]:
+                mins[index] = value
+            if value > maxs[index]:
+                maxs[index] = value
+
+    def evict(self, before: int):
+        # Drops the buckets older than the one containing before.
+        bucket = before - before % self.resolution
+        index = self._block(bucket)
+        lo = bisect_left(self.blocks[index].buckets, bucket)
+        del self.blocks[:index]
+        if lo:
+            self.blocks[0] = self.blocks[0].copy(lo)
+        self._index()
+        self.horizon = max(self.horizon, bucket)
+
+    def freeze(self) -> "RollupTier":
+        # A copy for readers sharing all blocks but the newest.
+        tier = RollupTier(self.resolution, [*self.blocks[:-1], self.blocks[-1].copy()])
+        tier._firsts = list(self._firsts)
+        tier._offsets = list(self._offsets)
+        tier.horizon = self.horizon
+        return tier
+
+    def bounds(self, start: Optional[int], end: Optional[int]) -> tuple[int, int]:
+        lo = 0
+        if start is not None:
+            lo = self._position(start - start % self.resolution)
+        hi = len(self) if end is None else self._position(end)
+        return lo, hi
+
+    def range(
+        self, start: Optional[int] = None, end: Optional[int] = None
+    ) -> Iterator[tuple[int, list[Optional[tuple[int, float, float, float]]]]]:
+        # Yields each bucket with (count, avg, min, max) per rollup column.
+        lo, hi = self.bounds(start, end)
+        for offset, block in zip(self._offsets, self.blocks):
+            if offset >= hi:
+                return
+            for index in range(max(lo - offset, 0), min(hi - offset, len(block))):
+                yield block.row(index)
+
+
+def select_resolution(
+    tiers: dict[str, RollupTier],
+    start: Optional[int],
+    end: Optional[int],
+    max_points: int = ROLLUP_MAX_POINTS,
+) -> str:
+    # The finest resolution that answers the range in at most max_points
+    # buckets, skipping those evicted from part of the range.
+    for name in sorted(tiers, key=lambda name: tiers[name].resolution):
+        horizon = tiers[name].horizon
+        if horizon and (start is None or start < horizon):
+            continue
+        lo, hi = tiers[name].bounds(start, end)
+        if hi - lo <= max_points:
+            return name
+    return max(tiers, key=lambda name: tiers[name].resolution)
+
+
+def lttb(values: Sequence[Optional[float]], threshold: int) -> list[int]:
+    # Largest-triangle-three-buckets over evenly spaced points. Returns the
+    # indexes of the points to keep, always including the first and last.
+    length = len(values)
+    if threshold >= length or threshold < 3:
+        return list(range(length))
+    ys = [0.0 if value is None or math.isnan(value) else value for value in values]
+    every = (length - 2) / (threshold - 2)
+    indexes = [0]
+    previous = 0
+    for bucket in range(threshold - 2):
+        lo = int(bucket * every) + 1
+        hi = int((bucket + 1) * every) + 1
+        next_hi = max(min(int((bucket + 2) * every) + 1, length), hi + 1)
+        average_x = (hi + next_hi - 1) / 2
+        average_y = sum(ys[hi:next_hi]) / (next_hi - hi)
+
+        selected = lo
+        largest = -1.0
+        for index in range(lo, hi):
+            area = abs(
+                (previous - average_x) * (ys[index] - ys[previous])
+                - (previous - index) * (average_y - ys[previous])
+            )
+            if area > largest:
+                largest = area
+                selected = index
+        indexes.append(selected)
+        previous = selected
+    indexes.append(length - 1)
+    return indexes
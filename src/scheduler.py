@@ -0,0 +1,82 @@
+import os
+import math
+import time
+import random
+from collections import deque
+from statistics import median
+from typing import Iterable, Optional
+
+POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", default=1.0))
+# Seconds after the expected reading time at which the device is polled.
+POLL_LEAD = float(os.getenv("POLL_LEAD", default=5.0))
+POLL_MAX_BACKOFF = float(os.getenv("POLL_MAX_BACKOFF", default=300.0))
+POLL_INTERVAL_SAMPLES = int(os.getenv("POLL_INTERVAL_SAMPLES", default=16))
+
+
+class PollSchedule:
+    def __init__(
+        self,
+        interval: float = POLL_INTERVAL,
+        lead: float = POLL_LEAD,
+        max_backoff: float = POLL_MAX_BACKOFF,
+        samples: int = POLL_INTERVAL_SAMPLES,
+    ):
+        self.interval = interval
+        self.lead = lead
+        self.max_backoff = max_backoff
+        self.gaps: deque[int] = deque(maxlen=samples)
+        self.last: Optional[int] = None
+        self.version: Optional[str] = None
+        self.failures = 0
+        self.misses = 0
+
+    @property
+    def reporting_interval(self) -> Optional[float]:
+        # The median ignores the odd long gap left by a device that was offline.
+        return median(self.gaps) if self.gaps else None
+
+    def observe(self, epochs: Iterable[int]):
+        for epoch in sorted(epochs):
+            if self.last is not None and epoch > self.last:
+                self.gaps.append(epoch - self.last)
+            if self.last is None or epoch > self.last:
+                self.last = epoch
+
+    def changed(self, version: Optional[str]) -> bool:
+        return version is None or version != self.version
+
+    def applied(self, version: Optional[str]):
+        # Only a version whose response was processed is skipped afterwards,
+        # one that failed is processed again on the next poll.
+        self.version = version
+
+    def backoff(self, attempts: int, cap: float) -> float:
+        # The exponent stops growing once the delay reaches the cap, however
+        # long a device fails or stays silent.
+        if 0 < self.interval < cap:
+            attempts = min(attempts, math.ceil(math.log2(cap / self.interval)))
+        else:
+            attempts = 0
+        delay = min(cap, self.interval * 2**attempts)
+        return random.uniform(delay / 2, delay)
+
+    def next_delay(self, outcome: Optional[int], now: Optional[float] = None) -> float:
+        # outcome is None after a failed poll, otherwise the number of new readings.
+        now = time.time() if now is None else now
+        if outcome is None:
+            self.failures += 1
+            return self.backoff(self.failures - 1, self.max_backoff)
+        self.failures = 0
+        self.misses = 0 if outcome else self.misses + 1
+
+        interval = self.reporting_interval
+        if interval is None or self.last is None:
+            return self.interval
+        expected = self.last + interval + self.lead
+        if expected > now:
+            return max(self.interval, expected - now)
+        # The reading is late, poll more often than the device reports.
+        return max(
+            self.interval,
+            self.backoff(self.misses, min(self.max_backoff, interval / 4)),
+        )
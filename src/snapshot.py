@@ -0,0 +1,312 @@
+import os
+import json
+import mmap
+import logging
+import struct
+from array import array
+from datetime import date
+from typing import Optional
+
+from src.data import DailyMetrics, DeviceHistory
+from src.danger import DANGER_THRESHOLDS, DangerIndex
+from src.days import Days, current_days
+from src.recompute import derive
+from src.rollup import RollupBlock, RollupTier
+from src.store import FeedChunk, FeedStore
+
+SNAPSHOT_DIR = str(os.getenv("SNAPSHOT_DIR", default="snapshots"))
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", default=300))
+MAGIC = b"PMSNAP02"
+
+log = logging.getLogger("uvicorn")
+
+
+class SnapshotWriter:
+    # Collects arrays into one blob and describes each as (typecode, offset,
+    # length) for the header.
+    def __init__(self):
+        self.buffers: list = []
+        self.offset = 0
+
+    def array(self, values: array, frozen: bool = False) -> list:
+        # Chunks are never modified, so they are written from a view later on.
+        # Everything else is copied now, while it is consistent.
+        data = memoryview(values).cast("B") if frozen else values.tobytes()
+        self.buffers.append(data)
+        descriptor = [values.typecode, self.offset, len(values)]
+        self.offset += len(data)
+        return descriptor
+
+
+class SnapshotReader:
+    # Copies each array out of the mapped file once. Histories own their
+    # arrays and extend some of them, so they are not views of the map, but
+    # the file is never read into memory as a whole first.
+    def __init__(self, view: memoryview, base: int):
+        self.view = view
+        self.base = base
+
+    def array(self, descriptor: list) -> array:
+        typecode, offset, length = descriptor
+        values = array(typecode)
+        start = self.base + offset
+        end = start + length * values.itemsize
+        if offset < 0 or end > len(self.view):
+            raise ValueError("snapshot is truncated")
+        values.frombytes(self.view[start:end])
+        return values
+
+
+def snapshot_path(device_id: str, directory: Optional[str] = None) -> str:
+    return os.path.join(
+        SNAPSHOT_DIR if directory is None else directory,
+        f"{device_id.replace(os.sep, '_')}.snap",
+    )
+
+
+def capture_rollup(writer: SnapshotWriter, tier: RollupTier) -> dict:
+    return {
+        "horizon": tier.horizon,
+        "blocks": [
+            {
+                "buckets": writer.array(block.buckets),
+                **{
+                    name: [writer.array(values) for values in getattr(block, name)]
+                    for name in ("counts", "sums", "mins", "maxs")
+                },
+            }
+            for block in tier.blocks
+        ],
+    }
+
+
+def capture_feed(writer: SnapshotWriter, records: FeedStore) -> dict:
+    records.flush()
+    return {
+        "project": records.project,
+        "device_id": records.device_id,
+        "length": len(records),
+        "spilled": records.spilled,
+        "spilled_length": records._spilled_length,
+        "segments": list(records.segments),
+        "chunks": [
+            [
+                writer.array(chunk.timestamps, frozen=True),
+                [writer.array(column, frozen=True) for column in chunk.columns],
+            ]
+            for chunk in records.chunks
+        ],
+        "rollups": {
+            name: capture_rollup(writer, tier) for name, tier in records.rollups.items()
+        },
+    }
+
+
+def capture_danger(writer: SnapshotWriter, index: DangerIndex) -> dict:
+    return {
+        "threshold": index.threshold,
+        "last": index.last,
+        "open": index.open,
+        **{
+            name: writer.array(getattr(index, name))
+            for name in ("starts", "ends", "peaks", "counts")
+        },
+        "exceedances": {
+            name: [
+                writer.array(array("q", counts.keys())),
+                writer.array(array("q", counts.values())),
+            ]
+            for name, counts in index.exceedances.items()
+        },
+    }
+
+
+def capture_metrics(metrics: DailyMetrics) -> dict:
+    stats = metrics._stats
+    digest = metrics._digest
+    return {
+        "stats": [stats.count, stats.mean, stats.m2, stats.min, stats.max],
+        "digest": [
+            digest.compression,
+            list(digest.means),
+            list(digest.weights),
+            list(digest.buffer),
+            digest.min,
+            digest.max,
+        ],
+    }
+
+
+def capture(history: DeviceHistory) -> tuple[dict, list]:
+    # A view never changes, so it can be captured on any thread. A live
+    # history has to be captured on the thread that writes it.
+    writer = SnapshotWriter()
+    header = {
+        "source": history.source,
+        "device_id": history.device_id,
+        "version": history.version,
+        "num_of_records": history.num_of_records,
+        "timezone": history._days.name,
+        "feeds": {
+            project: capture_feed(writer, records)
+            for project, records in history.feeds.items()
+        },
+        "danger": {
+            name: capture_danger(writer, index)
+            for name, index in history.danger.items()
+        },
+        "daily_metrics": {
+            day.isoformat(): capture_metrics(metrics)
+            for day, metrics in history.daily_metrics.items()
+        },
+    }
+    return header, writer.buffers
+
+
+def write_snapshot(path: str, header: dict, buffers: list):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    encoded = json.dumps(header).encode()
+    with open(path + ".tmp", "wb") as snapshot:
+        snapshot.write(MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+        for data in buffers:
+            snapshot.write(data)
+        # On disk before it replaces the last one, so a crash leaves either.
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def save_snapshot(history: DeviceHistory, directory: Optional[str] = None) -> str:
+    path = snapshot_path(history.device_id, directory)
+    write_snapshot(path, *capture(history))
+    return path
+
+
+def restore_feed(reader: SnapshotReader, state: dict) -> FeedStore:
+    records = FeedStore(state["project"], state["device_id"])
+    records.chunks = [
+        FeedChunk(
+            reader.array(timestamps),
+            tuple(reader.array(column) for column in columns),
+        )
+        for timestamps, columns in state["chunks"]
+    ]
+    records._firsts = [chunk.timestamps[0] for chunk in records.chunks]
+    records._length = state["length"]
+    records.segments = [tuple(segment) for segment in state["segments"]]
+    records._segment_firsts = [segment[0] for segment in records.segments]
+    records._spilled_length = state["spilled_length"]
+    records.spilled = state["spilled"]
+    for name, tier_state in state["rollups"].items():
+        tier = records.rollups[name]
+        tier.horizon = tier_state["horizon"]
+        tier.blocks = [
+            RollupBlock(
+                reader.array(block["buckets"]),
+                *(
+                    [reader.array(d) for d in block[field]]
+                    for field in ("counts", "sums", "mins", "maxs")
+                ),
+            )
+            for block in tier_state["blocks"]
+        ]
+        tier._index()
+    return records
+
+
+def restore_danger(reader: SnapshotReader, state: dict, days: Days) -> DangerIndex:
+    index = DangerIndex(state["threshold"], days)
+    index.last = state["last"]
+    index.open = state["open"]
+    for name in ("starts", "ends", "peaks", "counts"):
+        setattr(index, name, reader.array(state[name]))
+    for name, (buckets, counts) in state["exceedances"].items():
+        index.exceedances[name] = dict(zip(reader.array(buckets), reader.array(counts)))
+    return index
+
+
+def restore_metrics(state: dict) -> DailyMetrics:
+    metrics = DailyMetrics.empty()
+    stats = metrics._stats
+    digest = metrics._digest
+    stats.count, stats.mean, stats.m2, stats.min, stats.max = state["stats"]
+    (
+        digest.compression,
+        digest.means,
+        digest.weights,
+        digest.buffer,
+        digest.min,
+        digest.max,
+    ) = state["digest"]
+    metrics.refresh()
+    return metrics
+
+
+def load_snapshot(path: str, recompute: bool = True) -> Optional[DeviceHistory]:
+    # Returns None when there is no usable snapshot, including a corrupt one
+    # and one whose spilled segments have gone missing. One taken with other
+    # danger thresholds or another timezone is recomputed to the current
+    # ones, unless recompute is off.
+    if not os.path.exists(path) or os.path.getsize(path) < len(MAGIC) + 8:
+        return None
+    try:
+        history = read_snapshot(path)
+    except (ValueError, KeyError, TypeError, IndexError, struct.error) as e:
+        log.error(f"Ignoring the corrupt snapshot {path}: {e}")
+        return None
+    if history is None:
+        return None
+    history.index_rolling()
+    thresholds = {name: index.threshold for name, index in history.danger.items()}
+    days = history._days
+    if recompute and (
+        thresholds != DANGER_THRESHOLDS or days.name != current_days().name
+    ):
+        danger, daily_metrics, _ = derive(history, DANGER_THRESHOLDS, current_days())
+        history.replace_derived(danger, daily_metrics, current_days())
+    return history
+
+
+def read_snapshot(path: str) -> Optional[DeviceHistory]:
+    with open(path, "rb") as snapshot:
+        with mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                if bytes(view[: len(MAGIC)]) != MAGIC:
+                    return None
+                (size,) = struct.unpack_from("<Q", view, len(MAGIC))
+                start = len(MAGIC) + 8
+                if start + size > len(view):
+                    raise ValueError("snapshot header is truncated")
+                header = json.loads(bytes(view[start : start + size]))
+                feeds = header["feeds"]
+                for state in feeds.values():
+                    if not all(os.path.exists(s[3]) for s in state["segments"]):
+                        return None
+                try:
+                    days = Days(header.get("timezone", "UTC"))
+                except ValueError:
+                    return None
+                reader = SnapshotReader(view, start + size)
+                history = DeviceHistory.model_construct(
+                    source=header["source"],
+                    device_id=header["device_id"],
+                    version=header["version"],
+                    num_of_records=header["num_of_records"],
+                    feeds={
+                        project: restore_feed(reader, state)
+                        for project, state in feeds.items()
+                    },
+                    danger={
+                        name: restore_danger(reader, state, days)
+                        for name, state in header["danger"].items()
+                    },
+                    daily_metrics={
+                        date.fromisoformat(day): restore_metrics(state)
+                        for day, state in header["daily_metrics"].items()
+                    },
+                )
+                history._days = days
+            finally:
+                view.release()
+    return history
@@ -0,0 +1,165 @@
+import os
+import math
+from typing import Iterable, Optional
+
+DIGEST_COMPRESSION = int(os.getenv("DIGEST_COMPRESSION", default=100))
+
+
+class RunningStats:
+    # Welford's running mean and variance, merged with Chan's formula.
+    __slots__ = ("count", "mean", "m2", "min", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def copy(self) -> "RunningStats":
+        stats = RunningStats()
+        stats.count, stats.mean, stats.m2 = self.count, self.mean, self.m2
+        stats.min, stats.max = self.min, self.max
+        return stats
+
+    def merge(self, other: "RunningStats"):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self) -> Optional[float]:
+        return self.m2 / self.count if self.count else None
+
+    @property
+    def std(self) -> Optional[float]:
+        return math.sqrt(self.variance) if self.count else None
+
+
+class TDigest:
+    # Merging t-digest with the k1 scale function. Values are buffered and
+    # folded into at most about compression centroids.
+    __slots__ = ("compression", "means", "weights", "buffer", "min", "max")
+
+    def __init__(self, compression: int = DIGEST_COMPRESSION):
+        self.compression = compression
+        self.means: list[float] = []
+        self.weights: list[float] = []
+        self.buffer: list[float] = []
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        self.buffer.append(value)
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self.buffer) >= 5 * self.compression:
+            self.compress()
+
+    def copy(self) -> "TDigest":
+        digest = TDigest(self.compression)
+        digest.means = list(self.means)
+        digest.weights = list(self.weights)
+        digest.buffer = list(self.buffer)
+        digest.min, digest.max = self.min, self.max
+        return digest
+
+    def merge(self, other: "TDigest"):
+        self.compress(
+            list(zip(other.means, other.weights)) + [(v, 1.0) for v in other.buffer]
+        )
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _k(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q(self, k: float) -> float:
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(2 * math.pi * k / self.compression) + 1) / 2
+
+    def compress(self, centroids: Iterable[tuple[float, float]] = ()):
+        points = list(zip(self.means, self.weights))
+        points.extend((value, 1.0) for value in self.buffer)
+        points.extend(centroids)
+        self.buffer = []
+        if not points:
+            return
+        points.sort()
+        total = sum(weight for _, weight in points)
+
+        means = []
+        weights = []
+        mean, weight = points[0]
+        seen = 0.0
+        limit = total * self._q(self._k(0.0) + 1)
+        for next_mean, next_weight in points[1:]:
+            if seen + weight + next_weight <= limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                seen += weight
+                limit = total * self._q(self._k(seen / total) + 1)
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self.means = means
+        self.weights = weights
+
+    def boundaries(self, count: int) -> list[int]:
+        # Where compress starts each centroid of count values of weight one,
+        # in order, for callers that sum the values of each themselves.
+        starts = []
+        start = 0
+        while start < count:
+            starts.append(start)
+            limit = count * self._q(self._k(start / count) + 1)
+            start = max(start + 1, min(count, math.floor(limit)))
+        return starts
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.buffer:
+            self.compress()
+        if not self.weights:
+            return None
+        if len(self.weights) == 1:
+            return self.means[0]
+        total = sum(self.weights)
+        target = q * total
+        # Each centroid's weight is taken to be spread evenly around its mean.
+        if target < self.weights[0] / 2:
+            return self.min + (self.means[0] - self.min) * target / (
+                self.weights[0] / 2
+            )
+        cumulative = self.weights[0] / 2
+        for index in range(len(self.weights) - 1):
+            step = (self.weights[index] + self.weights[index + 1]) / 2
+            if target < cumulative + step:
+                left, right = self.means[index], self.means[index + 1]
+                return left + (right - left) * (target - cumulative) / step
+            cumulative += step
+        tail = self.weights[-1] / 2
+        return self.means[-1] + (self.max - self.means[-1]) * min(
+            (target - cumulative) / tail, 1.0
+        )
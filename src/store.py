@@ -0,0 +1,494 @@
+import os
+import math
+import calendar
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import chain, islice
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from typing import Any, Iterator, Optional
+from pydantic_core import core_schema
+
+from src.rollup import RESOLUTIONS, ROLLUP_COLUMNS, RollupTier
+from src.retention import (
+    list_segments,
+    read_segment,
+    retention_window,
+    segment_dir,
+    write_segment,
+)
+
+COLUMNS = ("s_t0", "s_h0", "s_d0", "gps_lat", "gps_lon")
+FEED_CHUNK_SIZE = int(os.getenv("FEED_CHUNK_SIZE", default=4096))
+FEED_BUFFER_SIZE = int(os.getenv("FEED_BUFFER_SIZE", default=256))
+NAN = float("nan")
+ROLLUP_INDEXES = tuple(COLUMNS.index(name) + 1 for name in ROLLUP_COLUMNS)
+# Rollups that grow as fast as the readings are trimmed with them.
+HOT_ROLLUPS = ("minute",)
+
+
+def to_epoch(timestamp: datetime) -> int:
+    if timestamp.tzinfo is None:
+        return calendar.timegm(timestamp.timetuple())
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+def from_epoch(epoch: int) -> datetime:
+    return datetime.fromtimestamp(epoch, timezone.utc)
+
+
+def to_value(value: float) -> Optional[float]:
+    return None if math.isnan(value) else value
+
+
+class FeedChunk:
+    # Chunks are never modified once built, writers replace them instead.
+    __slots__ = ("timestamps", "columns")
+
+    def __init__(self, timestamps: array, columns: tuple[array, ...]):
+        self.timestamps = timestamps
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, rows: list[tuple]) -> "FeedChunk":
+        if not rows:
+            return cls(array("q"), tuple(array("d") for _ in COLUMNS))
+        timestamps, *columns = zip(*rows)
+        return cls(
+            array("q", timestamps), tuple(array("d", column) for column in columns)
+        )
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def rows(self, lo: int = 0, hi: Optional[int] = None) -> Iterator[tuple]:
+        hi = len(self.timestamps) if hi is None else hi
+        return zip(self.timestamps[lo:hi], *(column[lo:hi] for column in self.columns))
+
+    def split(self) -> list["FeedChunk"]:
+        if len(self) <= FEED_CHUNK_SIZE:
+            return [self]
+        pieces = -(-len(self) // FEED_CHUNK_SIZE)
+        size = -(-len(self) // pieces)
+        return [
+            FeedChunk(
+                self.timestamps[lo : lo + size],
+                tuple(column[lo : lo + size] for column in self.columns),
+            )
+            for lo in range(0, len(self), size)
+        ]
+
+
+class FeedStore(Mapping):
+    def __init__(
+        self,
+        project: Optional[str] = None,
+        device_id: Optional[str] = None,
+        rollups: Optional[dict[str, RollupTier]] = None,
+    ):
+        self.project = project
+        self.device_id = device_id
+        self.chunks: list[FeedChunk] = []
+        self._firsts: list[int] = []
+        self._buffer: dict[int, tuple] = {}
+        # The buffer as a chunk, as of the last freeze, with the buffer it was
+        # built from and how many of its rows it holds.
+        self._frozen_buffer: Optional[tuple[dict, int, FeedChunk]] = None
+        self._length = 0
+        # Chunks evicted from memory, as (first, last, length, path).
+        self.segments: list[tuple[int, int, int, str]] = []
+        self._segment_firsts: list[int] = []
+        self._spilled_length = 0
+        self.spilled: Optional[int] = None
+        self.rollups = rollups or {
+            name: RollupTier(resolution) for name, resolution in RESOLUTIONS.items()
+        }
+
+    def _locate(self, epoch: int) -> Optional[tuple[int, int]]:
+        index = bisect_right(self._firsts, epoch) - 1
+        if index < 0:
+            return None
+        timestamps = self.chunks[index].timestamps
+        position = bisect_left(timestamps, epoch)
+        if position < len(timestamps) and timestamps[position] == epoch:
+            return index, position
+        return None
+
+    def _locate_spilled(self, epoch: int) -> Optional[tuple]:
+        if self.spilled is None or epoch > self.spilled:
+            return None
+        index = bisect_right(self._segment_firsts, epoch) - 1
+        if index < 0:
+            return None
+        chunk = FeedChunk(*read_segment(self.segments[index][3], len(COLUMNS)))
+        position = bisect_left(chunk.timestamps, epoch)
+        if position < len(chunk) and chunk.timestamps[position] == epoch:
+            return next(chunk.rows(position, position + 1))
+        return None
+
+    def has(self, epoch: int) -> bool:
+        return (
+            epoch in self._buffer
+            or self._locate(epoch) is not None
+            or self._locate_spilled(epoch) is not None
+        )
+
+    def add(self, timestamp: datetime, record) -> bool:
+        epoch = to_epoch(timestamp)
+        if self.spilled is not None and epoch <= self.spilled:
+            # Readings older than the spilled ones are not taken back.
+            return False
+        if self.has(epoch):
+            return False
+
+        if self.project is None:
+            self.project = record.app
+        if record.device_id is not None:
+            self.device_id = record.device_id
+        row = self._buffer[epoch] = (
+            epoch,
+            *(
+                NAN if getattr(record, name) is None else float(getattr(record, name))
+                for name in COLUMNS
+            ),
+        )
+        values = tuple(row[index] for index in ROLLUP_INDEXES)
+        for tier in self.rollups.values():
+            tier.add(epoch, values)
+        self._length += 1
+        if len(self._buffer) >= FEED_BUFFER_SIZE:
+            self.flush()
+        return True
+
+    def newest(self) -> Optional[int]:
+        epochs = [
+            epoch
+            for epoch in (
+                max(self._buffer) if self._buffer else None,
+                self.chunks[-1].timestamps[-1] if self.chunks else None,
+                self.spilled,
+            )
+            if epoch is not None
+        ]
+        return max(epochs) if epochs else None
+
+    def extend(
+        self, rows: list[tuple], project: Optional[str], device_id: Optional[str]
+    ) -> bool:
+        # Appends rows sorted by epoch and newer than every stored reading,
+        # flushing at the same points as adding them one by one would. Returns
+        # False, adding nothing, when the rows do not qualify.
+        newest = self.newest()
+        previous = -1 if newest is None else newest
+        for row in rows:
+            if row[0] <= previous:
+                return False
+            previous = row[0]
+        if not rows:
+            return True
+
+        if self.project is None:
+            self.project = project
+        if device_id is not None:
+            self.device_id = device_id
+        values = [tuple(row[index] for index in ROLLUP_INDEXES) for row in rows]
+        for tier in self.rollups.values():
+            for row, value in zip(rows, values):
+                tier.add(row[0], value)
+        self._length += len(rows)
+
+        start = FEED_BUFFER_SIZE - len(self._buffer)
+        if start > len(rows):
+            start = 0
+        else:
+            self._buffer.update((row[0], row) for row in rows[:start])
+            self.flush()
+        end = start + (len(rows) - start) // FEED_BUFFER_SIZE * FEED_BUFFER_SIZE
+        for lo in range(start, end, FEED_BUFFER_SIZE):
+            self._append(rows[lo : lo + FEED_BUFFER_SIZE])
+        self._firsts = [chunk.timestamps[0] for chunk in self.chunks]
+        self._buffer.update((row[0], row) for row in rows[end:])
+        return True
+
+    def flush(self):
+        if not self._buffer:
+            return
+        rows = sorted(self._buffer.values())
+        self._buffer = {}
+
+        if not self.chunks or rows[0][0] > self.chunks[-1].timestamps[-1]:
+            self._append(rows)
+        else:
+            groups: dict[int, list[tuple]] = {}
+            for row in rows:
+                index = max(bisect_right(self._firsts, row[0]) - 1, 0)
+                groups.setdefault(index, []).append(row)
+            for index in sorted(groups, reverse=True):
+                merged = sorted([*self.chunks[index].rows(), *groups[index]])
+                self.chunks[index : index + 1] = FeedChunk.from_rows(merged).split()
+
+        self._firsts = [chunk.timestamps[0] for chunk in self.chunks]
+
+    def _append(self, rows: list[tuple]):
+        new = FeedChunk.from_rows(rows)
+        if self.chunks and len(self.chunks[-1]) < FEED_CHUNK_SIZE:
+            tail = self.chunks.pop()
+            new = FeedChunk(
+                tail.timestamps + new.timestamps,
+                tuple(old + add for old, add in zip(tail.columns, new.columns)),
+            )
+        self.chunks.extend(new.split())
+
+    def retain(self):
+        # Spills the oldest chunks to disk once the rest still fill the window.
+        records, age = retention_window(self.project)
+        if records is None and age is None:
+            return
+        spilled = False
+        while len(self.chunks) > 1:
+            chunk = self.chunks[0]
+            hot = self._length - self._spilled_length
+            newest = self.chunks[-1].timestamps[-1]
+            if not (
+                (records is not None and hot - len(chunk) >= records)
+                or (age is not None and chunk.timestamps[-1] < newest - age)
+            ):
+                break
+            path = write_segment(
+                segment_dir(self.device_id, self.project),
+                chunk.timestamps,
+                chunk.columns,
+            )
+            self.segments.append(
+                (chunk.timestamps[0], chunk.timestamps[-1], len(chunk), path)
+            )
+            self._segment_firsts.append(chunk.timestamps[0])
+            self._spilled_length += len(chunk)
+            self.spilled = chunk.timestamps[-1]
+            del self.chunks[0]
+            del self._firsts[0]
+            spilled = True
+        if spilled:
+            for name in HOT_ROLLUPS:
+                self.rollups[name].evict(self.spilled + 1)
+
+    def _pending(self) -> Optional[FeedChunk]:
+        # The buffered rows as a chunk that follows the stored ones, extended
+        # from the last one built while the buffer only grew in order.
+        count = len(self._buffer)
+        chunk = None
+        if self._frozen_buffer is not None and self._frozen_buffer[0] is self._buffer:
+            _, built, chunk = self._frozen_buffer
+            rows = list(islice(self._buffer.values(), built, None))
+            if rows and (
+                rows[0][0] <= chunk.timestamps[-1]
+                or any(a[0] >= b[0] for a, b in zip(rows, rows[1:]))
+            ):
+                chunk = None
+            elif rows:
+                new = FeedChunk.from_rows(rows)
+                chunk = FeedChunk(
+                    chunk.timestamps + new.timestamps,
+                    tuple(old + add for old, add in zip(chunk.columns, new.columns)),
+                )
+        if chunk is None:
+            chunk = FeedChunk.from_rows(sorted(self._buffer.values()))
+        self._frozen_buffer = (self._buffer, count, chunk)
+        if self.chunks and chunk.timestamps[0] <= self.chunks[-1].timestamps[-1]:
+            return None
+        return chunk
+
+    def freeze(self) -> "FeedStore":
+        # A flushed copy for readers. Chunks are shared and the buffer becomes
+        # one more chunk of the copy, so the writer keeps buffering.
+        records = FeedStore(
+            self.project,
+            self.device_id,
+            {name: tier.freeze() for name, tier in self.rollups.items()},
+        )
+        records.chunks = list(self.chunks)
+        records._firsts = list(self._firsts)
+        if self._buffer:
+            pending = self._pending()
+            if pending is None:
+                records._buffer = dict(self._buffer)
+                records.flush()
+            else:
+                records.chunks.append(pending)
+                records._firsts.append(pending.timestamps[0])
+        records._length = self._length
+        records.segments = list(self.segments)
+        records._segment_firsts = list(self._segment_firsts)
+        records._spilled_length = self._spilled_length
+        records.spilled = self.spilled
+        return records
+
+    def open_segments(self) -> int:
+        # Takes over the segments spilled by an earlier run. They are counted
+        # and rolled up again but stay on disk.
+        segments = list_segments(segment_dir(self.device_id, self.project))
+        if not segments:
+            return 0
+        self.segments = segments
+        self._segment_firsts = [segment[0] for segment in segments]
+        self.spilled = segments[-1][1]
+        length = sum(segment[2] for segment in segments)
+        self._spilled_length += length
+        self._length += length
+        for name in HOT_ROLLUPS:
+            self.rollups[name].evict(self.spilled + 1)
+        tiers = list(self.rollups.values())
+        for row in self.range(None, self.spilled + 1):
+            values = tuple(row[index] for index in ROLLUP_INDEXES)
+            for tier in tiers:
+                if row[0] >= tier.horizon:
+                    tier.add(row[0], values)
+        return length
+
+    def _chunks(self, start: Optional[int], end: Optional[int]) -> Iterator[FeedChunk]:
+        # Spilled segments are read back from disk first, then the chunks in
+        # memory, found by bisecting the chunk indexes.
+        if self.segments and (start is None or start <= self.spilled):
+            index = 0
+            if start is not None:
+                index = max(bisect_right(self._segment_firsts, start) - 1, 0)
+            for first, _, _, path in self.segments[index:]:
+                if end is not None and first >= end:
+                    return
+                yield FeedChunk(*read_segment(path, len(COLUMNS)))
+        index = 0 if start is None else max(bisect_right(self._firsts, start) - 1, 0)
+        yield from self.chunks[index:]
+
+    def rows(self) -> Iterator[tuple]:
+        yield from self.range()
+
+    def range(
+        self, start: Optional[int] = None, end: Optional[int] = None
+    ) -> Iterator[tuple]:
+        # Rows with start <= epoch < end.
+        self.flush()
+        for chunk in self._chunks(start, end):
+            if end is not None and chunk.timestamps[0] >= end:
+                return
+            lo = 0 if start is None else bisect_left(chunk.timestamps, start)
+            hi = len(chunk) if end is None else bisect_left(chunk.timestamps, end)
+            yield from chunk.rows(lo, hi)
+
+    def page(
+        self, start: Optional[int] = None, end: Optional[int] = None, limit: int = 1000
+    ) -> tuple[list[tuple], Optional[int]]:
+        # Returns up to limit rows and the epoch the next page starts at.
+        rows = list(islice(self.range(start, end), limit + 1))
+        return rows[:limit], rows[limit][0] if len(rows) > limit else None
+
+    def tail(self, count: int) -> list[tuple]:
+        self.flush()
+        rows = []
+        segments = (
+            FeedChunk(*read_segment(segment[3], len(COLUMNS)))
+            for segment in reversed(self.segments)
+        )
+        for chunk in chain(reversed(self.chunks), segments):
+            if len(rows) >= count:
+                break
+            rows[:0] = chunk.rows(max(len(chunk) - (count - len(rows)), 0))
+        return rows
+
+    def last(self) -> Optional[int]:
+        self.flush()
+        return self.chunks[-1].timestamps[-1] if self.chunks else self.spilled
+
+    def column(self, name: str) -> Iterator[float]:
+        self.flush()
+        index = COLUMNS.index(name)
+        for chunk in self._chunks(None, None):
+            yield from chunk.columns[index]
+
+    def chunk_columns(self, name: str) -> Iterator[tuple[array, array]]:
+        # The timestamps and one column a chunk at a time, for bulk readers.
+        self.flush()
+        index = COLUMNS.index(name)
+        for chunk in self._chunks(None, None):
+            yield chunk.timestamps, chunk.columns[index]
+
+    def record(self, row: tuple):
+        from src.data import DeviceRecord
+
+        return DeviceRecord.model_construct(
+            app=self.project,
+            device_id=self.device_id,
+            s_t0=to_value(row[1]),
+            s_h0=to_value(row[2]),
+            s_d0=to_value(row[3]),
+            gps_lat=to_value(row[4]),
+            gps_lon=to_value(row[5]),
+            timestamp=from_epoch(row[0]),
+        )
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __contains__(self, timestamp: Any) -> bool:
+        return isinstance(timestamp, datetime) and self.has(to_epoch(timestamp))
+
+    def __getitem__(self, timestamp: datetime):
+        epoch = to_epoch(timestamp)
+        if epoch in self._buffer:
+            return self.record(self._buffer[epoch])
+        location = self._locate(epoch)
+        if location is None:
+            row = self._locate_spilled(epoch)
+            if row is None:
+                raise KeyError(timestamp)
+            return self.record(row)
+        chunk = self.chunks[location[0]]
+        return self.record(next(chunk.rows(location[1], location[1] + 1)))
+
+    def __iter__(self) -> Iterator[datetime]:
+        for row in self.rows():
+            yield from_epoch(row[0])
+
+    def values(self):
+        for row in self.rows():
+            yield self.record(row)
+
+    def items(self):
+        for row in self.rows():
+            yield from_epoch(row[0]), self.record(row)
+
+    def serialize(self, info) -> dict:
+        if info.mode_is_json():
+            return {
+                from_epoch(row[0]).strftime("%Y-%m-%dT%H:%M:%SZ"): {
+                    "app": self.project,
+                    "device_id": self.device_id,
+                    **{name: to_value(value) for name, value in zip(COLUMNS, row[1:])},
+                    "timestamp": from_epoch(row[0]).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                }
+                for row in self.rows()
+            }
+        return dict(self.items())
+
+    @classmethod
+    def validate(cls, value: Mapping) -> "FeedStore":
+        store = cls()
+        for timestamp, record in value.items():
+            store.add(timestamp, record)
+        return store
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source, handler):
+        from src.data import DeviceRecord
+
+        mapping_schema = core_schema.no_info_after_validator_function(
+            cls.validate, handler.generate_schema(dict[datetime, DeviceRecord])
+        )
+        return core_schema.json_or_python_schema(
+            json_schema=mapping_schema,
+            python_schema=core_schema.union_schema(
+                [core_schema.is_instance_schema(cls), mapping_schema]
+            ),
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda store, info: store.serialize(info), info_arg=True
+            ),
+        )
@@ -0,0 +1,212 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from typing import Iterable
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", default="true").lower() not in (
+    "0",
+    "false",
+    "no",
+)
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS = tuple(4**i for i in range(4, 14))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def sort_key(item: tuple) -> tuple:
+    # Label values may mix types, a status is an int or "error".
+    return tuple(str(value) for value in item[0])
+
+
+class Counter:
+    # Series are keyed by their label values, given in the order of the label
+    # names, so an increment is a dict lookup and an add. The event loop and
+    # the ingest thread both count, so updates hold a lock.
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, *values, amount: float = 1):
+        if METRICS_ENABLED:
+            with self.lock:
+                self.series[values] = self.series.get(values, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        with self.lock:
+            series = list(self.series.items())
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for values, count in sorted(series, key=sort_key):
+            yield f"{self.name}{labels(self.labelnames, values)} {count}"
+
+
+class Histogram:
+    # Each series is the count per bucket, the overflow and the sum, made
+    # cumulative only when rendered.
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, *values):
+        if not METRICS_ENABLED:
+            return
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(values)
+            if series is None:
+                series = self.series[values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bucket] += 1
+            series[-1] += value
+
+    def time(self, *values) -> "Timer":
+        return Timer(self, values)
+
+    def render(self) -> Iterable[str]:
+        with self.lock:
+            copied = [(values, list(series)) for values, series in self.series.items()]
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for values, series in sorted(copied, key=sort_key):
+            count = 0
+            for bound, observed in zip((*self.buckets, "+Inf"), series):
+                count += observed
+                le = labels(self.labelnames, values, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {count}"
+            yield f"{self.name}_sum{labels(self.labelnames, values)} {series[-1]}"
+            yield f"{self.name}_count{labels(self.labelnames, values)} {count}"
+
+
+class Timer:
+    __slots__ = ("histogram", "values", "started")
+
+    def __init__(self, histogram: Histogram, values: tuple):
+        self.histogram = histogram
+        self.values = values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.values)
+
+
+REGISTRY: list = []
+
+FETCH_SECONDS = Histogram(
+    "pm_fetch_seconds", "Time to fetch from the LASS API.", ["endpoint"]
+)
+FETCH_RESPONSES = Counter(
+    "pm_fetch_responses_total",
+    "LASS API responses by HTTP status, or error when none arrived.",
+    ["endpoint", "status"],
+)
+PARSE_SECONDS = Histogram(
+    "pm_parse_seconds",
+    "Time to decode a LASS response and to build its DeviceRecords.",
+    ["stage"],
+)
+RECORDS = Counter(
+    "pm_records_total", "Readings offered to add_record.", ["project", "result"]
+)
+STORAGE_WRITE_SECONDS = Histogram(
+    "pm_storage_write_seconds", "Time to write one batch to storage.", ["backend"]
+)
+STORAGE_RECORDS = Counter(
+    "pm_storage_records_total",
+    "Records written to storage, failed and dropped.",
+    ["backend", "result"],
+)
+RENDER_SECONDS = Histogram(
+    "pm_render_seconds", "Time to rebuild a dashboard page.", ["page"]
+)
+REQUEST_SECONDS = Histogram(
+    "pm_http_request_seconds",
+    "Time to answer a request, until the last byte of the body.",
+    ["method", "route", "status"],
+)
+RESPONSE_BYTES = Histogram(
+    "pm_http_response_bytes", "Size of response bodies.", ["route"], SIZE_BUCKETS
+)
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+class MetricsMiddleware:
+    # Times every request by its route template, so paths with device ids do
+    # not each make a series.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        response = {"status": 500, "bytes": 0}
+
+        async def measure(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, measure)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                scope["method"],
+                path,
+                response["status"],
+            )
+            RESPONSE_BYTES.observe(response["bytes"], path)
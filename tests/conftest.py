@@ -0,0 +1,26 @@
+import pytest
+
+import src.data
+import src.retention
+from src.data import DeviceHistory
+
+
+@pytest.fixture(autouse=True)
+def memory_only(monkeypatch, tmp_path):
+    # Histories are kept in memory, and segments spilled by a test stay in its
+    # own directory.
+    monkeypatch.setattr(src.data, "STORAGE", None)
+    monkeypatch.setattr(src.retention, "RETENTION_DIR", str(tmp_path / "segments"))
+
+
+@pytest.fixture
+def history() -> DeviceHistory:
+    return DeviceHistory(
+        source=None,
+        device_id="08BEAC0AB2DE",
+        version=None,
+        num_of_records=0,
+        feeds={"AirBox": {}},
+        danger={},
+        daily_metrics={},
+    )
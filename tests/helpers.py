@@ -0,0 +1,22 @@
+from datetime import datetime
+
+from src.data import DeviceRecord
+
+DEVICE = "08BEAC0AB2DE"
+
+
+def add(history, timestamp: datetime, i: int):
+    history.add_record(
+        "AirBox",
+        timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        DeviceRecord.model_construct(
+            app="AirBox",
+            device_id=DEVICE,
+            s_t0=25.0 + i % 10,
+            s_h0=60.0 + i % 7,
+            s_d0=float(i % 80),
+            gps_lat=25.04,
+            gps_lon=121.54,
+            timestamp=timestamp,
+        ),
+    )
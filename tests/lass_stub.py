@@ -0,0 +1,239 @@
+import json
+import math
+import time
+import random
+import asyncio
+import multiprocessing
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+
+class LASSStub:
+    def __init__(
+        self,
+        latency: float = 0.05,
+        start: datetime = None,
+        interval: float = None,
+        history_size: int = 1,
+        drops: int = 0,
+        lost: int = 0,
+        flaky: float = 0.0,
+        seed: int = 0,
+    ):
+        # With an interval the devices report on the wall clock every interval
+        # seconds, otherwise every request returns a new reading. The history
+        # endpoint returns history_size readings a minute apart up to start,
+        # without those of drops random windows, as a poller that was down
+        # would have missed them. Asked with start and end it returns every
+        # reading between them but those of the first lost windows, and
+        # answers a flaky share of such requests with a 503.
+        self.latency = latency
+        self.start = start or datetime(2024, 6, 1, tzinfo=timezone.utc)
+        self.interval = interval
+        self.history_size = history_size
+        self.flaky = flaky
+        self.rng = random.Random(seed)
+        # Windows of minutes before start, as (first, last) with first > last,
+        # apart from each other and within the history.
+        self.dropped: list[tuple[int, int]] = []
+        while len(self.dropped) < min(drops, history_size // 400):
+            length = self.rng.randint(5, 180)
+            first = self.rng.randint(length + 1, history_size - 1)
+            last = first - length + 1
+            if all(last > other + 1 or first < end - 1 for other, end in self.dropped):
+                self.dropped.append((first, last))
+        self.lost = self.dropped[:lost]
+        self.requests = 0
+        # Ranged history requests in flight, and the most at once.
+        self.ranged = 0
+        self.active = 0
+        self.peak = 0
+        self.server = None
+
+    def latest(self, device_id: str) -> dict:
+        if self.interval:
+            reported = datetime.fromtimestamp(
+                time.time() // self.interval * self.interval, timezone.utc
+            )
+        else:
+            reported = self.start + timedelta(seconds=self.requests)
+        timestamp = reported.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return {
+            "source": "stub",
+            "device_id": device_id,
+            "version": timestamp,
+            "num_of_records": 1,
+            "feeds": [
+                {
+                    "AirBox": {
+                        "device_id": device_id,
+                        "s_t0": 25.0,
+                        "s_h0": 60.0,
+                        "s_d0": 12.0,
+                        "gps_lat": 25.04,
+                        "gps_lon": 121.54,
+                        "timestamp": timestamp,
+                    }
+                }
+            ],
+        }
+
+    def timestamp(self, minutes: int) -> str:
+        reported = self.start - timedelta(minutes=minutes)
+        return reported.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def minutes(self, timestamp: str) -> float:
+        reported = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+        return (self.start - reported.replace(tzinfo=timezone.utc)).total_seconds() / 60
+
+    def history(
+        self, device_id: str, since: Optional[str] = None, until: Optional[str] = None
+    ) -> dict:
+        ranged = since is not None or until is not None
+        missing = self.lost if ranged else self.dropped
+        oldest, newest = self.history_size, 1
+        if since:
+            oldest = min(oldest, math.floor(self.minutes(since)))
+        if until:
+            newest = max(newest, math.ceil(self.minutes(until)))
+        entries = []
+        for i in range(oldest, newest - 1, -1):
+            if any(first >= i >= last for first, last in missing):
+                continue
+            timestamp = self.timestamp(i)
+            entries.append(
+                {
+                    timestamp: {
+                        "app": "AirBox",
+                        "device_id": device_id,
+                        "s_t0": 25.0 + i % 10,
+                        "s_h0": 60.0 + i % 7,
+                        "s_d0": float(i % 80),
+                        "gps_lat": 25.04,
+                        "gps_lon": 121.54,
+                        "timestamp": timestamp,
+                    }
+                }
+            )
+        return {
+            "source": "stub",
+            "device_id": device_id,
+            "version": (self.start - timedelta(minutes=1)).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            "num_of_records": len(entries),
+            "feeds": [{"AirBox": entries}],
+        }
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                path = request_line.decode().split(" ")[1]
+                device_id = path.split("/device/")[1].split("/")[0]
+                query = parse_qs(urlsplit(path).query)
+                since = query.get("start", [None])[0]
+                until = query.get("end", [None])[0]
+                ranged = since is not None or until is not None
+                self.requests += 1
+                if ranged:
+                    self.ranged += 1
+                    self.active += 1
+                    self.peak = max(self.peak, self.active)
+                try:
+                    await asyncio.sleep(self.latency)
+                finally:
+                    if ranged:
+                        self.active -= 1
+                if device_id.startswith("FAIL") or (
+                    ranged and self.rng.random() < self.flaky
+                ):
+                    writer.write(
+                        b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n\r\n"
+                    )
+                    await writer.drain()
+                    continue
+                if "/history/" in path:
+                    body = json.dumps(self.history(device_id, since, until)).encode()
+                else:
+                    body = json.dumps(self.latest(device_id)).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/API-1.0.0"
+
+
+def _serve(latency: float, interval: float, history_size: int, port, ready, requests):
+    async def serve():
+        async with LASSStub(
+            latency=latency, interval=interval, history_size=history_size
+        ) as stub:
+            port.value = stub.server.sockets[0].getsockname()[1]
+            ready.set()
+            while True:
+                requests.value = stub.requests
+                await asyncio.sleep(0.05)
+
+    asyncio.run(serve())
+
+
+class LASSStubProcess:
+    def __init__(
+        self, latency: float = 0.05, interval: float = None, history_size: int = 1
+    ):
+        self.latency = latency
+        self.interval = interval
+        self.history_size = history_size
+        self.port = multiprocessing.Value("i", 0)
+        self.ready = multiprocessing.Event()
+        # Requests served so far, updated every 50 ms.
+        self.requests = multiprocessing.Value("i", 0)
+        self.process = None
+
+    def __enter__(self):
+        self.process = multiprocessing.Process(
+            target=_serve,
+            args=(
+                self.latency,
+                self.interval,
+                self.history_size,
+                self.port,
+                self.ready,
+                self.requests,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        self.ready.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port.value}/API-1.0.0"
@@ -0,0 +1,94 @@
+import random
+from typing import Optional
+from datetime import datetime, timedelta, timezone
+
+from src.danger import DANGER_THRESHOLDS
+
+PROJECTS = ["AirBox", "MAPS", "LASS", "Indie", "ProbeCube", "webduino"]
+# Mean length of a run above the danger threshold, in readings.
+EPISODE_LENGTH = 30
+
+
+class PayloadGenerator:
+    # Readings for LASS /history/ and /latest/ payloads. Readings are interval
+    # seconds apart per project and end at end, now by default. About
+    # danger_ratio of them are above the highest danger threshold, in runs
+    # like real pollution episodes. The same seed gives the same values.
+    def __init__(
+        self,
+        device_id: str = "08BEAC0AB2DE",
+        projects: int = 1,
+        danger_ratio: float = 0.1,
+        interval: int = 60,
+        end: Optional[datetime] = None,
+        seed: int = 0,
+    ):
+        self.device_id = device_id
+        self.projects = PROJECTS[:projects]
+        self.danger_ratio = danger_ratio
+        self.interval = interval
+        self.end = end or datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        self.threshold = max(DANGER_THRESHOLDS.values())
+        self.random = random.Random(seed)
+        self.above = False
+
+    def timestamp(self, i: int) -> str:
+        reported = self.end + timedelta(seconds=i * self.interval)
+        return reported.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def pm(self) -> float:
+        # A two state chain whose share of time above the threshold is the
+        # danger ratio.
+        if self.above:
+            self.above = self.random.random() >= 1 / EPISODE_LENGTH
+        elif self.danger_ratio >= 1:
+            self.above = True
+        elif self.danger_ratio > 0:
+            enter = self.danger_ratio / (EPISODE_LENGTH * (1 - self.danger_ratio))
+            self.above = self.random.random() < enter
+        if self.above:
+            return round(self.random.uniform(self.threshold + 1, self.threshold * 3), 2)
+        return round(self.random.uniform(1, self.threshold - 1), 2)
+
+    def reading(self, project: str, i: int) -> dict:
+        return {
+            "app": project,
+            "device_id": self.device_id,
+            "s_t0": round(self.random.uniform(15, 35), 2),
+            "s_h0": round(self.random.uniform(40, 95), 2),
+            "s_d0": self.pm(),
+            "gps_lat": 25.04,
+            "gps_lon": 121.54,
+            "timestamp": self.timestamp(i),
+        }
+
+    def history(self, count: int) -> dict:
+        # count readings in total, split over the projects and ending at end.
+        per_project = -(-count // len(self.projects))
+        feeds = {project: [] for project in self.projects}
+        for i in range(-per_project, 0):
+            for project in self.projects:
+                reading = self.reading(project, i + 1)
+                feeds[project].append({reading["timestamp"]: reading})
+        return {
+            "source": "generator",
+            "device_id": self.device_id,
+            "version": self.timestamp(0),
+            "num_of_records": per_project * len(self.projects),
+            "feeds": [feeds],
+        }
+
+    def latest(self, i: int) -> dict:
+        # The i-th reading after end, one per project.
+        feeds = {}
+        for project in self.projects:
+            reading = self.reading(project, i)
+            del reading["app"]
+            feeds[project] = reading
+        return {
+            "source": "generator",
+            "device_id": self.device_id,
+            "version": self.timestamp(i),
+            "num_of_records": len(self.projects),
+            "feeds": [feeds],
+        }
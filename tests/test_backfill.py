@@ -0,0 +1,276 @@
+import math
+import asyncio
+from datetime import timedelta
+
+from src.backfill import Backfill
+from src.poller import DevicePoller
+from src.store import to_epoch
+from tests.lass_stub import LASSStub
+
+DEVICES = [f"GAP{i:05d}" for i in range(3)]
+HISTORY = 2_880
+DROPS = 6
+LOST = 2
+CONCURRENCY = 3
+CHUNK = 3600
+
+
+def expected(stub: LASSStub) -> set[int]:
+    # Every reading LASS still has.
+    return {
+        to_epoch(stub.start - timedelta(minutes=i))
+        for i in range(1, stub.history_size + 1)
+        if not any(first >= i >= last for first, last in stub.lost)
+    }
+
+
+def epochs(poller: DevicePoller, device_id: str) -> set[int]:
+    return {row[0] for row in poller.view(device_id).feeds["AirBox"].range()}
+
+
+def reading(stub: LASSStub, device_id: str, minutes: int) -> dict:
+    # A live reading, minutes after the history.
+    payload = stub.latest(device_id)
+    entry = payload["feeds"][0]["AirBox"]
+    timestamp = (stub.start + timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    entry["timestamp"] = payload["version"] = timestamp
+    return payload
+
+
+async def loaded(stub: LASSStub, directory: str = "") -> DevicePoller:
+    poller = DevicePoller(DEVICES, base_url=stub.url)
+    if directory:
+        await poller.restore(directory)
+    await poller.fetch_histories()
+    return poller
+
+
+def test_recovery(tmp_path):
+    # The gaps the stub dropped from the history are found and filled, but
+    # the windows it lost, with a fifth of the requests failing, while live
+    # readings keep being applied.
+    async def recover():
+        async with LASSStub(
+            latency=0.005,
+            history_size=HISTORY,
+            drops=DROPS,
+            lost=LOST,
+            flaky=0.2,
+            seed=1,
+        ) as stub:
+            poller = await loaded(stub)
+            try:
+                held = {device_id: epochs(poller, device_id) for device_id in DEVICES}
+                backfill = Backfill(
+                    poller,
+                    concurrency=CONCURRENCY,
+                    retries=8,
+                    chunk=CHUNK,
+                    max_backoff=0.01,
+                    checkpoint=str(tmp_path / "backfill.json"),
+                )
+                stop = asyncio.Event()
+
+                async def live() -> int:
+                    minutes = 0
+                    while not stop.is_set():
+                        minutes += 1
+                        await poller.offload(
+                            poller.process_response,
+                            DEVICES[0],
+                            reading(stub, DEVICES[0], minutes),
+                        )
+                        await asyncio.sleep(0.005)
+                    return minutes
+
+                polling = asyncio.create_task(live())
+                added = await backfill.run_once()
+                stop.set()
+                minutes = await polling
+
+                full = expected(stub)
+                for device_id in DEVICES:
+                    found = epochs(poller, device_id)
+                    assert full <= found and held[device_id] <= found
+                    assert len(found - full - held[device_id]) == (
+                        minutes if device_id == DEVICES[0] else 0
+                    )
+                    assert poller.histories[device_id].num_of_records == len(found)
+                    assert poller.view(device_id).num_of_records == len(found)
+                assert added == sum(len(full - held[d]) for d in DEVICES) > 0
+                assert backfill.failed == 0 and stub.peak <= CONCURRENCY
+                newest = reading(stub, DEVICES[0], minutes)
+                assert poller.histories[DEVICES[0]].version == newest["version"]
+
+                # The daily metrics and rolling windows end as those of a
+                # device that never missed a reading.
+                reference = DevicePoller([DEVICES[1]])
+                reference.process_init_response(
+                    DEVICES[1],
+                    stub.history(
+                        DEVICES[1], stub.timestamp(HISTORY), stub.timestamp(1)
+                    ),
+                )
+                ours = poller.view(DEVICES[1])
+                theirs = reference.view(DEVICES[1])
+                assert ours.daily_metrics.keys() == theirs.daily_metrics.keys()
+                for day, metrics in ours.daily_metrics.items():
+                    other = theirs.daily_metrics[day]
+                    assert (metrics.count, metrics.min, metrics.max) == (
+                        other.count,
+                        other.min,
+                        other.max,
+                    )
+                    assert math.isclose(metrics.avg, other.avg, abs_tol=0.1)
+                for name, value in ours.rolling().items():
+                    other = theirs.rolling()[name]
+                    assert (value.count, value.min, value.max) == (
+                        other.count,
+                        other.min,
+                        other.max,
+                    )
+
+                # The lost windows brought nothing and are not asked for
+                # again, by this run or the next process.
+                requests = stub.ranged
+                assert await backfill.run_once() == 0 and stub.ranged == requests
+                restarted = Backfill(
+                    poller, chunk=CHUNK, checkpoint=str(tmp_path / "backfill.json")
+                )
+                restarted.load()
+                restarted.semaphore = asyncio.Semaphore(CONCURRENCY)
+                assert await restarted.run_once() == 0 and stub.ranged == requests
+            finally:
+                await poller.aclose()
+
+    asyncio.run(recover())
+
+
+def test_resume(tmp_path):
+    # A backfill stopped half way, whose process restarts from its snapshots,
+    # fetches the chunks it had not merged yet and nothing else.
+    async def resume():
+        async with LASSStub(
+            latency=0.005, history_size=HISTORY, drops=DROPS, lost=LOST, seed=2
+        ) as stub:
+            checkpoint = str(tmp_path / "resume.json")
+            poller = await loaded(stub)
+            try:
+                first = Backfill(
+                    poller, concurrency=1, chunk=CHUNK, checkpoint=checkpoint
+                )
+                first.semaphore = asyncio.Semaphore(1)
+                total = sum(
+                    [len(await first.pending(device_id)) for device_id in DEVICES]
+                )
+                task = asyncio.create_task(first.run_once())
+                while first.fetched < total // 2:
+                    await asyncio.sleep(0.001)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                await poller.drain()
+                await poller.save_snapshots(str(tmp_path))
+            finally:
+                await poller.aclose()
+
+            poller = await loaded(stub, str(tmp_path))
+            try:
+                second = Backfill(poller, chunk=CHUNK, checkpoint=checkpoint)
+                second.load()
+                left = sum(
+                    [len(await second.pending(device_id)) for device_id in DEVICES]
+                )
+                # The gap a device was filling restarts after its last
+                # reading, so at most the tail of that chunk is asked for
+                # again.
+                assert 0 < left <= total - first.fetched + len(DEVICES)
+                before = stub.ranged
+                assert await second.run_once() > 0
+                assert stub.ranged - before == second.fetched == left
+                for device_id in DEVICES:
+                    assert expected(stub) == epochs(poller, device_id)
+            finally:
+                await poller.aclose()
+
+    asyncio.run(resume())
+
+
+def test_backfilled_readings_are_not_sent_live():
+    # Subscribers get one backfill event per device filled in, no readings.
+    async def backfill() -> dict:
+        async with LASSStub(
+            latency=0.001, history_size=HISTORY, drops=DROPS, seed=3
+        ) as stub:
+            poller = await loaded(stub)
+            try:
+                queues = {d: poller.broadcaster.subscribe(d) for d in DEVICES}
+                assert await Backfill(poller, chunk=CHUNK).run_once() > 0
+                events = {}
+                for device_id, queue in queues.items():
+                    events[device_id] = []
+                    while not queue.empty():
+                        message = queue.get_nowait()
+                        events[device_id].append(message.split("\n")[0])
+                return events
+            finally:
+                await poller.aclose()
+
+    events = asyncio.run(backfill())
+    assert events == {d: ["event: backfill"] for d in DEVICES}
+
+
+def test_a_failed_chunk_does_not_stop_the_others(tmp_path):
+    # An unexpected error fails its chunk alone, the next run fetches it again.
+    async def backfill():
+        async with LASSStub(
+            latency=0.001, history_size=HISTORY, drops=DROPS, seed=4
+        ) as stub:
+            poller = await loaded(stub)
+            try:
+                process = poller.process_backfill
+                failing = []
+
+                def broken(device_id, data, start, end):
+                    if device_id == DEVICES[0] and not failing:
+                        failing.append(start)
+                        raise RuntimeError("broken")
+                    return process(device_id, data, start, end)
+
+                poller.process_backfill = broken
+                backfill = Backfill(
+                    poller, chunk=CHUNK, checkpoint=str(tmp_path / "backfill.json")
+                )
+                assert await backfill.run_once() > 0
+                assert backfill.failed == 1 and len(failing) == 1
+                for device_id in DEVICES[1:]:
+                    assert expected(stub) == epochs(poller, device_id)
+                assert expected(stub) != epochs(poller, DEVICES[0])
+
+                assert await backfill.run_once() > 0 and backfill.failed == 1
+                assert expected(stub) == epochs(poller, DEVICES[0])
+            finally:
+                await poller.aclose()
+
+    asyncio.run(backfill())
+
+
+def test_the_run_loop_outlives_errors():
+    runs = []
+
+    async def run_once():
+        runs.append(len(runs))
+        if len(runs) == 1:
+            raise RuntimeError("broken")
+        return 0
+
+    async def run():
+        backfill = Backfill(DevicePoller(DEVICES), checkpoint="")
+        backfill.run_once = run_once
+        task = asyncio.create_task(backfill.run(interval=0.001))
+        while len(runs) < 3:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert len(runs) >= 3
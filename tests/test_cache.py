@@ -0,0 +1,158 @@
+import gzip
+import json
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+from src.app import PM_Analyzer
+from src.cache import ResponseCache
+from src.data import DeviceRecord
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+HISTORY_SIZE = 10_080
+PATHS = ["/data/metrics/", "/data/danger", "/data", "/"]
+
+
+def service() -> PM_Analyzer:
+    analyzer = PM_Analyzer([DEVICE])
+    analyzer.poller.process_init_response(
+        DEVICE, PayloadGenerator(DEVICE, danger_ratio=0.2).history(HISTORY_SIZE)
+    )
+    analyzer.poller.publish(DEVICE)
+    return analyzer
+
+
+def without_keys(value):
+    # Stored metrics get a new key in every service.
+    if isinstance(value, dict):
+        return {k: without_keys(v) for k, v in value.items() if k != "pk"}
+    if isinstance(value, list):
+        return [without_keys(item) for item in value]
+    return value
+
+
+def decode(response: httpx.Response):
+    if response.headers["content-type"].startswith("text/html"):
+        return response.text
+    return without_keys(json.loads(response.content))
+
+
+def client(analyzer: PM_Analyzer) -> httpx.AsyncClient:
+    transport = httpx.ASGITransport(app=analyzer.app)
+    return httpx.AsyncClient(transport=transport, base_url="http://app")
+
+
+@pytest.mark.parametrize("path", PATHS)
+def test_cached_gzip_and_304_responses_agree(path):
+    # Every way of asking returns the same document as serializing afresh.
+    analyzer = service()
+
+    async def ask():
+        async with client(analyzer) as c:
+            plain = await c.get(path, headers={"Accept-Encoding": "identity"})
+            assert plain.status_code == 200 and "content-encoding" not in plain.headers
+            again = await c.get(path, headers={"Accept-Encoding": "identity"})
+            assert again.content == plain.content
+
+            request = c.build_request("GET", path, headers={"Accept-Encoding": "gzip"})
+            zipped = await c.send(request, stream=True)
+            assert zipped.headers["content-encoding"] == "gzip"
+            raw = b"".join([chunk async for chunk in zipped.aiter_raw()])
+            assert gzip.decompress(raw) == plain.content
+            zipped = await c.send(request)
+            assert decode(zipped) == decode(plain)
+            tag = plain.headers["etag"]
+            assert zipped.headers["etag"] == tag
+
+            matched = await c.get(path, headers={"If-None-Match": tag})
+            assert matched.status_code == 304 and matched.content == b""
+            stale = await c.get(path, headers={"If-None-Match": 'W/"other"'})
+            assert stale.status_code == 200
+
+        fresh = service()
+        fresh.responses = ResponseCache(max_bytes=0)
+        async with client(fresh) as other:
+            assert decode(await other.get(path)) == decode(plain)
+
+    asyncio.run(ask())
+
+
+def test_a_new_reading_changes_every_tag():
+    analyzer = service()
+
+    async def ask():
+        async with client(analyzer) as c:
+            tags = {path: (await c.get(path)).headers["etag"] for path in PATHS}
+            analyzer.poller.process_response(
+                DEVICE, PayloadGenerator(DEVICE, seed=1).latest(1)
+            )
+            for path in PATHS:
+                response = await c.get(path, headers={"If-None-Match": tags[path]})
+                assert response.status_code == 200, path
+                assert response.headers["etag"] != tags[path]
+            data = (await c.get("/data")).json()
+            assert data["num_of_records"] == HISTORY_SIZE + 1
+
+    asyncio.run(ask())
+
+
+def test_concurrent_compression_is_counted_once():
+    cache = ResponseCache(max_bytes=2**20)
+    entry = cache.put(("/data", ""), "tag", b"x" * 10_000)
+
+    async def compress():
+        return await asyncio.gather(
+            *(cache.compress(("/data", ""), entry) for _ in range(8))
+        )
+
+    results = asyncio.run(compress())
+    assert all(result is results[0] for result in results)
+    assert cache.bytes == entry.size == len(entry.body) + len(results[0])
+
+
+def test_tags_follow_every_change_of_the_view():
+    service = PM_Analyzer([DEVICE])
+    poller = service.poller
+    generator = PayloadGenerator(DEVICE)
+    poller.process_init_response(DEVICE, generator.history(500))
+
+    async def get(headers: dict = {}) -> httpx.Response:
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as c:
+            return await c.get("/data", headers=headers)
+
+    first = asyncio.run(get())
+    tag = first.headers["etag"]
+    assert "last-modified" not in first.headers
+    assert asyncio.run(get({"If-None-Match": tag})).status_code == 304
+    assert (
+        asyncio.run(
+            get({"If-Modified-Since": "Fri, 01 Jan 2100 00:00:00 GMT"})
+        ).status_code
+        == 200
+    )
+
+    # An older reading, as a backfill brings, is not newer than the version.
+    history = poller.histories[DEVICE]
+    oldest = min(next(records.range())[0] for records in history.feeds.values())
+    timestamp = datetime.fromtimestamp(oldest, timezone.utc) - timedelta(hours=1)
+    history.add_record(
+        "AirBox",
+        timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        DeviceRecord.model_construct(
+            app="AirBox",
+            device_id=DEVICE,
+            s_t0=25.0,
+            s_h0=60.0,
+            s_d0=12.0,
+            gps_lat=25.04,
+            gps_lon=121.54,
+            timestamp=timestamp,
+        ),
+    )
+    poller.publish(DEVICE)
+    backfilled = asyncio.run(get({"If-None-Match": tag}))
+    assert backfilled.status_code == 200 and backfilled.headers["etag"] != tag
@@ -0,0 +1,156 @@
+import os
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import src.data
+import src.retention
+from src.cluster import STATUS_FILE, Coordinator, Lease
+from src.data import DeviceRecord
+from src.persistence import SQLiteBackend
+from src.poller import DevicePoller
+from src.snapshot import snapshot_path
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+
+
+def test_corrupt_shared_files_are_skipped(tmp_path):
+    # A follower logs a corrupt status file or snapshot, keeps following and
+    # loads them once the leader replaces them.
+    directory = str(tmp_path)
+    poller = DevicePoller([DEVICE])
+    coordinator = Coordinator(
+        poller, directory, lease=Lease(str(tmp_path / "poller.lease"))
+    )
+    with open(os.path.join(directory, STATUS_FILE), "w") as file:
+        file.write('{"devices": [{"device_id"')
+    with open(snapshot_path(DEVICE, directory), "wb") as file:
+        file.write(b"PMSNAP02" + b"\xff" * 64)
+
+    async def follow():
+        try:
+            await poller.prepare(DEVICE)
+            await coordinator.follow_once()
+            assert coordinator.statuses == {}
+            assert poller.view(DEVICE).num_of_records == 0
+
+            leader = DevicePoller([DEVICE])
+            leader.process_init_response(DEVICE, PayloadGenerator(DEVICE).history(200))
+            leader.status[DEVICE].ready = True
+            await Coordinator(leader, directory).share()
+            await coordinator.follow_once()
+        finally:
+            await poller.drain()
+
+    asyncio.run(follow())
+    assert poller.view(DEVICE).num_of_records == 200
+    assert poller.status[DEVICE].ready
+
+
+def test_readings_are_shared_as_deltas(tmp_path):
+    # Between full snapshots the leader appends what it added, and a follower
+    # replays it into the same view.
+    directory = str(tmp_path)
+    payloads = PayloadGenerator(DEVICE, projects=2, danger_ratio=0.3)
+    leader = DevicePoller([DEVICE])
+    leader.process_init_response(DEVICE, payloads.history(500))
+    leader.status[DEVICE].ready = True
+    sharing = Coordinator(leader, directory)
+    follower = DevicePoller([DEVICE])
+    following = Coordinator(
+        follower, directory, lease=Lease(str(tmp_path / "poller.lease"))
+    )
+    snapshot = snapshot_path(DEVICE, directory)
+
+    def same(view, other) -> bool:
+        return (
+            view.num_of_records == other.num_of_records
+            and view.version == other.version
+            and view.rolling() == other.rolling()
+            and {name: list(index.starts) for name, index in view.danger.items()}
+            == {name: list(index.starts) for name, index in other.danger.items()}
+            and {day: m.count for day, m in view.daily_metrics.items()}
+            == {day: m.count for day, m in other.daily_metrics.items()}
+        )
+
+    async def share():
+        try:
+            await follower.prepare(DEVICE)
+            await sharing.share()
+            written = os.stat(snapshot).st_ino
+            await following.follow_once()
+            assert same(follower.view(DEVICE), leader.view(DEVICE))
+
+            for i in range(1, 40):
+                leader.process_response(DEVICE, payloads.latest(i))
+                if i % 10 == 0:
+                    await sharing.share()
+                    await following.follow_once()
+                    assert same(follower.view(DEVICE), leader.view(DEVICE))
+            assert os.stat(snapshot).st_ino == written
+            await sharing.share()
+            await following.follow_once()
+            assert same(follower.view(DEVICE), leader.view(DEVICE))
+            assert os.stat(snapshot).st_ino == written
+
+            # A reading older than those shared takes a new snapshot.
+            leader.process_response(DEVICE, payloads.latest(-1000))
+            await sharing.share()
+            assert os.stat(snapshot).st_ino != written
+            await following.follow_once()
+            assert same(follower.view(DEVICE), leader.view(DEVICE))
+        finally:
+            await follower.drain()
+
+    asyncio.run(share())
+    assert follower.view(DEVICE).num_of_records == 500 + 2 * 39 + 2
+
+
+def test_followers_leave_retention_to_the_leader(monkeypatch, tmp_path):
+    # Histories a follower loads from storage are not spilled into the
+    # segments the leader writes, until it takes the lease itself.
+    monkeypatch.setattr(src.retention, "RETENTION_WINDOW", "1d")
+    src.retention.retention_window.cache_clear()
+    backend = SQLiteBackend(DeviceRecord, str(tmp_path / "records.db"))
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    backend.append(
+        [
+            DeviceRecord(
+                app="AirBox",
+                device_id=DEVICE,
+                s_t0=25.0,
+                s_h0=60.0,
+                s_d0=float(i % 80),
+                gps_lat=25.04,
+                gps_lon=121.54,
+                timestamp=start + timedelta(minutes=i),
+            )
+            for i in range(7 * 1440)
+        ]
+    )
+    monkeypatch.setattr(src.data, "STORAGE", backend)
+    segments = tmp_path / "segments"
+
+    async def prepare(poller: DevicePoller) -> DevicePoller:
+        try:
+            await poller.prepare(DEVICE)
+        finally:
+            await poller.drain()
+        return poller
+
+    try:
+        follower = DevicePoller([DEVICE])
+        Coordinator(follower, str(tmp_path), lease=Lease(str(tmp_path / "lease")))
+        assert follower.role == "follower"
+        asyncio.run(prepare(follower))
+        records = follower.histories[DEVICE].feeds["AirBox"]
+        assert len(records) == 7 * 1440 and not records.segments
+        assert not segments.exists()
+
+        standalone = asyncio.run(prepare(DevicePoller([DEVICE])))
+        records = standalone.histories[DEVICE].feeds["AirBox"]
+        assert len(records) == 7 * 1440 and records.segments
+        assert segments.exists()
+    finally:
+        backend.close()
+        src.retention.retention_window.cache_clear()
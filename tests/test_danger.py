@@ -0,0 +1,117 @@
+import math
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from src.app import PM_Analyzer
+from src.danger import DangerIndex, DangerSummary
+from src.days import Days
+from src.store import from_epoch, to_epoch
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+T0 = to_epoch(START)
+HOUR = 3600
+
+
+def state(index: DangerIndex) -> list[tuple]:
+    return list(zip(index.starts, index.ends, index.peaks, index.counts))
+
+
+def filled(values: list[float], threshold: float = 30.0) -> DangerIndex:
+    # A reading a minute.
+    index = DangerIndex(threshold, Days("UTC"))
+    for i, value in enumerate(values):
+        index.add(T0 + 60 * i, value)
+    return index
+
+
+def test_runs_above_the_threshold():
+    # A reading at the threshold is not above it and ends the run, a missing
+    # one neither counts nor ends it.
+    index = filled([10, 31, 40, math.nan, 35, 30, 50, 29, 30.5])
+    assert state(index) == [
+        (T0 + 60, T0 + 240, 40.0, 3),
+        (T0 + 360, T0 + 360, 50.0, 1),
+        (T0 + 480, T0 + 480, 30.5, 1),
+    ]
+    assert index.open and index.last == T0 + 480
+
+
+def test_late_readings():
+    index = filled([40, 41, 42, 10, 10, 10, 45, 46])
+    # Inside an episode it joins it, below the threshold it does not split it.
+    index.add(T0 + 30, 60.0)
+    index.add(T0 + 90, 5.0)
+    # Between episodes or before the first it is an episode of its own, and
+    # it does not merge the episodes around it.
+    index.add(T0 + 240, 33.0)
+    index.add(T0 - 600, 31.0)
+    assert state(index) == [
+        (T0 - 600, T0 - 600, 31.0, 1),
+        (T0, T0 + 120, 60.0, 4),
+        (T0 + 240, T0 + 240, 33.0, 1),
+        (T0 + 360, T0 + 420, 46.0, 2),
+    ]
+    assert all(a < b for a, b in zip(index.ends, index.starts[1:]))
+    # A late reading does not close the open episode.
+    index.add(T0 + 480, 50.0)
+    assert state(index)[-1] == (T0 + 360, T0 + 480, 50.0, 3)
+
+
+def test_counts_by_hour_and_local_day():
+    # Days follow the zone of the index, hours are whole in both.
+    index = DangerIndex(30.0, Days("Asia/Taipei"))
+    epochs = [T0 + 15 * HOUR + 59 * 60, T0 + 16 * HOUR, T0 + 16 * HOUR + 60]
+    for epoch in epochs:
+        index.add(epoch, 40.0)
+    index.add(T0 + 17 * HOUR, 20.0)
+    taipei = T0 - 8 * HOUR
+    assert index.exceedances["day"] == {taipei + 86400: 2, taipei: 1}
+    assert index.exceedances["hour"] == {T0 + 15 * HOUR: 1, T0 + 16 * HOUR: 2}
+    assert sum(index.exceedances["day"].values()) == sum(index.counts) == 3
+
+
+def test_pages_and_summary():
+    index = filled([40, 10] * 50)
+    assert len(index) == 50
+    episodes, cursor = index.page(limit=20)
+    assert len(episodes) == 20 and cursor == T0 + 40 * 60
+    episodes, cursor = index.page(start=cursor, limit=20)
+    assert episodes[0].start == from_epoch(T0 + 40 * 60) and cursor is not None
+    episodes, cursor = index.page(start=T0 + 61, end=T0 + 300)
+    assert [to_epoch(e.start) for e in episodes] == [T0 + 120, T0 + 240]
+    assert cursor is None
+
+    restored = DangerIndex.validate(DangerSummary.model_validate(index.summary()))
+    assert state(restored) == state(index)
+    frozen = index.freeze()
+    index.add(T0 + 100 * 60, 45.0)
+    assert len(frozen) == 50 and len(index) == 51
+
+
+def test_endpoints_count_every_exceedance():
+    service = PM_Analyzer([DEVICE])
+    history = service.poller.history(DEVICE)
+    # The dust level ramps from 0 to 79 every 80 minutes, so every ramp
+    # crosses the threshold once.
+    for i in range(5_000):
+        add(history, START + timedelta(minutes=i), i)
+    service.poller.publish(DEVICE)
+    index = history.danger["local"]
+    above = sum(1 for row in history.feeds["AirBox"].range() if row[3] > 30.0)
+
+    async def ask():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as c:
+            days = (await c.get("/data/danger/counts")).json()
+            hours = (await c.get("/data/danger/counts?resolution=hour")).json()
+            page = (await c.get("/data/danger?limit=10")).json()
+            return days, hours, page
+
+    days, hours, page = asyncio.run(ask())
+    assert len(index) == -(-5_000 // 80)
+    assert sum(index.counts) == sum(days.values()) == sum(hours.values()) == above
+    assert len(page["episodes"]) == 10 and page["next_cursor"] is not None
+    assert all(episode["count"] == 49 for episode in page["episodes"])
@@ -0,0 +1,48 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from src.data import DeviceRecord
+
+
+def record(minute: int, s_d0) -> tuple[str, DeviceRecord]:
+    timestamp = datetime(2024, 1, 1, 0, minute, tzinfo=timezone.utc)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"), DeviceRecord.model_construct(
+        app="AirBox",
+        device_id="08BEAC0AB2DE",
+        s_t0=25.0,
+        s_h0=60.0,
+        s_d0=s_d0,
+        gps_lat=25.04,
+        gps_lon=121.54,
+        timestamp=timestamp,
+    )
+
+
+def test_reading_without_s_d0_is_stored_but_not_derived(history):
+    assert history.add_record("AirBox", *record(1, None))
+    records = history.feeds["AirBox"]
+    assert len(records) == 1 and history.num_of_records == 1
+    assert history.daily_metrics == {}
+    assert all(len(index) == 0 for index in history.danger.values())
+    assert all(value.count == 0 for value in history.rolling().values())
+
+    # Not taken again, and the readings after it count as usual.
+    assert not history.add_record("AirBox", *record(1, 80.0))
+    assert history.add_record("AirBox", *record(2, 80.0))
+    assert history.num_of_records == 2
+    (metrics,) = history.daily_metrics.values()
+    assert metrics.count == 1 and metrics.max == 80.0
+    assert all(len(index) == 1 for index in history.danger.values())
+    assert history.freeze().num_of_records == 2
+
+
+def test_invalid_s_d0_stores_nothing(history):
+    with pytest.raises(ValueError):
+        history.add_record("AirBox", *record(1, "high"))
+    records = history.feeds["AirBox"]
+    assert len(records) == 0 and history.num_of_records == 0
+    assert all(not list(tier.range()) for tier in records.rollups.values())
+
+    assert history.add_record("AirBox", *record(1, 12.5))
+    assert history.num_of_records == 1 and len(records) == 1
@@ -0,0 +1,147 @@
+import csv
+import json
+import asyncio
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from src.app import PM_Analyzer
+from src.export import EXPORT_BATCH_SIZE
+from src.store import COLUMNS
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+COUNT = 5 * EXPORT_BATCH_SIZE + 7
+
+
+def filled(count: int) -> PM_Analyzer:
+    service = PM_Analyzer([DEVICE])
+    history = service.poller.history(DEVICE)
+    for i in range(count):
+        add(history, START + timedelta(minutes=5 * i), i)
+    service.poller.publish(DEVICE)
+    return service
+
+
+@pytest.fixture
+def service() -> PM_Analyzer:
+    return filled(COUNT)
+
+
+def request(
+    service: PM_Analyzer, path: str, query: str = "", keep: bool = True
+) -> tuple[int, list]:
+    # Drives the ASGI app directly and keeps every body message apart, or
+    # only their sizes.
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 8000),
+    }
+    status = 0
+    bodies = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if requested:
+            await asyncio.Event().wait()
+        requested = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body" and message.get("body"):
+            bodies.append(message["body"] if keep else len(message["body"]))
+
+    asyncio.run(service.app(scope, receive, send))
+    return status, bodies
+
+
+def test_ndjson_is_streamed_in_batches(service):
+    # No message holds more than a batch, so memory does not grow with the
+    # history.
+    status, bodies = request(service, "/data/export", "format=ndjson")
+    assert status == 200
+    assert len(bodies) == -(-COUNT // EXPORT_BATCH_SIZE)
+    assert all(body.count(b"\n") <= EXPORT_BATCH_SIZE for body in bodies)
+    lines = b"".join(bodies).decode().splitlines()
+    assert len(lines) == COUNT
+    first, last = json.loads(lines[0]), json.loads(lines[-1])
+    assert first == {
+        "project": "AirBox",
+        "timestamp": "2024-01-01T00:00:00Z",
+        "s_t0": 25.0,
+        "s_h0": 60.0,
+        "s_d0": 0.0,
+        "gps_lat": 25.04,
+        "gps_lon": 121.54,
+    }
+    end = START + timedelta(minutes=5 * (COUNT - 1))
+    assert last["timestamp"] == end.strftime("%Y-%m-%dT%H:%M:%SZ")
+    assert last["s_d0"] == float((COUNT - 1) % 80)
+
+
+def test_export_memory_is_bounded():
+    # The peak while exporting stays the same whatever the history holds.
+    peaks = []
+    for count in (5 * EXPORT_BATCH_SIZE, 50 * EXPORT_BATCH_SIZE):
+        service = filled(count)
+        tracemalloc.start()
+        try:
+            status, sizes = request(service, "/data/export", "format=ndjson", False)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        assert status == 200 and len(sizes) == count // EXPORT_BATCH_SIZE
+    small, large = peaks
+    assert large < 1.5 * small
+    # Well below the export itself, which is held nowhere in full.
+    assert large < sum(sizes) / 4
+
+
+def test_csv(service):
+    status, bodies = request(
+        service, f"/devices/{DEVICE}/data/export", "format=csv&columns=s_d0,s_t0"
+    )
+    assert status == 200
+    rows = list(csv.reader(b"".join(bodies).decode().splitlines()))
+    assert rows[0] == ["project", "timestamp", "s_d0", "s_t0"]
+    assert len(rows) == COUNT + 1
+    assert rows[1] == ["AirBox", "2024-01-01T00:00:00Z", "0.0", "25.0"]
+    assert rows[81] == ["AirBox", "2024-01-01T06:40:00Z", "0.0", "25.0"]
+
+
+def test_range(service):
+    start = START + timedelta(hours=1)
+    end = START + timedelta(hours=2)
+    query = (
+        f"start={start.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+        f"&end={end.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+    )
+    status, bodies = request(service, "/data/export", query)
+    assert status == 200
+    lines = [json.loads(line) for line in b"".join(bodies).decode().splitlines()]
+    assert len(lines) == 12 and set(lines[0]) == {"project", "timestamp", *COLUMNS}
+    assert lines[0]["timestamp"] == "2024-01-01T01:00:00Z"
+    assert lines[-1]["timestamp"] == "2024-01-01T01:55:00Z"
+
+
+@pytest.mark.parametrize(
+    "query, expected",
+    [("project=MAPS", 404), ("columns=s_d0,pm25", 400), ("format=xml", 422)],
+)
+def test_invalid(service, query, expected):
+    assert request(service, "/data/export", query)[0] == expected
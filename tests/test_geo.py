@@ -0,0 +1,143 @@
+import random
+import asyncio
+
+import httpx
+import pytest
+
+from src.app import PM_Analyzer
+from src.geo import SpatialIndex, distance
+from tests.payloads import PayloadGenerator
+
+
+def positions(count: int, seed: int) -> dict[str, tuple[float, float]]:
+    # Anywhere on earth, and as many again packed around the antimeridian and
+    # the poles.
+    rng = random.Random(seed)
+    found = {}
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        elif kind == 1:
+            lat, lon = rng.uniform(-60, 60), rng.choice((-1, 1)) * rng.uniform(179, 180)
+        else:
+            lat = rng.choice((-1, 1)) * rng.uniform(89, 90)
+            lon = rng.uniform(-180, 180)
+        found[f"GEO{i:05d}"] = (round(lat, 5), round(lon, 5))
+    return found
+
+
+def points(seed: int) -> list[tuple[float, float]]:
+    rng = random.Random(seed)
+    return [
+        (0.0, 180.0),
+        (10.0, -179.99),
+        (90.0, 0.0),
+        (-90.0, 45.0),
+        (89.95, 179.9),
+        *((rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(40)),
+    ]
+
+
+@pytest.fixture(params=[0.05, 1.0, 30.0])
+def index(request) -> tuple[SpatialIndex, dict]:
+    devices = positions(2_000, seed=1)
+    index = SpatialIndex(request.param)
+    for device_id, (lat, lon) in devices.items():
+        index.update(device_id, lat, lon, 0)
+    return index, devices
+
+
+def test_nearest(index):
+    index, devices = index
+    for lat, lon in points(seed=2):
+        expected = sorted(
+            (distance(lat, lon, *position), device_id)
+            for device_id, position in devices.items()
+        )[:10]
+        found = [(km, p.device_id) for km, p in index.nearest(lat, lon, 10)]
+        assert found == expected, (lat, lon)
+
+
+@pytest.mark.parametrize("radius", [1.0, 150.0, 3_000.0, 25_000.0])
+def test_within_radius(index, radius):
+    index, devices = index
+    for lat, lon in points(seed=3):
+        expected = sorted(
+            (km, device_id)
+            for device_id, position in devices.items()
+            if (km := distance(lat, lon, *position)) <= radius
+        )
+        found = [(km, p.device_id) for km, p in index.within_radius(lat, lon, radius)]
+        assert found == expected, (lat, lon)
+
+
+@pytest.mark.parametrize(
+    "box",
+    [
+        (20.0, 120.0, 26.0, 122.0),
+        (-60.0, 179.5, 60.0, -179.5),
+        (-10.0, 170.0, 10.0, -170.0),
+        (89.0, -180.0, 90.0, 180.0),
+        (-90.0, -180.0, 90.0, 180.0),
+    ],
+)
+def test_within_box(index, box):
+    # A box whose west is east of its east crosses the antimeridian.
+    index, devices = index
+    south, west, north, east = box
+    expected = sorted(
+        device_id
+        for device_id, (lat, lon) in devices.items()
+        if south <= lat <= north
+        and (west <= lon <= east if west <= east else lon >= west or lon <= east)
+    )
+    assert [p.device_id for p in index.within_box(*box)] == expected
+
+
+def test_moves_and_removals():
+    index = SpatialIndex()
+    index.update("A", 25.0, 121.5, 0)
+    index.update("B", 25.01, 121.5, 0)
+    index.update("A", -33.9, 151.2, 1)
+    assert [p.device_id for _, p in index.nearest(25.0, 121.5, 1)] == ["B"]
+    assert [p.device_id for p in index.within_box(-34, 151, -33, 152)] == ["A"]
+    index.remove("B")
+    index.remove("missing")
+    assert len(index) == 1 and len(index.cells) == 1
+    assert [p.device_id for _, p in index.nearest(25.0, 121.5, 5)] == ["A"]
+    assert SpatialIndex().nearest(0, 0, 3) == []
+
+
+def test_endpoints():
+    # Each device found comes with its current reading and daily metrics.
+    service = PM_Analyzer([])
+    poller = service.poller
+    for i, (device_id, (lat, lon)) in enumerate(positions(200, seed=4).items()):
+        payload = PayloadGenerator(device_id, seed=i).latest(1)
+        reading = payload["feeds"][0]["AirBox"]
+        reading.update(device_id=device_id, gps_lat=lat, gps_lon=lon)
+        poller.process_response(device_id, payload)
+    assert len(poller.positions) == 200
+
+    async def ask():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as c:
+            nearest = (await c.get("/devices/nearest?lat=0&lon=180&k=5")).json()
+            radius = (await c.get("/devices/within?lat=89.5&lon=0&radius=200")).json()
+            box = (
+                await c.get("/devices/within?south=-60&west=179&north=60&east=-179")
+            ).json()
+            invalid = await c.get("/devices/within?lat=25")
+            return nearest, radius, box, invalid.status_code
+
+    nearest, radius, box, invalid = asyncio.run(ask())
+    assert len(nearest) == 5
+    assert [d["distance_km"] for d in nearest] == sorted(
+        d["distance_km"] for d in nearest
+    )
+    assert radius and all(d["distance_km"] <= 200 for d in radius)
+    assert box and all(abs(d["gps_lon"]) >= 179 for d in box)
+    for device in nearest + radius + box:
+        assert device["metrics"]["count"] == 1 and device["s_d0"] is not None
+    assert invalid == 400
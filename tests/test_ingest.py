@@ -0,0 +1,232 @@
+import json
+import math
+
+import pytest
+
+import src.data
+import src.retention
+from src.data import DeviceHistory, DeviceRecord
+from src.ingest import ingest_history
+from src.persistence import SQLiteBackend
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+
+
+def empty() -> DeviceHistory:
+    return DeviceHistory(
+        source=None,
+        device_id=DEVICE,
+        version=None,
+        num_of_records=0,
+        feeds={"AirBox": {}},
+        danger={},
+        daily_metrics={},
+    )
+
+
+def reference(history: DeviceHistory, response_data: dict, since=None):
+    # The record by record path process_init_response took before.
+    for feed in response_data["feeds"]:
+        for project in feed.keys():
+            for entry in feed[project]:
+                for key in entry.keys():
+                    if since is not None and key <= since:
+                        continue
+                    record = DeviceRecord(**entry[key])
+                    history.add_record(project, key, record)
+
+
+def clean(values) -> list:
+    return [None if value != value else value for value in values]
+
+
+def state(history: DeviceHistory) -> dict:
+    # Everything process_init_response leaves behind, with NaN made comparable.
+    return {
+        "source": history.source,
+        "version": history.version,
+        "num_of_records": history.num_of_records,
+        "feeds": {
+            project: {
+                "project": records.project,
+                "device_id": records.device_id,
+                "length": len(records),
+                "rows": [tuple(clean(row)) for row in records.range()],
+                "chunks": [len(chunk) for chunk in records.chunks],
+                "buffer": sorted(records._buffer),
+                "segments": [segment[:3] for segment in records.segments],
+                "spilled": records.spilled,
+                "rollups": {
+                    name: [tier.horizon, [len(block) for block in tier.blocks]]
+                    + list(tier.range())
+                    for name, tier in records.rollups.items()
+                },
+            }
+            for project, records in history.feeds.items()
+        },
+        "danger": {
+            name: [
+                index.last,
+                index.open,
+                list(index.starts),
+                list(index.ends),
+                list(index.peaks),
+                list(index.counts),
+                index.exceedances,
+            ]
+            for name, index in history.danger.items()
+        },
+        "daily_metrics": {
+            day: [
+                metrics.model_dump(exclude={"pk"}),
+                list(metrics._digest.means),
+                list(metrics._digest.weights),
+                list(metrics._digest.buffer),
+            ]
+            for day, metrics in history.daily_metrics.items()
+        },
+        "rolling": history.rolling(),
+    }
+
+
+def run(path, payloads: list, since=None) -> tuple[DeviceHistory, list]:
+    # Takes the payloads in turn, as fresh copies, and records what each
+    # raised.
+    history = empty()
+    errors = []
+    for response_data in payloads:
+        try:
+            path(history, json.loads(json.dumps(response_data)), since)
+            errors.append(None)
+        except Exception as e:
+            errors.append(type(e).__name__)
+    return history, errors
+
+
+def both(payloads: list, since=None) -> tuple[DeviceHistory, list]:
+    # Both paths must end the same way. Returns what the bulk one left.
+    expected, expected_errors = run(reference, payloads, since)
+    found, errors = run(ingest_history, payloads, since)
+    assert state(found) == state(expected)
+    assert errors == expected_errors
+    return found, errors
+
+
+def generator(**options) -> PayloadGenerator:
+    return PayloadGenerator(DEVICE, **options)
+
+
+def entry(payload: dict, index: int) -> dict:
+    return next(iter(payload["feeds"][0]["AirBox"][index].values()))
+
+
+@pytest.mark.parametrize(
+    "payloads",
+    [
+        pytest.param(lambda: [generator(danger_ratio=0.3).history(5_000)], id="one"),
+        pytest.param(lambda: [generator(projects=3).history(3_000)], id="three"),
+        pytest.param(
+            lambda: [
+                generator(danger_ratio=0.5, seed=1).history(2_000),
+                generator(danger_ratio=0.5, seed=2).history(3_000),
+            ],
+            id="overlapping",
+        ),
+    ],
+)
+def test_histories(payloads):
+    history, errors = both(payloads())
+    assert errors == [None] * len(errors) and history.num_of_records
+
+
+def test_newer_history():
+    first = generator()
+    later = generator(seed=3, end=first.end).history(1_500)
+    history, _ = both([first.history(1_000), later])
+    assert history.num_of_records == 1_500
+
+
+def test_unsorted():
+    unsorted = generator().history(2_000)
+    unsorted["feeds"][0]["AirBox"].reverse()
+    history, _ = both([unsorted])
+    assert history.num_of_records == 2_000
+
+
+def test_coerced_and_missing_fields():
+    mixed = generator().history(1_000)
+    for i, item in enumerate(mixed["feeds"][0]["AirBox"]):
+        reading = next(iter(item.values()))
+        if i % 3 == 0:
+            reading["s_d0"] = str(reading["s_d0"])
+        if i % 5 == 0:
+            reading["s_t0"] = int(reading["s_t0"])
+        if i % 7 == 0:
+            del reading["gps_lat"]
+    history, errors = both([mixed])
+    assert errors == [None] and history.num_of_records == 1_000
+
+
+def test_invalid_reading():
+    # Validation stops at the invalid reading, the ones before it are kept.
+    invalid = generator().history(1_000)
+    entry(invalid, 600)["s_d0"] = "high"
+    history, errors = both([invalid])
+    assert errors == ["ValidationError"] and history.num_of_records == 600
+
+
+def test_reading_without_s_d0():
+    # Stored like the others, and left out of the figures derived from s_d0.
+    missing = generator().history(1_000)
+    reading = entry(missing, 600)
+    reading["s_d0"] = None
+    history, errors = both([missing])
+    assert errors == [None] and history.num_of_records == 1_000
+    rows = {row[0]: row for row in history.feeds["AirBox"].range()}
+    assert len(rows) == 1_000
+    held = [row for row in rows.values() if math.isnan(row[3])]
+    assert len(held) == 1 and held[0][1] == reading["s_t0"]
+    assert sum(metrics.count for metrics in history.daily_metrics.values()) == 999
+
+
+def test_since():
+    payload = generator().history(2_000)
+    since = next(iter(payload["feeds"][0]["AirBox"][1_200]))
+    history, _ = both([payload], since)
+    assert history.num_of_records == 799
+
+
+def test_retention_window(monkeypatch, tmp_path):
+    # Each path spills into a folder of its own.
+    monkeypatch.setattr(src.retention, "RETENTION_WINDOW", "5000")
+    src.retention.retention_window.cache_clear()
+    payload = generator().history(20_000)
+    try:
+        results = []
+        for path in (reference, ingest_history):
+            monkeypatch.setattr(
+                src.retention, "RETENTION_DIR", str(tmp_path / path.__name__)
+            )
+            results.append(run(path, [payload]))
+    finally:
+        src.retention.retention_window.cache_clear()
+    (expected, _), (found, errors) = results
+    assert state(found) == state(expected) and errors == [None]
+    assert found.feeds["AirBox"].spilled is not None
+
+
+def test_storage(monkeypatch, tmp_path):
+    payload = generator().history(2_000)
+    stored = []
+    for i, path in enumerate((reference, ingest_history)):
+        backend = SQLiteBackend(DeviceRecord, str(tmp_path / f"{i}.db"))
+        monkeypatch.setattr(src.data, "STORAGE", backend)
+        try:
+            run(path, [payload])
+            stored.append(
+                [record.model_dump(exclude={"pk"}) for record in backend.load()]
+            )
+        finally:
+            backend.close()
+    assert stored[0] == stored[1] and len(stored[0]) == 2_000
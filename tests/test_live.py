@@ -0,0 +1,151 @@
+import json
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+
+from src.app import PM_Analyzer
+from src.live import Broadcaster
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def events(messages: list[str]) -> list[tuple[str, dict]]:
+    parsed = []
+    for message in messages:
+        lines = message.rstrip("\n").split("\n")
+        if lines[0].startswith("event: "):
+            parsed.append((lines[0][7:], json.loads(lines[1][6:])))
+    return parsed
+
+
+def test_subscribe_publish_and_unsubscribe():
+    broadcaster = Broadcaster(queue_size=8)
+
+    async def run():
+        assert not broadcaster.listening(DEVICE)
+        first = broadcaster.subscribe(DEVICE)
+        second = broadcaster.subscribe(DEVICE)
+        other = broadcaster.subscribe("other")
+        assert broadcaster.listening(DEVICE)
+
+        broadcaster.publish(DEVICE, "reading", {"s_d0": 12.5})
+        message = 'event: reading\ndata: {"s_d0": 12.5}\n\n'
+        assert first.get_nowait() == message and second.get_nowait() == message
+        assert other.empty()
+
+        broadcaster.unsubscribe(DEVICE, first)
+        broadcaster.publish(DEVICE, "reading", {"s_d0": 13.0})
+        assert first.empty() and second.qsize() == 1
+        broadcaster.unsubscribe(DEVICE, second)
+        # Unsubscribing again, or from a device nobody follows, is harmless.
+        broadcaster.unsubscribe(DEVICE, second)
+        broadcaster.unsubscribe("missing", other)
+        assert DEVICE not in broadcaster.subscribers
+        assert not broadcaster.listening(DEVICE)
+
+        # Nobody listens, the event is counted and goes nowhere.
+        broadcaster.publish(DEVICE, "reading", {"s_d0": 14.0})
+        assert broadcaster.published == 3 and broadcaster.dropped == 0
+
+    asyncio.run(run())
+
+
+def test_slow_subscriber_is_dropped():
+    broadcaster = Broadcaster(queue_size=4)
+
+    async def run():
+        slow = broadcaster.subscribe(DEVICE)
+        fast = broadcaster.subscribe(DEVICE)
+        for i in range(4):
+            broadcaster.publish(DEVICE, "reading", {"i": i})
+            fast.get_nowait()
+        assert slow.full() and broadcaster.dropped == 0
+
+        broadcaster.publish(DEVICE, "reading", {"i": 4})
+        assert broadcaster.dropped == 1
+        assert broadcaster.subscribers[DEVICE] == {fast}
+        # The backlog is cleared and only the end of stream is left.
+        assert slow.qsize() == 1 and slow.get_nowait() is None
+        assert fast.get_nowait() == 'event: reading\ndata: {"i": 4}\n\n'
+
+        # The others keep receiving, the dropped one hears nothing more.
+        broadcaster.publish(DEVICE, "reading", {"i": 5})
+        assert slow.empty() and fast.qsize() == 1
+        assert broadcaster.published == 6 and broadcaster.dropped == 1
+
+    asyncio.run(run())
+
+
+def test_stream_ends_on_drop_and_disconnect():
+    broadcaster = Broadcaster(queue_size=2)
+
+    async def run():
+        stream = broadcaster.stream(DEVICE)
+        assert await anext(stream) == ": connected\n\n"
+        assert broadcaster.listening(DEVICE)
+        for i in range(3):
+            broadcaster.publish(DEVICE, "reading", {"i": i})
+        # Dropped on the third event, the stream ends without the backlog.
+        assert [message async for message in stream] == []
+        assert not broadcaster.listening(DEVICE) and broadcaster.dropped == 1
+
+        # A client that goes away unsubscribes when its stream is closed.
+        stream = broadcaster.stream(DEVICE)
+        await anext(stream)
+        broadcaster.publish(DEVICE, "reading", {"i": 3})
+        assert await anext(stream) == 'event: reading\ndata: {"i": 3}\n\n'
+        await stream.aclose()
+        assert not broadcaster.listening(DEVICE) and broadcaster.dropped == 1
+
+    asyncio.run(run())
+
+
+def test_events_published_from_other_threads():
+    broadcaster = Broadcaster()
+
+    async def run():
+        stream = broadcaster.stream(DEVICE)
+        await anext(stream)
+
+        def publish():
+            for i in range(100):
+                broadcaster.publish(DEVICE, "reading", {"i": i})
+
+        thread = threading.Thread(target=publish)
+        thread.start()
+        received = [await anext(stream) for _ in range(100)]
+        thread.join()
+        await stream.aclose()
+        return received
+
+    received = asyncio.run(run())
+    assert [data["i"] for _, data in events(received)] == list(range(100))
+    assert broadcaster.published == 100 and broadcaster.dropped == 0
+
+
+def test_readings_reach_the_live_stream():
+    analyzer = PM_Analyzer([DEVICE])
+    history = analyzer.poller.history(DEVICE)
+    broadcaster = analyzer.poller.broadcaster
+    for i in range(100):
+        add(history, START + timedelta(minutes=i), i)
+
+    async def run():
+        stream = analyzer.live(history).body_iterator
+        assert await anext(stream) == ": connected\n\n"
+        for i in range(100, 110):
+            add(history, START + timedelta(minutes=i), i)
+        received = [await anext(stream) for _ in range(10)]
+        await stream.aclose()
+        return received
+
+    received = events(asyncio.run(run()))
+    assert [event for event, _ in received] == ["reading"] * 10
+    assert [data["reading"]["timestamp"] for _, data in received] == [
+        (START + timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        for i in range(100, 110)
+    ]
+    assert [data["num_of_records"] for _, data in received] == list(range(101, 111))
+    assert broadcaster.published == 10
+    assert not broadcaster.listening(DEVICE)
@@ -0,0 +1,210 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from redis.exceptions import TimeoutError
+
+from src.data import DeviceRecord
+from src.persistence import (
+    RedisBackend,
+    SQLiteBackend,
+    StorageError,
+    WriteBehindQueue,
+    device_key,
+)
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    db = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(DeviceRecord._meta, "database", db)
+    return db
+
+
+def records(device_id: str, count: int) -> list[DeviceRecord]:
+    return [
+        DeviceRecord(
+            app="AirBox",
+            device_id=device_id,
+            s_t0=25.0,
+            s_h0=60.0,
+            s_d0=float(i),
+            gps_lat=25.04,
+            gps_lon=121.54,
+            timestamp=START + timedelta(minutes=i),
+        )
+        for i in range(count)
+    ]
+
+
+def loaded(backend, device_id: str) -> list[float]:
+    return sorted(record.s_d0 for record in backend.load(device_id))
+
+
+def test_load_reads_only_the_device(db):
+    backend = RedisBackend(DeviceRecord, chunk_size=7)
+    backend.append(records("A", 30) + records("B", 20))
+    assert loaded(backend, "A") == [float(i) for i in range(30)]
+    assert loaded(backend, "B") == [float(i) for i in range(20)]
+    assert loaded(backend, "C") == []
+    assert db.scard(device_key(DeviceRecord, "A")) == 30
+    assert len(list(backend.load())) == 50
+
+    # Range reads go by the device as well.
+    rows = list(backend.range("A", "AirBox", START + timedelta(minutes=10)))
+    assert [record.s_d0 for record in rows] == [float(i) for i in range(10, 30)]
+
+
+def test_records_written_before_the_index(db):
+    # Hashes saved without the device sets are indexed by the first load,
+    # once.
+    for record in records("A", 12) + records("B", 5):
+        db.hset(record.key(), mapping=record.model_dump(mode="json", exclude_none=True))
+    backend = RedisBackend(DeviceRecord, chunk_size=5)
+    assert loaded(backend, "B") == [float(i) for i in range(5)]
+    assert db.scard(device_key(DeviceRecord, "A")) == 12
+
+    backend.append(records("A", 15)[12:])
+    assert loaded(RedisBackend(DeviceRecord), "A") == [float(i) for i in range(15)]
+
+
+@pytest.fixture
+def sqlite(tmp_path):
+    backend = SQLiteBackend(DeviceRecord, str(tmp_path / "records.db"), chunk_size=7)
+    yield backend
+    backend.close()
+
+
+def test_sqlite_round_trip(sqlite):
+    sqlite.append(records("A", 30) + records("B", 20))
+    assert loaded(sqlite, "A") == [float(i) for i in range(30)]
+    assert loaded(sqlite, "B") == [float(i) for i in range(20)]
+    assert loaded(sqlite, "C") == []
+    assert len(list(sqlite.load())) == 50
+
+    # Every field comes back as it was written.
+    first, *_ = sqlite.load("A")
+    assert first.model_dump(exclude={"pk"}) == records("A", 1)[0].model_dump(
+        exclude={"pk"}
+    )
+
+    # A reading written again replaces the stored one.
+    again = records("A", 1)
+    again[0].s_d0 = 99.0
+    sqlite.append(again)
+    assert len(list(sqlite.load("A"))) == 30
+    assert loaded(sqlite, "A")[-1] == 99.0
+
+    # The data outlives the connection.
+    sqlite.close()
+    reopened = SQLiteBackend(DeviceRecord, sqlite.path)
+    assert len(list(reopened.load())) == 50
+    reopened.close()
+
+
+def test_sqlite_range(sqlite):
+    sqlite.append(records("A", 30) + records("B", 20))
+    rows = list(sqlite.range("A", "AirBox", START + timedelta(minutes=10)))
+    assert [record.s_d0 for record in rows] == [float(i) for i in range(10, 30)]
+    rows = sqlite.range(
+        "A", "AirBox", START + timedelta(minutes=5), START + timedelta(minutes=8)
+    )
+    assert [record.s_d0 for record in rows] == [5.0, 6.0, 7.0]
+    rows = sqlite.range("B", "AirBox", end=START + timedelta(minutes=3))
+    assert [record.s_d0 for record in rows] == [0.0, 1.0, 2.0]
+    assert list(sqlite.range("A", "MAPS")) == []
+
+
+def test_sqlite_uses_wal(sqlite):
+    sqlite.append(records("A", 1))
+    (mode,) = sqlite.connect().execute("PRAGMA journal_mode").fetchone()
+    assert mode == "wal"
+    # Other connections read while the batch is being written.
+    reader = sqlite3.connect(sqlite.path)
+    (mode,) = reader.execute("PRAGMA journal_mode").fetchone()
+    assert mode == "wal"
+    with sqlite.connect():
+        sqlite.connect().execute("DELETE FROM records")
+        assert reader.execute("SELECT COUNT(*) FROM records").fetchone() == (1,)
+    assert reader.execute("SELECT COUNT(*) FROM records").fetchone() == (0,)
+    reader.close()
+
+
+def test_sqlite_errors_are_storage_errors(sqlite, tmp_path):
+    missing = SQLiteBackend(DeviceRecord, str(tmp_path / "missing" / "records.db"))
+    with pytest.raises(StorageError):
+        missing.append(records("A", 1))
+    with pytest.raises(StorageError):
+        list(missing.load("A"))
+    with pytest.raises(StorageError):
+        list(missing.range("A", "AirBox"))
+
+    # A connection closed under the backend fails the same way.
+    sqlite.append(records("A", 10))
+    sqlite.connect().close()
+    with pytest.raises(StorageError):
+        sqlite.append(records("A", 1))
+    with pytest.raises(StorageError):
+        list(sqlite.load("A"))
+
+    # Closing resets it, the next call opens the database again.
+    sqlite.close()
+    assert loaded(sqlite, "A") == [float(i) for i in range(10)]
+
+
+def test_redis_errors_are_storage_errors(db, monkeypatch):
+    def timeout(*args, **kwargs):
+        raise TimeoutError("timed out")
+
+    for name in ("pipeline", "scan_iter", "sscan_iter"):
+        monkeypatch.setattr(db, name, timeout)
+    backend = RedisBackend(DeviceRecord)
+    with pytest.raises(StorageError):
+        backend.append(records("A", 3))
+    with pytest.raises(StorageError):
+        list(backend.load("A"))
+
+
+class Failing:
+    # A backend whose writes fail until it is told otherwise.
+    name = "failing"
+
+    def __init__(self, error: Exception):
+        self.error = error
+        self.written = []
+
+    def append(self, records: list):
+        if self.error is not None:
+            raise self.error
+        self.written.extend(records)
+
+
+def test_write_queue_survives_failed_writes():
+    # A failed flush keeps its batch and the writer, and the queue never holds
+    # more than max_pending however long the writes fail.
+    backend = Failing(RuntimeError("unexpected"))
+    queue = WriteBehindQueue(backend, batch_size=3, interval=0.01, max_pending=5)
+
+    async def write():
+        writer = asyncio.create_task(queue.run())
+        try:
+            for record in records("A", 100):
+                queue.put(record)
+                assert len(queue.pending) <= 5
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.05)
+            assert not writer.done()
+            backend.error = None
+            await asyncio.sleep(0.05)
+        finally:
+            writer.cancel()
+            await asyncio.gather(writer, return_exceptions=True)
+        await queue.close()
+
+    asyncio.run(write())
+    assert [record.s_d0 for record in backend.written] == [95.0, 96.0, 97.0, 98.0, 99.0]
+    assert queue.dropped == 95 and queue.written == 5 and not queue.pending
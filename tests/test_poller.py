@@ -0,0 +1,150 @@
+import asyncio
+import threading
+
+import httpx
+
+import src.data
+from src.data import DeviceRecord
+from src.persistence import SQLiteBackend
+from src.poller import DevicePoller
+from src.snapshot import save_snapshot
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+
+
+class Watched(SQLiteBackend):
+    # Remembers the threads storage was read on.
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.threads = []
+
+    def load(self, device_id=None):
+        self.threads.append(threading.current_thread().name)
+        return super().load(device_id)
+
+
+def test_histories_are_built_on_the_ingest_thread(monkeypatch, tmp_path):
+    backend = Watched(DeviceRecord, str(tmp_path / "records.db"))
+    monkeypatch.setattr(src.data, "STORAGE", backend)
+    poller = DevicePoller([DEVICE])
+
+    async def prepare():
+        try:
+            await poller.prepare_histories()
+            await poller.prepare(DEVICE)
+        finally:
+            await poller.drain()
+
+    try:
+        asyncio.run(prepare())
+    finally:
+        backend.close()
+    assert len(backend.threads) == 1 and backend.threads[0].startswith("ingest")
+    assert poller.view(DEVICE).num_of_records == 0
+
+
+def test_snapshots_are_restored_on_the_ingest_thread(monkeypatch, tmp_path):
+    source = DevicePoller([DEVICE])
+    source.process_init_response(DEVICE, PayloadGenerator(DEVICE).history(500))
+    save_snapshot(source.view(DEVICE), str(tmp_path))
+    loaded = []
+    poller = DevicePoller([DEVICE])
+    load = poller.load
+    monkeypatch.setattr(
+        poller,
+        "load",
+        lambda *args: loaded.append(threading.current_thread().name) or load(*args),
+    )
+
+    async def restore() -> int:
+        try:
+            return await poller.restore(str(tmp_path))
+        finally:
+            await poller.drain()
+
+    assert asyncio.run(restore()) == 1
+    assert len(loaded) == 1 and loaded[0].startswith("ingest")
+    assert poller.view(DEVICE).num_of_records == 500
+    assert poller.status[DEVICE].restored_until is not None
+
+
+def test_empty_snapshots_restore_nothing(history, tmp_path):
+    # An empty history has no newest reading, it is then fetched in full.
+    save_snapshot(history, str(tmp_path))
+    poller = DevicePoller([DEVICE])
+
+    async def restore() -> int:
+        try:
+            return await poller.restore(str(tmp_path))
+        finally:
+            await poller.drain()
+
+    assert asyncio.run(restore()) == 1
+    assert poller.view(DEVICE).num_of_records == 0
+    assert poller.status[DEVICE].restored_until is None
+    assert poller.readiness().restored == 0
+
+    history.feeds.clear()
+    poller = DevicePoller([DEVICE])
+    poller.adopt(DEVICE, history)
+    assert poller.status[DEVICE].restored_until is None
+
+
+def test_ready_only_once_the_history_loaded(monkeypatch):
+    poller = DevicePoller([DEVICE])
+    responses = [
+        httpx.ConnectError("down"),
+        {"feeds": [{"AirBox": [{"2024-01-01T00:00:00Z": {"s_d0": "high"}}]}]},
+        PayloadGenerator(DEVICE).history(300),
+    ]
+
+    async def request(device_id, endpoint, params=None):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(poller, "request", request)
+
+    async def fetch() -> list:
+        try:
+            results = []
+            for _ in range(3):
+                results.append(await poller.fetch_history(DEVICE))
+                results.append(poller.status[DEVICE].ready)
+            return results
+        finally:
+            await poller.drain()
+
+    assert asyncio.run(fetch()) == [False, False, False, False, True, True]
+    assert poller.view(DEVICE).num_of_records == 300
+
+
+def test_a_failed_version_is_polled_again(monkeypatch):
+    # The version of a response that failed to apply is not skipped later.
+    poller = DevicePoller([DEVICE])
+    latest = PayloadGenerator(DEVICE).latest(1)
+    process = poller.process_response
+    failures = [ValueError("broken")]
+
+    def flaky(device_id, data):
+        if failures:
+            raise failures.pop()
+        return process(device_id, data)
+
+    async def request(device_id, endpoint, params=None):
+        return latest
+
+    monkeypatch.setattr(poller, "request", request)
+    monkeypatch.setattr(poller, "process_response", flaky)
+
+    async def poll() -> list:
+        try:
+            await poller.prepare(DEVICE)
+            return [await poller.poll_device(DEVICE) for _ in range(3)]
+        finally:
+            await poller.drain()
+
+    assert asyncio.run(poll()) == [None, 1, 0]
+    assert poller.schedules[DEVICE].version == latest["version"]
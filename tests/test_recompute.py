@@ -0,0 +1,386 @@
+import math
+import random
+import asyncio
+import threading
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import httpx
+import pytest
+
+import src.app
+import src.poller
+from src.app import PM_Analyzer
+from src.danger import DANGER_THRESHOLDS
+from src.data import DeviceHistory, DeviceRecord
+from src.days import Days, current_days, use_days
+from src.poller import DevicePoller
+from src.recompute import derive, derive_rows, vectorized
+from src.snapshot import load_snapshot, save_snapshot, snapshot_path
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+PROJECTS = ("AirBox", "MAPS", "LASS")
+START = datetime(2024, 3, 1, tzinfo=timezone.utc)
+ZONES = ("UTC", "+05:45", "Asia/Taipei", "America/New_York")
+
+
+@pytest.fixture(autouse=True)
+def settings():
+    # Recomputing changes the thresholds and days of the process.
+    previous = dict(DANGER_THRESHOLDS), current_days()
+    yield
+    restore(*previous)
+
+
+def restore(thresholds: dict, days: Days):
+    DANGER_THRESHOLDS.clear()
+    DANGER_THRESHOLDS.update(thresholds)
+    use_days(days)
+
+
+def danger_state(danger: dict) -> dict:
+    return {
+        name: (
+            index.threshold,
+            list(index.starts),
+            list(index.ends),
+            list(index.peaks),
+            list(index.counts),
+            index.last,
+            index.open,
+            index.exceedances,
+        )
+        for name, index in danger.items()
+    }
+
+
+def same_metrics(found: dict, expected: dict, exact: bool = False) -> bool:
+    # Counts and extremes are exact, the means are summed in another order.
+    # Exact ones also have percentiles from centroids with the same weights.
+    if list(found) != list(expected):
+        return False
+    for day, metrics in found.items():
+        other = expected[day]
+        if (metrics.count, metrics.min, metrics.max) != (
+            other.count,
+            other.min,
+            other.max,
+        ):
+            return False
+        if not exact and not math.isclose(metrics.avg, other.avg, abs_tol=1e-6):
+            return False
+        if exact and metrics._digest.weights != other._digest.weights:
+            return False
+        # Rounded to a tenth, a sum in another order can land on the next one.
+        for name in ("std",) + (("avg", "p50", "p95", "p99") if exact else ()):
+            if not math.isclose(
+                getattr(metrics, name), getattr(other, name), abs_tol=0.11
+            ):
+                return False
+    return True
+
+
+def record(project: str, epoch: int, value: float) -> DeviceRecord:
+    return DeviceRecord.model_construct(
+        app=project,
+        device_id=DEVICE,
+        s_t0=25.0,
+        s_h0=60.0,
+        s_d0=value,
+        gps_lat=25.04,
+        gps_lon=121.54,
+        timestamp=datetime.fromtimestamp(epoch, timezone.utc),
+    )
+
+
+def scattered(count: int, seed: int) -> DeviceHistory:
+    # Readings of three projects at the same seconds as often as not, late
+    # ones, and values at and around the thresholds, across the daylight
+    # saving change of New York.
+    rng = random.Random(seed)
+    history = DeviceHistory(
+        source=None,
+        device_id=DEVICE,
+        version=None,
+        num_of_records=0,
+        feeds={},
+        danger={},
+        daily_metrics={},
+    )
+    epoch = int(START.timestamp()) + 9 * 86400
+    thresholds = list(DANGER_THRESHOLDS.values())
+    for _ in range(count):
+        epoch += rng.choice((0, 0, 60, 600, 3600))
+        at = epoch - (rng.randint(0, 86400) if rng.random() < 0.1 else 0)
+        roll = rng.random()
+        if roll < 0.2:
+            value = rng.choice(thresholds)
+        elif roll < 0.22:
+            value = math.nan
+        else:
+            value = round(rng.uniform(0, 60), 1)
+        project = rng.choice(PROJECTS)
+        timestamp = datetime.fromtimestamp(at, timezone.utc)
+        history.add_record(
+            project,
+            timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            record(project, at, value),
+        )
+    return history
+
+
+def without_s_d0(count: int, every: int) -> dict:
+    payload = PayloadGenerator(DEVICE, projects=2, danger_ratio=0.3).history(count)
+    for feed in payload["feeds"]:
+        for entries in feed.values():
+            for i, entry in enumerate(entries):
+                if i % every == 0:
+                    next(iter(entry.values()))["s_d0"] = None
+    return payload
+
+
+@pytest.mark.parametrize("ingest", ["bulk", "reading by reading"])
+def test_readings_without_s_d0(ingest):
+    # Stored and counted by every path, and left out of the danger episodes
+    # and daily metrics by the live path and the recompute alike.
+    payload = without_s_d0(3_000, every=7)
+    poller = DevicePoller([DEVICE])
+    if ingest == "bulk":
+        poller.process_init_response(DEVICE, payload)
+    else:
+        for feed in payload["feeds"]:
+            for project, entries in feed.items():
+                for entry in entries:
+                    for key, reading in entry.items():
+                        poller.process_response(
+                            DEVICE,
+                            {
+                                "device_id": DEVICE,
+                                "version": key,
+                                "feeds": [{project: {**reading, "timestamp": key}}],
+                            },
+                        )
+    history = poller.histories[DEVICE]
+    missing = sum(
+        1
+        for records in history.feeds.values()
+        for row in records.range()
+        if row[3] != row[3]
+    )
+    assert missing and history.num_of_records == 3_000
+
+    danger, daily_metrics, readings = derive(history, DANGER_THRESHOLDS, current_days())
+    assert readings == 3_000 - missing
+    assert sum(metrics.count for metrics in daily_metrics.values()) == readings
+    assert danger_state(danger) == danger_state(history.danger)
+    assert same_metrics(daily_metrics, history.daily_metrics)
+    rows = derive_rows(history, DANGER_THRESHOLDS, current_days())
+    assert danger_state(rows[0]) == danger_state(danger) and rows[2] == readings
+
+    # Recomputed with the same settings, nothing changes.
+    before = danger_state(history.danger), dict(history.daily_metrics)
+    assert asyncio.run(poller.recompute(dict(DANGER_THRESHOLDS), current_days())) == (
+        readings
+    )
+    assert danger_state(history.danger) == before[0]
+    assert same_metrics(history.daily_metrics, before[1])
+
+
+def test_recompute_with_other_settings():
+    poller = DevicePoller([DEVICE])
+    poller.process_init_response(DEVICE, without_s_d0(3_000, every=11))
+    thresholds = {"local": 22.0, "who": 12.0}
+    days = Days("Asia/Taipei")
+    asyncio.run(poller.recompute(thresholds, days))
+    view = poller.view(DEVICE)
+    assert view.settings() == "local=22,who=12;Asia/Taipei"
+    danger, daily_metrics, _ = derive_rows(view, thresholds, days)
+    assert danger_state(view.danger) == danger_state(danger)
+    assert same_metrics(view.daily_metrics, daily_metrics)
+
+
+def test_settings_change_on_the_ingest_thread(monkeypatch):
+    # The thresholds and days new histories are built with are only changed
+    # by the thread that builds them, and are never left empty.
+    poller = DevicePoller([DEVICE])
+    poller.process_init_response(DEVICE, without_s_d0(500, every=5))
+    use_days = src.poller.use_days
+    threads = []
+
+    def watched(days):
+        threads.append(threading.current_thread().name)
+        use_days(days)
+
+    monkeypatch.setattr(src.poller, "use_days", watched)
+    thresholds = {"local": 30.0, "who": 20.0}
+
+    async def recompute():
+        try:
+            return await poller.recompute(thresholds, Days("Asia/Taipei"))
+        finally:
+            await poller.drain()
+
+    asyncio.run(recompute())
+    assert len(threads) == 1 and threads[0].startswith("ingest")
+    assert DANGER_THRESHOLDS == thresholds
+    assert current_days().name == "Asia/Taipei"
+
+
+def test_scattered_readings_in_every_zone():
+    # The vectorized pass builds what adding the sorted readings one by one
+    # builds, ties, NaN and time zones included, and what the history itself
+    # rebuilds from its feeds.
+    history = scattered(20_000, seed=1)
+    rebuilt = history.model_copy()
+    rebuilt.danger = dict(history.danger)
+    rebuilt._DeviceHistory__index_danger()
+    assert danger_state(derive_rows(history, DANGER_THRESHOLDS, Days())[0]) == (
+        danger_state(rebuilt.danger)
+    )
+    for zone in ZONES:
+        days = Days(zone)
+        thresholds = {"local": 20.0, "who": 15.0, "strict": 5.0}
+        danger, daily_metrics, readings = derive(history, thresholds, days)
+        reference = derive_rows(history, thresholds, days)
+        assert danger_state(danger) == danger_state(reference[0]), zone
+        assert same_metrics(daily_metrics, reference[1], exact=True), zone
+        assert readings == reference[2]
+        # Days by the calendar of the zone.
+        zone_info = timezone.utc if zone == "UTC" else Days(zone).zone
+        expected = {}
+        for records in history.feeds.values():
+            for row in records.range():
+                if row[3] == row[3]:
+                    day = datetime.fromtimestamp(row[0], zone_info).date()
+                    expected[day] = expected.get(day, 0) + 1
+        assert {day: m.count for day, m in daily_metrics.items()} == expected, zone
+
+
+def test_ingested_history():
+    # Against the history ingested with the current settings, and the
+    # vectorized pass against the reading by reading one with others.
+    payload = PayloadGenerator(DEVICE, projects=2, danger_ratio=0.1).history(50_000)
+    poller = DevicePoller([DEVICE])
+    poller.process_init_response(DEVICE, payload)
+    history = poller.histories[DEVICE]
+    danger, daily_metrics, _ = derive(history, DANGER_THRESHOLDS, current_days())
+    rebuilt = history.model_copy()
+    rebuilt.danger = dict(history.danger)
+    rebuilt._DeviceHistory__index_danger()
+    assert danger_state(danger) == danger_state(rebuilt.danger)
+    assert same_metrics(daily_metrics, history.daily_metrics)
+
+    thresholds = {"local": 25.0, "who": 10.0}
+    days = Days("Asia/Taipei")
+    fast = derive(history, thresholds, days)
+    slow = derive_rows(history, thresholds, days)
+    assert danger_state(fast[0]) == danger_state(slow[0])
+    assert same_metrics(fast[1], slow[1], exact=True)
+
+
+def test_readings_arriving_meanwhile():
+    # Readings that keep arriving during a recompute are neither lost nor
+    # counted twice, and subscribers are told to render anew.
+    async def recompute():
+        poller = DevicePoller([DEVICE])
+        generator = PayloadGenerator(DEVICE, projects=2, danger_ratio=0.2)
+        poller.process_init_response(DEVICE, generator.history(50_000))
+        poller.broadcaster.loop = asyncio.get_running_loop()
+        queue = poller.broadcaster.subscribe(DEVICE)
+        stop = asyncio.Event()
+
+        async def listen() -> str:
+            while True:
+                message = await queue.get()
+                if message.startswith("event: settings"):
+                    return message
+
+        async def poll():
+            i = 0
+            while not stop.is_set():
+                i += 1
+                await poller.offload(
+                    poller.process_response, DEVICE, generator.latest(i)
+                )
+                await asyncio.sleep(0)
+
+        polling = asyncio.create_task(poll())
+        listening = asyncio.create_task(listen())
+        try:
+            await asyncio.sleep(0.05)
+            await poller.recompute({"local": 22.0, "who": 12.0}, Days("+08:00"))
+        finally:
+            stop.set()
+            await polling
+        history = poller.histories[DEVICE]
+        danger, daily_metrics, readings = derive(
+            history, DANGER_THRESHOLDS, Days("+08:00")
+        )
+        assert readings == history.num_of_records > 50_000
+        assert danger_state(history.danger) == danger_state(danger)
+        assert same_metrics(history.daily_metrics, daily_metrics)
+        message = await asyncio.wait_for(listening, 1)
+        assert '"settings": "local=22,who=12;+08:00"' in message
+        await poller.drain()
+
+    asyncio.run(recompute())
+
+
+def test_endpoint(monkeypatch, tmp_path):
+    service = PM_Analyzer([DEVICE])
+    poller = service.poller
+    poller.process_init_response(DEVICE, PayloadGenerator(DEVICE).history(20_000))
+
+    async def ask():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as c:
+            assert (await c.post("/admin/recompute")).status_code == 403
+            monkeypatch.setattr(src.app, "ADMIN_TOKEN", "secret")
+            auth = {"Authorization": "Bearer secret"}
+            assert (await c.post("/admin/recompute")).status_code == 401
+            before = await c.get("/data")
+            tag = before.headers["etag"]
+            page = (await c.get("/")).text
+            for query, status in [
+                ("threshold=nope=3", 404),
+                ("threshold=abc", 400),
+                ("timezone=Mars/Base", 400),
+            ]:
+                response = await c.post(f"/admin/recompute?{query}", headers=auth)
+                assert response.status_code == status, query
+
+            response = await c.post(
+                "/admin/recompute?threshold=12&timezone=Asia/Taipei", headers=auth
+            )
+            assert response.status_code == 200, response.text
+            result = response.json()
+            assert result["thresholds"]["local"] == 12
+            assert result["timezone"] == "Asia/Taipei"
+            assert result["readings"] == 20_000
+            assert result["vectorized"] == vectorized()
+
+            after = await c.get("/data", headers={"If-None-Match": tag})
+            assert after.status_code == 200 and after.headers["etag"] != tag
+            assert (await c.get("/data/danger")).json()["threshold"] == 12
+            assert (await c.get("/")).text != page
+            return after.json()["daily_metrics"]
+
+    metrics = asyncio.run(ask())
+    expected = {}
+    for row in poller.view(DEVICE).feeds["AirBox"].range():
+        day = datetime.fromtimestamp(row[0], ZoneInfo("Asia/Taipei")).date()
+        expected[day.isoformat()] = expected.get(day.isoformat(), 0) + 1
+    assert {day: m["count"] for day, m in metrics.items()} == expected
+
+    # A snapshot keeps its settings, and a process started with others
+    # recomputes it on load.
+    save_snapshot(poller.view(DEVICE), str(tmp_path))
+    path = snapshot_path(DEVICE, str(tmp_path))
+    kept = load_snapshot(path, recompute=False)
+    assert kept.settings() == "local=12,who=15;Asia/Taipei"
+    restore({"local": 30.0, "who": 15.0}, Days("UTC"))
+    loaded = load_snapshot(path)
+    assert loaded.settings() == "local=30,who=15;UTC"
+    reference = derive(loaded, DANGER_THRESHOLDS, current_days())
+    assert danger_state(loaded.danger) == danger_state(reference[0])
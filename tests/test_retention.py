@@ -0,0 +1,80 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import src.retention
+from src.data import DeviceHistory
+from src.store import FEED_BUFFER_SIZE, FEED_CHUNK_SIZE, to_epoch
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+INTERVAL = 60
+PER_DAY = 86400 // INTERVAL
+DAYS = 12
+
+
+@pytest.fixture
+def window(monkeypatch):
+    def use(value: str):
+        monkeypatch.setattr(src.retention, "RETENTION_WINDOW", value)
+        src.retention.retention_window.cache_clear()
+
+    yield use
+    src.retention.retention_window.cache_clear()
+
+
+def empty() -> DeviceHistory:
+    return DeviceHistory(
+        source=None,
+        device_id=DEVICE,
+        version=None,
+        num_of_records=0,
+        feeds={},
+        danger={},
+        daily_metrics={},
+    )
+
+
+@pytest.mark.parametrize("value, kept", [("1d", PER_DAY), ("2000", 2000)])
+def test_hot_readings_stay_within_the_window(window, value, kept):
+    # However long it runs, memory holds the window, a chunk being filled and
+    # the append buffer. The rest is on disk and still counted and read.
+    window(value)
+    history = empty()
+    i = 0
+    for _ in range(DAYS):
+        for _ in range(PER_DAY):
+            add(history, START + timedelta(seconds=i * INTERVAL), i)
+            i += 1
+        store = history.feeds["AirBox"]
+        hot = len(store) - store._spilled_length
+        assert hot <= kept + FEED_CHUNK_SIZE + FEED_BUFFER_SIZE, hot
+    assert store.segments and store.spilled is not None
+
+    assert history.num_of_records == len(store) == i
+    assert sum(m.count for m in history.daily_metrics.values()) == i
+    week = (START + timedelta(days=2), START + timedelta(days=9))
+    rows = list(store.range(*map(to_epoch, week)))
+    assert len(rows) == 7 * PER_DAY
+    assert rows[0][0] == to_epoch(week[0])
+    assert [row[3] for row in rows[:80]] == [
+        float((2 * PER_DAY + n) % 80) for n in range(80)
+    ]
+    assert len(store.tail(PER_DAY)) == PER_DAY
+    assert sum(1 for _ in store.rows()) == i
+
+    # A new process finds the spilled readings on disk.
+    disk = sum(segment[2] for segment in store.segments)
+    assert all(os.path.exists(segment[3]) for segment in store.segments)
+    assert empty().num_of_records == disk
+
+
+def test_unbounded_keeps_everything_in_memory(window):
+    window("")
+    history = empty()
+    for i in range(3 * FEED_CHUNK_SIZE):
+        add(history, START + timedelta(seconds=i * INTERVAL), i)
+    store = history.feeds["AirBox"]
+    assert not store.segments and store._spilled_length == 0
+    assert len(store) == 3 * FEED_CHUNK_SIZE
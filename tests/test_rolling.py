@@ -0,0 +1,199 @@
+import math
+import random
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from src.app import PM_Analyzer
+from src.data import DeviceHistory, DeviceRecord
+from src.ingest import ingest_history
+from src.rolling import ROLLING_WINDOWS, RollingEngine
+from src.snapshot import load_snapshot, save_snapshot, snapshot_path
+from src.store import to_epoch
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+PROJECTS = ("AirBox", "MAPS")
+
+
+def empty() -> DeviceHistory:
+    return DeviceHistory(
+        source=None,
+        device_id=DEVICE,
+        version=None,
+        num_of_records=0,
+        feeds={},
+        danger={},
+        daily_metrics={},
+    )
+
+
+def brute_force(readings: dict, windows: dict = ROLLING_WINDOWS) -> dict:
+    # Every window recomputed from all the readings held.
+    if not readings:
+        return {name: (0, None, None, 0.0) for name in windows}
+    last = max(epoch for _, epoch in readings)
+    result = {}
+    for name, seconds in windows.items():
+        values = [
+            value
+            for (_, epoch), value in readings.items()
+            if last - seconds < epoch <= last
+        ]
+        result[name] = (len(values), min(values), max(values), math.fsum(values))
+    return result
+
+
+def state(engine: RollingEngine) -> dict:
+    return {
+        name: (
+            window.count,
+            window.lows[0][1] if window.lows else None,
+            -window.highs[0][1] if window.highs else None,
+            window.sum,
+        )
+        for name, window in engine.windows.items()
+    }
+
+
+def same(found: dict, expected: dict) -> bool:
+    return all(
+        found[name][:3] == expected[name][:3]
+        and math.isclose(found[name][3], expected[name][3], abs_tol=1e-6)
+        for name in expected
+    )
+
+
+def stream(count: int, seed: int) -> list[tuple[str, datetime, float]]:
+    # Readings a minute apart over two projects, with late ones up to a day
+    # and a half behind and repeats of readings already sent.
+    rng = random.Random(seed)
+    readings = []
+    for i in range(count):
+        project = rng.choice(PROJECTS)
+        timestamp = START + timedelta(minutes=i)
+        roll = rng.random()
+        if roll < 0.1 and i:
+            timestamp -= timedelta(minutes=rng.randint(1, min(i, 2160)))
+        value = round(rng.uniform(1, 120), 2)
+        readings.append((project, timestamp, value))
+        if roll > 0.97:
+            readings.append(readings[rng.randrange(len(readings))])
+    return readings
+
+
+def record(project: str, timestamp: datetime, value: float) -> DeviceRecord:
+    return DeviceRecord.model_construct(
+        app=project,
+        device_id=DEVICE,
+        s_t0=25.0,
+        s_h0=60.0,
+        s_d0=value,
+        gps_lat=25.04,
+        gps_lon=121.54,
+        timestamp=timestamp,
+    )
+
+
+def streamed(count: int) -> tuple[DeviceHistory, dict]:
+    history = empty()
+    readings = {}
+    for project, timestamp, value in stream(count, seed=1):
+        history.add_record(
+            project,
+            timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            record(project, timestamp, value),
+        )
+        readings.setdefault((project, to_epoch(timestamp)), value)
+    return history, readings
+
+
+def test_add_record():
+    # add_record keeps the first of a repeated timestamp per project, and so
+    # does the reference, after every reading and in every view.
+    history = empty()
+    readings = {}
+    previous = None
+    for i, (project, timestamp, value) in enumerate(stream(3_000, seed=1)):
+        key = (project, to_epoch(timestamp))
+        added = history.add_record(
+            project,
+            timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            record(project, timestamp, value),
+        )
+        assert added == (key not in readings)
+        readings.setdefault(key, value)
+        if i % 7 == 0:
+            assert same(state(history._rolling), brute_force(readings)), i
+            view = history.freeze(previous)
+            assert view.rolling() == history.rolling()
+            previous = view
+    assert same(state(history._rolling), brute_force(readings))
+
+
+def test_snapshot(tmp_path):
+    history, readings = streamed(3_000)
+    save_snapshot(history.freeze(), str(tmp_path))
+    restored = load_snapshot(snapshot_path(DEVICE, str(tmp_path)))
+    assert same(state(restored._rolling), brute_force(readings))
+    assert restored.rolling() == history.rolling()
+
+
+def test_bulk_ingest():
+    payload = PayloadGenerator(DEVICE, projects=2, danger_ratio=0.2).history(6_000)
+    history = empty()
+    ingest_history(history, payload)
+    expected = {
+        (project, row[0]): row[3]
+        for project, records in history.feeds.items()
+        for row in records.range()
+    }
+    assert len(expected) == 6_000
+    assert same(state(history._rolling), brute_force(expected))
+
+
+def test_engine():
+    # Odd windows, compaction and readings at the same second.
+    windows = {"90s": 90, "17m": 1020, "5h": 18000}
+    rng = random.Random(2)
+    engine, readings, epoch = RollingEngine(windows), {}, 0
+    for i in range(20_000):
+        epoch += rng.choice((0, 0, 10, 30, 60, 600))
+        at = epoch - (rng.randint(0, 20_000) if rng.random() < 0.15 else 0)
+        value = round(rng.uniform(0, 500), 1)
+        engine.add(at, value)
+        readings[(i, at)] = value
+        if i % 101 == 0:
+            assert same(state(engine), brute_force(readings, windows)), i
+    assert same(state(engine), brute_force(readings, windows))
+
+
+def test_endpoints():
+    service = PM_Analyzer([DEVICE])
+    poller = service.poller
+    poller.process_init_response(DEVICE, PayloadGenerator(DEVICE).history(2_000))
+    history = poller.histories[DEVICE]
+
+    async def get(*paths) -> list[httpx.Response]:
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as c:
+            return [await c.get(path) for path in paths]
+
+    windows, one, missing = asyncio.run(
+        get(
+            "/data/rolling",
+            f"/devices/{DEVICE}/data/rolling?window=8h",
+            "/data/rolling?window=2h",
+        )
+    )
+    windows = windows.json()
+    assert list(windows) == list(ROLLING_WINDOWS)
+    assert one.json() == {"8h": windows["8h"]} and windows["8h"]["count"] == 480
+    assert missing.status_code == 404
+
+    queue = poller.broadcaster.subscribe(DEVICE)
+    poller.process_response(DEVICE, PayloadGenerator(DEVICE, seed=1).latest(1))
+    assert '"rolling": {"1h": {"count": 60' in queue.get_nowait()
+    assert poller.view(DEVICE).rolling() == history.rolling()
@@ -0,0 +1,174 @@
+import math
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+import src.retention
+from src.app import PM_Analyzer
+from src.rollup import ROLLUP_BLOCK_SIZE, RollupTier, lttb, select_resolution
+from src.store import to_epoch
+from tests.helpers import DEVICE, add
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+T0 = to_epoch(START)
+HOUR = 3600
+
+
+def scan(rows, resolution: int) -> dict[int, tuple]:
+    # The count, mean, min and max of s_d0 per bucket from the raw rows.
+    buckets = {}
+    for row in rows:
+        if row[3] != row[3]:
+            continue
+        bucket = buckets.setdefault(row[0] - row[0] % resolution, [])
+        bucket.append(row[3])
+    return {
+        bucket: (len(values), sum(values) / len(values), min(values), max(values))
+        for bucket, values in buckets.items()
+    }
+
+
+def tier_s_d0(tier: RollupTier, start=None, end=None) -> dict[int, tuple]:
+    return {bucket: values[2] for bucket, values in tier.range(start, end) if values[2]}
+
+
+def same(found: dict, expected: dict) -> bool:
+    return found.keys() == expected.keys() and all(
+        found[b][0] == expected[b][0]
+        and math.isclose(found[b][1], expected[b][1], abs_tol=1e-9)
+        and found[b][2:] == expected[b][2:]
+        for b in found
+    )
+
+
+def test_bucket_boundaries():
+    # A bucket holds [start, start + resolution), missing values are not
+    # counted.
+    tier = RollupTier(HOUR)
+    tier.add(T0 + HOUR - 1, (20.0, 50.0, 10.0))
+    tier.add(T0 + HOUR, (21.0, 51.0, 30.0))
+    tier.add(T0 + 2 * HOUR - 1, (22.0, math.nan, 50.0))
+    tier.add(T0, (19.0, 49.0, math.nan))
+    rows = list(tier.range())
+    assert [bucket for bucket, _ in rows] == [T0, T0 + HOUR]
+    assert rows[0][1] == [(2, 19.5, 19.0, 20.0), (2, 49.5, 49.0, 50.0), (1, 10, 10, 10)]
+    assert rows[1][1][1] == (1, 51.0, 51.0, 51.0)
+    assert rows[1][1][2] == (2, 40.0, 30.0, 50.0)
+
+    # The range starts at the bucket holding start and ends before end.
+    assert list(tier_s_d0(tier, T0 + 10, T0 + HOUR)) == [T0]
+    assert list(tier_s_d0(tier, T0 + HOUR + 1)) == [T0 + HOUR]
+
+
+def test_blocks():
+    # Buckets across several blocks, a late one into an old block, and a view
+    # frozen before it that keeps its own.
+    tier = RollupTier(60)
+    count = 3 * ROLLUP_BLOCK_SIZE + 5
+    for i in range(count):
+        if i != 10:
+            tier.add(T0 + 60 * i, (0.0, 0.0, float(i)))
+    assert len(tier.blocks) == 4 and len(tier) == count - 1
+    frozen = tier.freeze()
+    tier.add(T0 + 600, (0.0, 0.0, 10.0))
+    tier.add(T0 + 30, (0.0, 0.0, 1.0))
+    assert len(tier) == count and len(frozen) == count - 1
+    found = tier_s_d0(tier)
+    assert list(found) == [T0 + 60 * i for i in range(count)]
+    assert found[T0] == (2, 0.5, 0.0, 1.0)
+    assert tier_s_d0(frozen)[T0] == (1, 0.0, 0.0, 0.0)
+    middle = tier_s_d0(tier, T0 + 60 * ROLLUP_BLOCK_SIZE - 60, T0 + 60 * 2000)
+    assert len(middle) == 2000 - ROLLUP_BLOCK_SIZE + 1
+
+
+def test_eviction_and_resolution():
+    tiers = {"minute": RollupTier(60), "hour": RollupTier(HOUR)}
+    for i in range(3 * 60):
+        for tier in tiers.values():
+            tier.add(T0 + 60 * i, (0.0, 0.0, 1.0))
+    assert select_resolution(tiers, T0, T0 + 3 * HOUR, max_points=200) == "minute"
+    assert select_resolution(tiers, T0, T0 + 3 * HOUR, max_points=100) == "hour"
+    tiers["minute"].evict(T0 + HOUR + 30)
+    assert tiers["minute"].horizon == T0 + HOUR
+    assert next(tiers["minute"].range())[0] == T0 + HOUR
+    # The minutes no longer cover a range that starts before the horizon.
+    assert select_resolution(tiers, T0, T0 + 3 * HOUR, max_points=200) == "hour"
+    assert select_resolution(tiers, T0 + HOUR, None, max_points=200) == "minute"
+
+
+@pytest.mark.parametrize("length, threshold", [(10_000, 500), (1_001, 3), (97, 10)])
+def test_lttb_keeps_the_ends(length, threshold):
+    values = [math.sin(i / 50) * 20 + 30 for i in range(length)]
+    values[length // 3] = 500.0
+    values[5] = None
+    values[6] = math.nan
+    indexes = lttb(values, threshold)
+    assert len(indexes) == threshold
+    assert indexes[0] == 0 and indexes[-1] == length - 1
+    assert all(a < b for a, b in zip(indexes, indexes[1:]))
+    # A spike is the largest triangle of its bucket.
+    assert length // 3 in indexes or threshold == 3
+
+
+def test_lttb_short_series():
+    assert lttb([1.0, 2.0, 3.0], 10) == [0, 1, 2]
+    assert lttb([1.0] * 50, 2) == list(range(50))
+    assert lttb([], 10) == []
+
+
+@pytest.fixture
+def spilling(monkeypatch):
+    monkeypatch.setattr(src.retention, "RETENTION_WINDOW", "2d")
+    src.retention.retention_window.cache_clear()
+    yield
+    src.retention.retention_window.cache_clear()
+
+
+def test_rollups_span_a_spill(spilling):
+    # Hours and days keep what was spilled, minutes only what is in memory,
+    # and each agrees with the readings it covers.
+    service = PM_Analyzer([DEVICE])
+    history = service.poller.history(DEVICE)
+    for i in range(7 * 1440):
+        add(history, START + timedelta(minutes=i), i)
+    service.poller.publish(DEVICE)
+    store = history.feeds["AirBox"]
+    assert store.segments and store.spilled is not None
+    rows = list(store.range())
+    for name, resolution in (("hour", HOUR), ("day", 86400)):
+        assert same(tier_s_d0(store.rollups[name]), scan(rows, resolution)), name
+    minute = store.rollups["minute"]
+    assert minute.horizon > T0
+    hot = [row for row in rows if row[0] >= minute.horizon]
+    assert same(tier_s_d0(minute), scan(hot, 60))
+
+    # The endpoint picks a tier that covers the whole range.
+    window = {
+        "start": START.isoformat(),
+        "end": (START + timedelta(days=7)).isoformat(),
+    }
+
+    async def ask():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as c:
+            auto = (await c.get("/data/rollup", params=window)).json()
+            hourly = (
+                await c.get("/data/rollup", params={**window, "resolution": "hour"})
+            ).json()
+            too_many = await c.get(
+                "/data/rollup", params={**window, "resolution": "minute"}
+            )
+            return auto, hourly, too_many.status_code
+
+    auto, hourly, too_many = asyncio.run(ask())
+    assert auto["resolution"] == "hour" and too_many == 400
+    expected = scan(rows, HOUR)
+    assert len(hourly["buckets"]) == len(expected) == 7 * 24
+    for bucket in hourly["buckets"]:
+        epoch = to_epoch(datetime.fromisoformat(bucket["timestamp"]))
+        value = bucket["values"]["s_d0"]
+        assert value["count"] == expected[epoch][0]
+        assert math.isclose(value["avg"], expected[epoch][1], abs_tol=1e-9)
+        assert (value["min"], value["max"]) == expected[epoch][2:]
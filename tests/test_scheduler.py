@@ -0,0 +1,25 @@
+from src.scheduler import PollSchedule
+
+
+def test_backoff_stays_capped():
+    schedule = PollSchedule(interval=1.0, lead=5.0, max_backoff=300.0)
+    delays = [schedule.next_delay(None) for _ in range(5_000)]
+    assert schedule.failures == 5_000
+    assert all(0 < delay <= 300.0 for delay in delays)
+    assert max(delays) > 150.0
+
+
+def test_late_readings_back_off_up_to_a_quarter_interval():
+    # A stale device is polled more often than it reports, never less.
+    schedule = PollSchedule(interval=1.0, lead=5.0, max_backoff=300.0)
+    schedule.observe(range(0, 600, 60))
+    now = 100_000.0
+    delays = [schedule.next_delay(0, now) for _ in range(5_000)]
+    assert schedule.misses == 5_000
+    assert all(1.0 <= delay <= 15.0 for delay in delays)
+
+
+def test_backoff_below_the_interval():
+    schedule = PollSchedule(interval=10.0)
+    assert schedule.backoff(2_000, 4.0) <= 4.0
+    assert PollSchedule(interval=0.0).backoff(2_000, 4.0) == 0.0
@@ -0,0 +1,98 @@
+import os
+import json
+import struct
+import asyncio
+
+import pytest
+
+from src.poller import DevicePoller
+from src.snapshot import MAGIC, load_snapshot, save_snapshot, snapshot_path
+from tests.payloads import PayloadGenerator
+
+DEVICE = "08BEAC0AB2DE"
+
+
+@pytest.fixture
+def saved(tmp_path) -> str:
+    poller = DevicePoller([DEVICE])
+    poller.process_init_response(DEVICE, PayloadGenerator(DEVICE).history(2_000))
+    return save_snapshot(poller.view(DEVICE), str(tmp_path))
+
+
+def rewrite(path: str, change):
+    with open(path, "rb") as snapshot:
+        data = bytearray(snapshot.read())
+    with open(path, "wb") as snapshot:
+        snapshot.write(change(data))
+
+
+def test_round_trip(saved):
+    history = load_snapshot(saved)
+    assert history.num_of_records == 2_000
+    assert sum(1 for _ in history.feeds["AirBox"].range()) == 2_000
+
+
+def test_written_to_disk_before_it_replaces_the_last(monkeypatch, tmp_path):
+    synced = []
+    fsync = os.fsync
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd) or fsync(fd))
+    poller = DevicePoller([DEVICE])
+    poller.process_init_response(DEVICE, PayloadGenerator(DEVICE).history(100))
+    save_snapshot(poller.view(DEVICE), str(tmp_path))
+    assert synced
+
+
+def header(data: bytearray) -> tuple[int, dict]:
+    (size,) = struct.unpack_from("<Q", data, len(MAGIC))
+    start = len(MAGIC) + 8
+    return size, json.loads(bytes(data[start : start + size]))
+
+
+def with_header(data: bytearray, changed: dict) -> bytes:
+    # The same arrays after another header.
+    size, _ = header(data)
+    encoded = json.dumps(changed).encode()
+    start = len(MAGIC) + 8
+    return MAGIC + struct.pack("<Q", len(encoded)) + encoded + data[start + size :]
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        pytest.param(lambda data: data[:200], id="truncated header"),
+        pytest.param(lambda data: data[: len(data) // 2], id="truncated arrays"),
+        pytest.param(
+            lambda data: data[: len(MAGIC) + 8] + b"[" + data[len(MAGIC) + 9 :],
+            id="broken json",
+        ),
+        pytest.param(
+            lambda data: with_header(
+                data, {k: v for k, v in header(data)[1].items() if k != "feeds"}
+            ),
+            id="missing field",
+        ),
+        pytest.param(
+            lambda data: data[: len(MAGIC)]
+            + struct.pack("<Q", 2**40)
+            + data[len(MAGIC) + 8 :],
+            id="header size",
+        ),
+    ],
+)
+def test_corrupt_snapshots_are_ignored(saved, change):
+    rewrite(saved, change)
+    assert load_snapshot(saved) is None
+
+
+def test_a_corrupt_snapshot_falls_back_to_a_cold_start(saved, tmp_path):
+    rewrite(saved, lambda data: data[: len(data) // 2])
+    poller = DevicePoller([DEVICE])
+
+    async def restore() -> int:
+        try:
+            return await poller.restore(str(tmp_path))
+        finally:
+            await poller.drain()
+
+    assert asyncio.run(restore()) == 0 and DEVICE not in poller.histories
+    assert snapshot_path(DEVICE, str(tmp_path)) == saved
@@ -0,0 +1,142 @@
+import random
+
+import pytest
+
+from src.data import DailyMetrics
+from src.stats import RunningStats, TDigest
+
+numpy = pytest.importorskip("numpy")
+
+QUANTILES = (0.5, 0.95, 0.99)
+# Rank error allowed for a quantile, a few readings in a day of 1440.
+RANK_ERROR = 0.003
+
+
+def samples(name: str, size: int) -> list[float]:
+    generator = random.Random(size)
+    draw = {
+        # PM2.5 is roughly log-normal with a long tail of polluted hours.
+        "lognormal": lambda: generator.lognormvariate(2.5, 0.6),
+        "normal": lambda: generator.gauss(35.0, 12.0),
+        "uniform": lambda: generator.uniform(0.0, 500.0),
+        # Whole micrograms with long runs of the same value.
+        "steps": lambda: float(generator.choice((3, 3, 3, 8, 8, 15, 40, 160))),
+        # Offset far from zero, where the naive sum of squares cancels.
+        "offset": lambda: 1e6 + generator.random(),
+    }[name]
+    return [draw() for _ in range(size)]
+
+
+DATASETS = ("lognormal", "normal", "uniform", "steps", "offset")
+
+
+def rank(values: numpy.ndarray, value: float) -> float:
+    # Quantiles are compared by rank, the usual accuracy measure for sketches,
+    # since the sparse upper tail turns small rank errors into large value gaps.
+    lo = numpy.searchsorted(values, value, side="left")
+    hi = numpy.searchsorted(values, value, side="right")
+    return (lo + hi) / 2 / len(values)
+
+
+@pytest.mark.parametrize("name", DATASETS)
+@pytest.mark.parametrize("size", [1, 2, 1440, 50_000])
+def test_running_stats_match_numpy(name, size):
+    values = samples(name, size)
+    stats = RunningStats()
+    for value in values:
+        stats.add(value)
+
+    assert stats.count == size
+    assert stats.min == min(values) and stats.max == max(values)
+    assert stats.mean == pytest.approx(numpy.mean(values), rel=1e-12)
+    # Population variance, as numpy computes it by default.
+    assert stats.variance == pytest.approx(numpy.var(values), rel=1e-6, abs=1e-9)
+    assert stats.std == pytest.approx(numpy.std(values), rel=1e-6, abs=1e-9)
+
+
+@pytest.mark.parametrize("name", DATASETS)
+def test_merged_stats_match_one_pass(name):
+    values = samples(name, 7 * 1440)
+    days = [RunningStats() for _ in range(7)]
+    for index, value in enumerate(values):
+        days[index // 1440].add(value)
+    merged = RunningStats()
+    merged.merge(RunningStats())
+    for day in days:
+        merged.merge(day)
+    merged.merge(RunningStats())
+
+    assert merged.count == len(values)
+    assert merged.mean == pytest.approx(numpy.mean(values), rel=1e-12)
+    assert merged.variance == pytest.approx(numpy.var(values), rel=1e-6)
+    assert merged.min == min(values) and merged.max == max(values)
+
+
+def test_empty_stats():
+    stats = RunningStats()
+    assert stats.variance is None and stats.std is None
+    assert TDigest().quantile(0.5) is None
+    assert DailyMetrics.empty().p50 is None
+
+
+@pytest.mark.parametrize("name", DATASETS)
+@pytest.mark.parametrize("size", [1440, 50_000])
+def test_digest_quantiles_match_numpy(name, size):
+    values = samples(name, size)
+    digest = TDigest()
+    for value in values:
+        digest.add(value)
+    ordered = numpy.sort(values)
+
+    for q in QUANTILES:
+        found = digest.quantile(q)
+        assert ordered[0] <= found <= ordered[-1]
+        expected = numpy.percentile(ordered, q * 100)
+        if name == "steps":
+            # Ties have no rank of their own, the value itself has to match.
+            assert found == pytest.approx(expected)
+        else:
+            assert rank(ordered, found) == pytest.approx(q, abs=RANK_ERROR)
+            spread = ordered[-1] - ordered[0]
+            assert abs(found - expected) < 0.01 * spread
+    assert digest.quantile(0) == ordered[0] and digest.quantile(1) == ordered[-1]
+    assert len(digest.means) <= digest.compression
+
+
+def test_merged_digest_matches_numpy():
+    values = samples("lognormal", 30 * 1440)
+    merged = TDigest()
+    for day in range(30):
+        digest = TDigest()
+        for value in values[day * 1440 : (day + 1) * 1440]:
+            digest.add(value)
+        merged.merge(digest)
+    ordered = numpy.sort(values)
+
+    for q in QUANTILES:
+        assert rank(ordered, merged.quantile(q)) == pytest.approx(q, abs=RANK_ERROR)
+    assert len(merged.means) <= merged.compression
+
+
+def test_daily_metrics_round_what_numpy_finds():
+    values = [round(value, 1) for value in samples("lognormal", 1440)]
+    metrics = DailyMetrics.empty()
+    metrics.extend(values[:720])
+    for value in values[720:]:
+        metrics.add(value)
+    ordered = numpy.sort(values)
+
+    assert metrics.count == 1440
+    assert metrics.max == max(values) and metrics.min == min(values)
+    assert metrics.avg == round(metrics._stats.mean, 1)
+    assert metrics.avg == pytest.approx(numpy.mean(values), abs=0.051)
+    assert metrics.std == pytest.approx(numpy.std(values), abs=0.051)
+    for q, found in zip(QUANTILES, (metrics.p50, metrics.p95, metrics.p99)):
+        assert found == round(metrics._digest.quantile(q), 1)
+        assert rank(ordered, found) == pytest.approx(q, abs=RANK_ERROR)
+
+    week = DailyMetrics.merge([metrics, DailyMetrics.empty(), metrics.freeze()])
+    assert week.count == 2 * 1440
+    assert week.avg == metrics.avg and week.std == metrics.std
+    assert week.max == metrics.max and week.min == metrics.min
+    assert week.p50 == pytest.approx(metrics.p50, abs=0.5)
@@ -0,0 +1,24 @@
+import threading
+
+from src.telemetry import REGISTRY, Counter, Histogram
+
+
+def test_counts_from_several_threads_add_up():
+    counter = Counter("pm_test_total", "Test counter.", ["thread"])
+    histogram = Histogram("pm_test_seconds", "Test histogram.")
+    REGISTRY.remove(counter)
+    REGISTRY.remove(histogram)
+
+    def count():
+        for i in range(20_000):
+            counter.inc("any")
+            histogram.observe(i % 3 / 1000)
+
+    threads = [threading.Thread(target=count) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.series == {("any",): 80_000}
+    assert sum(histogram.series[()][:-1]) == 80_000
+    assert "pm_test_seconds_count 80000" in "\n".join(histogram.render())